@@ -0,0 +1,71 @@
+import json
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lrs.managers.StatementManager import agent_role_fields, get_role_rows
+from lrs.models import Statement, StatementRole, Activity
+from lrs.utils import chunks, bulk_create_in_batches, filter_in_batches, json_text_column
+
+def get_activity_ids(stmt_json, prefix=''):
+	# Object and context activities as (role, activity id) pairs
+	act_ids = []
+	stmt_object = stmt_json['object']
+	if stmt_object.get('objectType', 'Activity') == 'Activity':
+		act_ids.append((prefix + 'object', stmt_object['id']))
+	con_acts = stmt_json.get('context', {}).get('contextActivities', {})
+	for group, acts in con_acts.items():
+		if not isinstance(acts, list):
+			acts = [acts]
+		act_ids.extend([(prefix + group, a['id']) for a in acts])
+	return act_ids
+
+class Command(BaseCommand):
+	help = 'Rebuilds the statement role index used by related_agents and related_activities from the stored statements'
+	option_list = BaseCommand.option_list + (
+		make_option(
+			'--batch',
+			dest = 'batch',
+			default = 500,
+			type = 'int',
+			help = 'Number of statements to index per transaction',
+			metavar = 'BATCH'
+			),
+		)
+
+	def handle(self, *args, **options):
+		# Agents are single FKs so they come straight off the statement rows, activities are read from
+		# full_statement to avoid joining the context activity tables
+		agent_fields = [field for role, field in agent_role_fields]
+		fields = ['id', 'full_statement_text', 'authority'] + agent_fields + \
+			['object_substatement__%s' % field for field in agent_fields]
+
+		pks = list(Statement.objects.order_by('id').values_list('id', flat=True))
+		for batch in chunks(pks, options['batch']):
+			stmts = Statement.objects.filter(id__in=batch).extra(select={'full_statement_text': json_text_column(Statement, 'full_statement')})
+			self.index_statements(stmts.values(*fields))
+			self.stdout.write("Indexed %s statements\n" % len(batch))
+		self.stdout.write("Successfully rebuilt the statement role index\n")
+
+	@transaction.commit_on_success
+	def index_statements(self, stmts):
+		stmts = list(stmts)
+		roles = []
+		for stmt in stmts:
+			full_statement = json.loads(stmt['full_statement_text'])
+			agent_roles = [(role, stmt[field]) for role, field in agent_role_fields]
+			agent_roles.append(('authority', stmt['authority']))
+			agent_roles.extend([('sub_' + role, stmt['object_substatement__%s' % field]) for role, field in agent_role_fields])
+			activity_roles = get_activity_ids(full_statement)
+			if full_statement['object'].get('objectType', None) == 'SubStatement':
+				activity_roles.extend(get_activity_ids(full_statement['object'], 'sub_'))
+			roles.append((stmt['id'], agent_roles, activity_roles))
+
+		act_ids = set(a[1] for stmt_pk, agent_roles, activity_roles in roles for a in activity_roles)
+		act_pks = dict(filter_in_batches(Activity.objects.values_list('activity_id', 'id'), 'activity_id', act_ids))
+		rows = []
+		for stmt_pk, agent_roles, activity_roles in roles:
+			rows.extend(get_role_rows(stmt_pk, agent_roles, [(role, act_pks.get(act_id, None)) for role, act_id in activity_roles]))
+
+		StatementRole.objects.filter(statement__in=[s['id'] for s in stmts]).delete()
+		bulk_create_in_batches(StatementRole, rows)
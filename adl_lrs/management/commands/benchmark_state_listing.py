@@ -0,0 +1,121 @@
+import datetime
+import random
+import time
+import uuid
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils.timezone import utc
+
+from lrs.managers.ActivityStateManager import ActivityStateManager
+from lrs.models import Agent, ActivityState
+from lrs.utils import bulk_create_in_batches
+
+MBOX_PREFIX = 'mailto:benchmark-state-listing-'
+ACTIVITY_PREFIX = 'http://example.com/benchmark/activity/'
+
+def percentile(timings, fraction):
+	timings = sorted(timings)
+	return timings[min(int(len(timings) * fraction), len(timings) - 1)] * 1000
+
+class Command(BaseCommand):
+	help = 'Fills the activity state table with synthetic rows and times the stateId listings with and without since'
+	option_list = BaseCommand.option_list + (
+		make_option(
+			'--rows',
+			dest = 'rows',
+			default = 1000000,
+			type = 'int',
+			help = 'Number of state rows to create',
+			metavar = 'ROWS'
+			),
+		make_option(
+			'--agents',
+			dest = 'agents',
+			default = 10000,
+			type = 'int',
+			help = 'Number of agents the rows are spread over',
+			metavar = 'AGENTS'
+			),
+		make_option(
+			'--queries',
+			dest = 'queries',
+			default = 500,
+			type = 'int',
+			help = 'Number of listings timed for each kind of query',
+			metavar = 'QUERIES'
+			),
+		make_option(
+			'--keep',
+			action = 'store_true',
+			dest = 'keep',
+			default = False,
+			help = 'Leave the synthetic rows in place'
+			),
+		)
+
+	def handle(self, *args, **options):
+		# Each agent gets ten activities with a registered and an unregistered set of states
+		self.registrations = ['', str(uuid.uuid4())]
+		self.activities = [ACTIVITY_PREFIX + str(i) for i in range(10)]
+		self.now = datetime.datetime.utcnow().replace(tzinfo=utc)
+		try:
+			agents = self.populate(options['rows'], options['agents'])
+			self.stdout.write("Timing listings over %s state rows\n" % ActivityState.objects.count())
+			self.time_listing("stateIds", agents, options['queries'], lambda: (random.choice(self.activities), None, None))
+			self.time_listing("stateIds since", agents, options['queries'], lambda: (random.choice(self.activities),
+				self.registrations[1], self.now - datetime.timedelta(days=random.randint(1, 365))))
+		finally:
+			if not options['keep']:
+				self.cleanup()
+
+	@transaction.commit_on_success
+	def populate(self, rows, agent_count):
+		bulk_create_in_batches(Agent, [Agent(mbox='%s%s@example.com' % (MBOX_PREFIX, i)) for i in range(agent_count)])
+		agents = list(Agent.objects.filter(mbox__startswith=MBOX_PREFIX).values_list('id', flat=True))
+		per_pair = max(rows / (len(agents) * len(self.activities) * len(self.registrations)), 1)
+		created = 0
+		for agent_id in agents:
+			states = []
+			for activity_id in self.activities:
+				for registration in self.registrations:
+					for i in range(per_pair):
+						states.append(ActivityState(agent_id=agent_id, activity_id=activity_id, registration_id=registration,
+							state_id='state-%s' % i, json_state='{}', content_type='application/json', etag=uuid.uuid4().hex,
+							updated=self.now - datetime.timedelta(minutes=random.randint(0, 525600))))
+			bulk_create_in_batches(ActivityState, states)
+			created += len(states)
+			if created >= rows:
+				break
+		return agents
+
+	def time_listing(self, label, agents, queries, get_args):
+		timings = []
+		for i in range(queries):
+			manager = ActivityStateManager(Agent(id=random.choice(agents)))
+			args = get_args()
+			start = time.time()
+			manager.get_state_ids(*args)
+			timings.append(time.time() - start)
+		self.stdout.write("%s: median %.2fms, p95 %.2fms\n" % (label, percentile(timings, 0.5), percentile(timings, 0.95)))
+		self.explain(manager.get_state_set(*args).values_list('state_id', flat=True))
+
+	def explain(self, queryset):
+		sql, params = queryset.query.sql_with_params()
+		cursor = connection.cursor()
+		if connection.vendor == 'sqlite':
+			cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+			plan = [row[-1] for row in cursor.fetchall()]
+		else:
+			cursor.execute("EXPLAIN " + sql, params)
+			plan = [row[0] for row in cursor.fetchall()]
+		self.stdout.write("".join("    %s\n" % line for line in plan))
+
+	@transaction.commit_on_success
+	def cleanup(self):
+		# Straight SQL, deleting through the ORM would load every row first
+		qn = connection.ops.quote_name
+		cursor = connection.cursor()
+		cursor.execute("DELETE FROM %s WHERE %s IN (SELECT %s FROM %s WHERE %s LIKE %%s)" % (qn(ActivityState._meta.db_table),
+			qn('agent_id'), qn('id'), qn(Agent._meta.db_table), qn('mbox')), [MBOX_PREFIX + '%'])
+		cursor.execute("DELETE FROM %s WHERE %s LIKE %%s" % (qn(Agent._meta.db_table), qn('mbox')), [MBOX_PREFIX + '%'])
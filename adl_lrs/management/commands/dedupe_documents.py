@@ -0,0 +1,41 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lrs.management import duplicate_document_keys
+from lrs.models import DOCUMENT_INDEXES
+
+class Command(BaseCommand):
+	help = 'Deletes documents that repeat a state or profile key, keeping the most recently updated one, so syncdb can add the unique keys'
+	option_list = BaseCommand.option_list + (
+		make_option(
+			'--dry-run',
+			action = 'store_true',
+			dest = 'dry_run',
+			default = False,
+			help = 'Only report the documents that would be deleted'
+			),
+		)
+
+	def handle(self, *args, **options):
+		deleted = 0
+		for name, model, fields, unique in DOCUMENT_INDEXES:
+			if not unique:
+				continue
+			for key in duplicate_document_keys(model, fields):
+				deleted += self.dedupe_key(model, fields, key, options['dry_run'])
+		if options['dry_run']:
+			self.stdout.write("Would delete %s documents\n" % deleted)
+		else:
+			self.stdout.write("Deleted %s documents, run syncdb to add the document keys\n" % deleted)
+
+	@transaction.commit_on_success
+	def dedupe_key(self, model, fields, key, dry_run):
+		docs = list(model.objects.filter(**key).order_by('-updated', '-pk'))
+		label = ', '.join('%s=%s' % (f, key[f]) for f in fields)
+		self.stdout.write("%s %s: keeping pk %s updated %s\n" % (model.__name__, label, docs[0].pk, docs[0].updated))
+		for doc in docs[1:]:
+			self.stdout.write("    %s pk %s updated %s\n" % ('would delete' if dry_run else 'deleting', doc.pk, doc.updated))
+			if not dry_run:
+				doc.delete()
+		return len(docs) - 1
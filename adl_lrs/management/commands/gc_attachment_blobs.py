@@ -0,0 +1,68 @@
+import os
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lrs.models import StatementAttachment, AttachmentBlob, STATEMENT_ATTACHMENT_UPLOAD_TO, attachment_payload_path
+from lrs.utils import filter_in_batches
+
+class Command(BaseCommand):
+	help = 'Deletes attachment payloads that no attachment references anymore'
+	option_list = BaseCommand.option_list + (
+		make_option(
+			'--grace',
+			dest = 'grace',
+			default = 3600,
+			type = 'int',
+			help = 'Seconds since a payload was last written before it can be collected',
+			metavar = 'GRACE'
+			),
+		)
+
+	def handle(self, *args, **options):
+		self.storage = StatementAttachment._meta.get_field('payload').storage
+		# Payloads written or reused recently could belong to a request that has not committed yet
+		self.cutoff = time.time() - options['grace']
+		deleted = 0
+		for sha2 in AttachmentBlob.objects.filter(ref_count=0).values_list('sha2', flat=True):
+			deleted += self.collect_blob(sha2)
+		deleted += self.collect_orphans()
+		self.stdout.write("Deleted %s attachment payloads\n" % deleted)
+
+	def is_stale(self, path):
+		try:
+			return os.path.getmtime(path) < self.cutoff
+		except OSError:
+			return True
+
+	@transaction.commit_on_success
+	def collect_blob(self, sha2):
+		# The row is locked and checked again so a reference added meanwhile keeps the payload
+		try:
+			blob = AttachmentBlob.objects.select_for_update().get(sha2=sha2, ref_count=0)
+		except AttachmentBlob.DoesNotExist:
+			return 0
+		path = self.storage.path(attachment_payload_path(sha2))
+		if not self.is_stale(path):
+			return 0
+		if os.path.exists(path):
+			os.remove(path)
+		blob.delete()
+		return 1
+
+	def collect_orphans(self):
+		# Files with no blob row at all are left over from requests that rolled back
+		deleted = 0
+		root = self.storage.path(STATEMENT_ATTACHMENT_UPLOAD_TO)
+		for dirpath, dirnames, filenames in os.walk(root):
+			# Only the sharded layout is managed here
+			if dirpath == root:
+				continue
+			known = set(filter_in_batches(AttachmentBlob.objects.values_list('sha2', flat=True), 'sha2', filenames))
+			for filename in filenames:
+				path = os.path.join(dirpath, filename)
+				if filename not in known and self.is_stale(path):
+					os.remove(path)
+					deleted += 1
+		return deleted
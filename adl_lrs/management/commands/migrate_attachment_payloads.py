@@ -0,0 +1,74 @@
+import binascii
+import hashlib
+import os
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from lrs.models import StatementAttachment, AttachmentBlob, attachment_payload_path
+
+def decode_payload(data, sha2):
+	# Text payloads with a base64 transfer encoding were encoded twice, so allow for two rounds
+	for i in range(2):
+		try:
+			data = binascii.a2b_base64(data)
+		except binascii.Error:
+			return None
+		if hashlib.sha256(data).hexdigest() == sha2:
+			return data
+	return None
+
+def write_payload(path, data):
+	# Written next to the target and renamed over it so a failed run never leaves a partial payload
+	if not os.path.exists(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path + '.tmp', 'wb') as f:
+		f.write(data)
+	os.rename(path + '.tmp', path)
+
+class Command(BaseCommand):
+	help = 'Moves attachment payloads into the sharded blob store, decoding ones stored base64 encoded, and recounts blob references'
+
+	def handle(self, *args, **options):
+		storage = StatementAttachment._meta.get_field('payload').storage
+		converted = 0
+		moved = 0
+		payloads = StatementAttachment.objects.exclude(payload='').exclude(payload=None).values_list('sha2', 'payload').distinct()
+		for sha2, name in payloads:
+			new_name = attachment_payload_path(sha2)
+			old_name = name
+			if not storage.exists(name):
+				if not storage.exists(new_name):
+					self.stdout.write("Missing payload file %s\n" % name)
+					continue
+				name = new_name
+			with storage.open(name) as f:
+				data = f.read()
+			# Payloads that already hash to their sha2 are raw
+			raw = hashlib.sha256(data).hexdigest() == sha2
+			if not raw:
+				data = decode_payload(data, sha2)
+				if data is None:
+					self.stdout.write("Payload file %s does not decode to its sha2, skipping\n" % name)
+					continue
+				converted += 1
+			if name != new_name:
+				if not storage.exists(new_name):
+					write_payload(storage.path(new_name), data)
+			elif not raw:
+				write_payload(storage.path(name), data)
+			# Rows are pointed at the new file before the old one goes
+			if old_name != new_name:
+				StatementAttachment.objects.filter(payload=old_name).update(payload=new_name)
+				moved += 1
+			if name != new_name:
+				storage.delete(name)
+		self.recount_refs()
+		self.stdout.write("Converted %s and moved %s payload files\n" % (converted, moved))
+
+	@transaction.commit_on_success
+	def recount_refs(self):
+		counts = dict(StatementAttachment.objects.exclude(payload='').exclude(payload=None).values_list('sha2')
+			.annotate(refs=Count('id')))
+		AttachmentBlob.objects.update(ref_count=0)
+		AttachmentBlob.objects.add_refs(counts)
@@ -0,0 +1,51 @@
+import time
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from lrs.utils import delete_in_one_query
+from oauth_provider.models import Nonce
+
+class Command(BaseCommand):
+	help = 'Deletes stored OAuth 1 nonces whose timestamp is too old for a request to be accepted'
+	option_list = BaseCommand.option_list + (
+		make_option(
+			'--age',
+			dest = 'age',
+			default = None,
+			type = 'int',
+			help = 'Seconds a nonce is kept for, defaults to OAUTH_NONCE_VALID_PERIOD',
+			metavar = 'AGE'
+			),
+		make_option(
+			'--batch',
+			dest = 'batch',
+			default = 5000,
+			type = 'int',
+			help = 'Number of nonces to delete per transaction',
+			metavar = 'BATCH'
+			),
+		)
+
+	def handle(self, *args, **options):
+		age = options['age'] if options['age'] is not None else getattr(settings, 'OAUTH_NONCE_VALID_PERIOD', None)
+		if age is None:
+			raise CommandError('Set OAUTH_NONCE_VALID_PERIOD or pass --age, without either every nonce is still needed')
+		cutoff = int(time.time()) - age
+		deleted = 0
+		while True:
+			count = self.delete_batch(cutoff, options['batch'])
+			if not count:
+				break
+			deleted += count
+			self.stdout.write("Deleted %s nonces\n" % deleted)
+		self.stdout.write("Successfully purged nonces older than %s seconds\n" % age)
+
+	@transaction.commit_on_success
+	def delete_batch(self, cutoff, batch):
+		# Short transactions so verification keeps writing nonces while a large table is cleared
+		pks = list(Nonce.objects.filter(timestamp__lt=cutoff).values_list('id', flat=True)[:batch])
+		if pks:
+			delete_in_one_query(Nonce.objects.filter(id__in=pks))
+		return len(pks)
@@ -108,6 +108,17 @@ OAUTH_CALLBACK_VIEW = 'oauth_provider.views.callback_view'
 OAUTH_SIGNATURE_METHODS = ['plaintext','hmac-sha1','rsa-sha1']
 OAUTH_REALM_KEY_NAME = '%s://%s/xAPI' % (SITE_SCHEME, SITE_DOMAIN)
 
+# Number of parsed RSA keys kept for OAuth RSA-SHA1 signatures and signed statement certificates
+RSA_KEY_CACHE_SIZE = 100
+# Seconds either side of the current time a signed OAuth 1 request's timestamp is accepted, and so how long its nonce
+# is remembered
+OAUTH_NONCE_VALID_PERIOD = 300
+# Where OAuth 1 nonces are remembered. ModelNonceStore keeps Nonce rows which purge_oauth_nonces clears out,
+# LocalNonceStore keeps them in memory for a single process deployment and CacheNonceStore keeps them in the
+# OAUTH_NONCE_CACHE cache, which must not cull live entries early (memcached rather than the database cache)
+OAUTH_NONCE_STORE = 'oauth_provider.store.nonce.ModelNonceStore'
+OAUTH_NONCE_CACHE = 'default'
+
 # THIS IS OAUTH2 STUFF
 STATE = 1
 PROFILE = 1 << 1
@@ -138,22 +149,41 @@ CELERY_RESULT_SERIALIZER = 'json'
 
 # Limit on number of statements the server will return
 SERVER_STMT_LIMIT = 100
+# Seconds a statements more URL stays valid
+MORE_CURSOR_MAX_AGE = 86400
+# Number of agents each process keeps cached by IFP
+AGENT_CACHE_SIZE = 1000
+# Number of verbs and of activities each process keeps cached by IRI, and for how many seconds
+DEFINITION_CACHE_SIZE = 5000
+DEFINITION_CACHE_TIMEOUT = 300
+# Number of JSON state and profile documents each process keeps cached, 0 turns the cache off, and the
+# longest document that gets cached
+DOCUMENT_CACHE_SIZE = 1000
+DOCUMENT_CACHE_MAX_LENGTH = 64 * 1024
+# Number of verified Basic auth credentials and of resolved OAuth token contexts each process keeps, and for how
+# many seconds, 0 turns both caches off
+CREDENTIAL_CACHE_SIZE = 1000
+CREDENTIAL_CACHE_TIMEOUT = 60
+# Merge POSTed JSON state and profile documents in the database with jsonb, needs Postgres 9.5+
+DOCUMENT_JSONB_MERGE = False
+# Bytes read from disk at a time when streaming attachment payloads
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+# How stored documents and attachment payloads are sent. None streams them through Django, 'x-sendfile'
+# hands the absolute path to Apache's mod_xsendfile and 'x-accel-redirect' hands FILE_OFFLOAD_URL plus the
+# path under MEDIA_ROOT to an nginx internal location
+FILE_OFFLOAD = None
+FILE_OFFLOAD_URL = '/protected/'
 # Fifteen second timeout to all celery tasks
 CELERYD_TASK_SOFT_TIME_LIMIT = 15
 # ActivityID resolve timeout (seconds)
 ACTIVITY_ID_RESOLVE_TIMEOUT = .2
-# Caches for /more endpoint and attachments
+# Shared cache for agents and the statement consistency watermark
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
         'LOCATION': 'cache_statement_list',
         'TIMEOUT': 86400,
     },
-    'attachment_cache':{
-        'BACKEND':'django.core.cache.backends.db.DatabaseCache',
-        'LOCATION':'attachment_cache',
-        'TIMEOUT': 86400,        
-    },
 }
 
 # List of finder classes that know how to find static files in
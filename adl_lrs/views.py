@@ -1,6 +1,5 @@
 import json
 import urllib
-from base64 import b64decode
 
 from django.contrib.auth import logout, login, authenticate
 from django.contrib.auth.decorators import login_required
@@ -18,6 +17,7 @@ from .forms import ValidatorForm, RegisterForm, RegClientForm
 from lrs.exceptions import ParamError
 from lrs.models import Statement, Verb, Agent, Activity, StatementAttachment, ActivityState
 from lrs.utils.StatementValidator import StatementValidator
+from lrs.utils.file_response import file_response
 
 from oauth_provider.consts import ACCEPTED, CONSUMER_STATES
 from oauth_provider.models import Consumer, Token
@@ -112,20 +112,16 @@ def register(request):
 @require_http_methods(["GET"])
 def admin_attachments(request, path):
     if request.user.is_superuser:
+        # Attachments with the same sha2 share one payload file
+        att_objects = StatementAttachment.objects.filter(sha2=path).exclude(payload='').exclude(payload=None)[:1]
+        if not att_objects:
+            return HttpResponseNotFound("File not found")
+        att_object = att_objects[0]
         try:
-            att_object = StatementAttachment.objects.get(sha2=path)
-        except StatementAttachment.DoesNotExist:
-            raise HttpResponseNotFound("File not found")
-        chunks = []
-        try:
-            # Default chunk size is 64kb
-            for chunk in att_object.payload.chunks():
-                decoded_data = b64decode(chunk)
-                chunks.append(decoded_data)
-        except OSError:
+            response = file_response(att_object.payload, str(att_object.contentType))
+        except EnvironmentError:
             return HttpResponseNotFound("File not found")
 
-        response = HttpResponse(chunks, content_type=str(att_object.contentType))
         response['Content-Disposition'] = 'attachment; filename="%s"' % path
         return response
 
@@ -82,7 +82,6 @@ def setup_lrs():
 
     # Create cache tables and sync the db
     local('./manage.py createcachetable cache_statement_list')
-    local('./manage.py createcachetable attachment_cache')
     local('./manage.py syncdb')
 
     print "If you see an error code 23 while running rync it's only because there were no files to sync in the django_extensions directory. \
@@ -0,0 +1,55 @@
+import sys
+
+from django.db import connection
+from django.db.models import Count
+from django.db.models.signals import post_syncdb
+
+import lrs.models
+from lrs.models import DOCUMENT_INDEXES, MAX_URL_LENGTH
+
+def index_exists(cursor, name):
+    if connection.vendor == 'sqlite':
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = %s", [name])
+    else:
+        cursor.execute("SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                       "WHERE c.relname = %s AND c.relkind = 'i' AND n.nspname = current_schema()", [name])
+    return cursor.fetchone() is not None
+
+def index_column(field):
+    # A PostgreSQL btree entry can't hold two IRIs of MAX_URL_LENGTH, so IRI columns are indexed by their md5
+    column = connection.ops.quote_name(field.column)
+    if connection.vendor == 'postgresql' and getattr(field, 'max_length', None) == MAX_URL_LENGTH:
+        return 'md5(%s)' % column
+    return column
+
+def duplicate_document_keys(model, fields):
+    # Rows written before the natural key was unique can repeat it
+    duplicates = model.objects.values(*fields).annotate(rows=Count('pk')).filter(rows__gt=1)
+    keys = []
+    for key in duplicates.order_by(*fields):
+        del key['rows']
+        keys.append(key)
+    return keys
+
+def create_document_indexes(sender, verbosity=1, **kwargs):
+    # Runs on every syncdb so existing databases pick the indexes up as well
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for name, model, fields, unique in DOCUMENT_INDEXES:
+        if index_exists(cursor, name):
+            continue
+        if unique:
+            duplicates = duplicate_document_keys(model, fields)
+            if duplicates:
+                # Picking which document survives is left to dedupe_documents, syncdb never deletes data
+                sys.stderr.write("Not creating index %s, %s rows repeat its key:\n" % (name, model.__name__))
+                for key in duplicates:
+                    sys.stderr.write("    %s\n" % ', '.join('%s=%s' % (f, key[f]) for f in fields))
+                sys.stderr.write("Run manage.py dedupe_documents and then syncdb again\n")
+                continue
+        columns = ', '.join(index_column(model._meta.get_field(field)) for field in fields)
+        cursor.execute("CREATE %sINDEX %s ON %s (%s)" % ('UNIQUE ' if unique else '', qn(name),
+                                                        qn(model._meta.db_table), columns))
+        if verbosity >= 1:
+            sys.stdout.write("Creating index %s\n" % name)
+post_syncdb.connect(create_document_indexes, sender=lrs.models)
@@ -2,6 +2,57 @@ from django.db import IntegrityError
 
 from ..models import Activity
 
+def set_activity_definition(activity, act_def):
+    interactionType = act_def.get('interactionType', '')
+    activity.activity_definition_name = act_def.get('name', {})
+    activity.activity_definition_description = act_def.get('description', {})
+    activity.activity_definition_type = act_def.get('type', '')
+    activity.activity_definition_moreInfo = act_def.get('moreInfo', '')
+    activity.activity_definition_crpanswers = act_def.get('correctResponsesPattern', {})
+    activity.activity_definition_extensions = act_def.get('extensions', {})
+    activity.activity_definition_interactionType = interactionType
+
+    #Multiple choice and sequencing must have choices
+    if (interactionType == 'choice' or \
+        interactionType == 'sequencing') and \
+        ('choices' in act_def):
+        activity.activity_definition_choices = act_def['choices']
+    #Matching must have both source and target
+    elif (interactionType == 'matching') and \
+        ('source' in act_def and 'target' in act_def):
+        activity.activity_definition_sources = act_def['source'] 
+        activity.activity_definition_targets = act_def['target']
+    #Performance must have steps
+    elif (interactionType == 'performance') and \
+        ('steps' in act_def):
+        activity.activity_definition_steps = act_def['steps']
+    #Likert must have scale
+    elif (interactionType == 'likert') and \
+        ('scale' in act_def):
+        activity.activity_definition_scales = act_def['scale']
+
+def merge_activity_definition(activity, act_def):
+    # Returns whether either language map changed
+    current = (activity.activity_definition_name, activity.activity_definition_description)
+    if 'name' in act_def:
+        if activity.activity_definition_name:
+            activity.activity_definition_name = dict(activity.activity_definition_name.items() + act_def['name'].items())
+        else:
+            activity.activity_definition_name = act_def['name']       
+
+    if 'description' in act_def:
+        if activity.activity_definition_description:
+            activity.activity_definition_description = dict(activity.activity_definition_description.items() + act_def['description'].items())
+        else:
+            activity.activity_definition_description = act_def['description']
+    return current != (activity.activity_definition_name, activity.activity_definition_description)
+
+def can_define_activity(act, auth):
+    return bool((not act.authority) or \
+       (act.authority == auth) or \
+       (act.authority.objectType == 'Group' and auth in act.authority.member.all()) or \
+       (auth.objectType == 'Group' and act.authority in auth.member.all()))
+
 class ActivityManager():
     def __init__(self, data, auth=None, define=True):
         self.auth = auth
@@ -9,48 +60,13 @@ class ActivityManager():
         self.populate(data)
 
     def create_activity_definition(self, act_def):
-        interactionType = act_def.get('interactionType', '')
-        self.Activity.activity_definition_name = act_def.get('name', {})
-        self.Activity.activity_definition_description = act_def.get('description', {})
-        self.Activity.activity_definition_type = act_def.get('type', '')
-        self.Activity.activity_definition_moreInfo = act_def.get('moreInfo', '')
-        self.Activity.activity_definition_crpanswers = act_def.get('correctResponsesPattern', {})
-        self.Activity.activity_definition_extensions = act_def.get('extensions', {})
-        self.Activity.activity_definition_interactionType = interactionType
-
-        #Multiple choice and sequencing must have choices
-        if (interactionType == 'choice' or \
-            interactionType == 'sequencing') and \
-            ('choices' in act_def):
-            self.Activity.activity_definition_choices = act_def['choices']
-        #Matching must have both source and target
-        elif (interactionType == 'matching') and \
-            ('source' in act_def and 'target' in act_def):
-            self.Activity.activity_definition_sources = act_def['source'] 
-            self.Activity.activity_definition_targets = act_def['target']
-        #Performance must have steps
-        elif (interactionType == 'performance') and \
-            ('steps' in act_def):
-            self.Activity.activity_definition_steps = act_def['steps']
-        #Likert must have scale
-        elif (interactionType == 'likert') and \
-            ('scale' in act_def):
-            self.Activity.activity_definition_scales = act_def['scale']
+        set_activity_definition(self.Activity, act_def)
         self.Activity.save()
 
     def update_activity_definition(self, act_def):
-        if 'name' in act_def:
-            if self.Activity.activity_definition_name:
-                self.Activity.activity_definition_name = dict(self.Activity.activity_definition_name.items() + act_def['name'].items())
-            else:
-                self.Activity.activity_definition_name = act_def['name']       
-
-        if 'description' in act_def:
-            if self.Activity.activity_definition_description:
-                self.Activity.activity_definition_description = dict(self.Activity.activity_definition_description.items() + act_def['description'].items())
-            else:
-                self.Activity.activity_definition_description = act_def['description']
-        self.Activity.save()
+        if merge_activity_definition(self.Activity, act_def):
+            self.Activity.version += 1
+            self.Activity.save()
 
     def populate(self, the_object):
         activity_id = the_object['id']
@@ -83,13 +99,7 @@ class ActivityManager():
                 # Act exists but it was created by someone who didn't have define permissions so it's up for grabs
                 # for first user with define permission or...
                 # Act exists - if it has same auth set it, else do nothing    
-                if (not act.authority) or \
-                   (act.authority == self.auth) or \
-                   (act.authority.objectType == 'Group' and self.auth in act.authority.member.all()) or \
-                   (self.auth.objectType == 'Group' and act.authority in self.auth.member.all()):
-                    can_define = True
-                else:
-                    can_define = False
+                can_define = can_define_activity(act, self.auth)
             # activity already exists but do not have define
             else:
                 can_define = False
@@ -1,32 +1,23 @@
-import datetime
-import json
-
-from django.core.files.base import ContentFile
-from django.utils.timezone import utc
-
 from ..models import ActivityState
-from ..exceptions import IDNotFoundError, ParamError
-from ..utils import etag
+from ..exceptions import IDNotFoundError
+from ..utils import filter_in_batches, delete_in_one_query, match_iri_hash
+from ..tasks import delete_document_files
+from .DocumentManager import DocumentManager
+
+class ActivityStateManager(DocumentManager):
+    model = ActivityState
+    file_field = 'state'
+    json_field = 'json_state'
+    document_key = 'state'
 
-class ActivityStateManager():
     def __init__(self, agent):
         self.Agent = agent
 
-    def save_non_json_state(self, s, state, request_dict):
-        s.content_type = request_dict['headers']['CONTENT_TYPE']
-        s.etag = etag.create_tag(state.read())
-
-        if 'updated' in request_dict['headers'] and request_dict['headers']['updated']:
-            s.updated = request_dict['headers']['updated']
-        else:
-            s.updated = datetime.datetime.utcnow().replace(tzinfo=utc)
-        
-        # Go to beginning of file
-        state.seek(0)
-        fn = "%s_%s_%s" % (s.agent_id, s.activity_id, request_dict.get('filename', s.id))
-        s.state.save(fn, state)
-
-        s.save()
+    def get_state_key(self, request_dict):
+        # States without a registration are stored with an empty one
+        return {'agent': self.Agent, 'activity_id': request_dict['params']['activityId'],
+                'registration_id': request_dict['params'].get('registration', None) or '',
+                'state_id': request_dict['params']['stateId']}
 
     def get_state_set(self, activity_id, registration, since):
         if registration:
@@ -43,125 +34,42 @@ class ActivityStateManager():
             # Neither
             else:
                 state_set = self.Agent.activitystate_set.filter(activity_id=activity_id)
-        return state_set
+        return match_iri_hash(state_set, 'activity_id', activity_id)
 
     def post_state(self, request_dict):
-        registration = request_dict['params'].get('registration', None)
-        if registration:
-            s, created = ActivityState.objects.get_or_create(state_id=request_dict['params']['stateId'], agent=self.Agent,
-                activity_id=request_dict['params']['activityId'], registration_id=request_dict['params']['registration'])
-        else:
-            s, created = ActivityState.objects.get_or_create(state_id=request_dict['params']['stateId'], agent=self.Agent,
-                activity_id=request_dict['params']['activityId'])
-        
-        if "application/json" not in request_dict['headers']['CONTENT_TYPE']:
-            try:
-                post_state = ContentFile(request_dict['state'].read())
-            except:
-                try:
-                    post_state = ContentFile(request_dict['state'])
-                except:
-                    post_state = ContentFile(str(request_dict['state']))
-            self.save_non_json_state(s, post_state, request_dict)
-        else:
-            post_state = request_dict['state']
-            # If incoming state is application/json and if a state didn't already exist with the same agent, stateId, actId, and/or registration
-            if created:
-                s.json_state = post_state
-                s.content_type = request_dict['headers']['CONTENT_TYPE']
-                s.etag = etag.create_tag(post_state)
-            # If incoming state is application/json and if a state already existed with the same agent, stateId, actId, and/or registration
-            else:
-                orig_state = json.loads(s.json_state)
-                post_state = json.loads(post_state)
-                if not isinstance(post_state, dict):
-                    raise ParamError("The document was not able to be parsed into a JSON object.")
-                else:
-                    merged = json.dumps(dict(orig_state.items() + post_state.items()))
-                s.json_state = merged
-                s.etag = etag.create_tag(merged)
-    
-                #Set updated
-            if 'updated' in request_dict['headers'] and request_dict['headers']['updated']:
-                s.updated = request_dict['headers']['updated']
-            else:
-                s.updated = datetime.datetime.utcnow().replace(tzinfo=utc)
-            s.save()
-        
-    def put_state(self, request_dict):
-        registration = request_dict['params'].get('registration', None)
-        if registration:
-            s, created = ActivityState.objects.get_or_create(state_id=request_dict['params']['stateId'], agent=self.Agent,
-                activity_id=request_dict['params']['activityId'], registration_id=request_dict['params']['registration'])
-        else:
-            s, created = ActivityState.objects.get_or_create(state_id=request_dict['params']['stateId'], agent=self.Agent,
-                activity_id=request_dict['params']['activityId'])
-        
-        if "application/json" not in request_dict['headers']['CONTENT_TYPE']:
-            try:
-                post_state = ContentFile(request_dict['state'].read())
-            except:
-                try:
-                    post_state = ContentFile(request_dict['state'])
-                except:
-                    post_state = ContentFile(str(request_dict['state']))
-            
-            # If a state already existed with the profileId and activityId
-            if not created:
-                etag.check_preconditions(request_dict, s)
-                if s.state:
-                    try:
-                        s.state.delete()
-                    except OSError:
-                        # probably was json before
-                        s.json_state = {}
-            self.save_non_json_state(s, post_state, request_dict)
-        # State being PUT is json
-        else:
-            if not created:
-                etag.check_preconditions(request_dict, s)
-            the_state = request_dict['state']
-            s.json_state = the_state
-            s.content_type = request_dict['headers']['CONTENT_TYPE']
-            s.etag = etag.create_tag(the_state)
+        self.save_document(self.get_state_key(request_dict), request_dict,
+            "%s_%s" % (self.Agent.id, request_dict['params']['activityId']), merge=True)
 
-            #Set updated
-            if 'updated' in request_dict['headers'] and request_dict['headers']['updated']:
-                s.updated = request_dict['headers']['updated']
-            else:
-                s.updated = datetime.datetime.utcnow().replace(tzinfo=utc)
-            s.save()
+    def put_state(self, request_dict):
+        self.save_document(self.get_state_key(request_dict), request_dict,
+            "%s_%s" % (self.Agent.id, request_dict['params']['activityId']), check=True)
 
-    def get_state(self, activity_id, registration, state_id):
+    def get_state(self, activity_id, registration, state_id, defer=()):
         try:
-            if registration:
-                return self.Agent.activitystate_set.get(state_id=state_id, activity_id=activity_id, registration_id=registration)
-            return self.Agent.activitystate_set.get(state_id=state_id, activity_id=activity_id)
+            return self.Agent.activitystate_set.defer(*defer).get(state_id=state_id, activity_id=activity_id, registration_id=registration or '')
         except ActivityState.DoesNotExist:
             err_msg = 'There is no activity state associated with the id: %s' % state_id
             raise IDNotFoundError(err_msg)
 
+    def get_states(self, activity_id, registration, state_ids):
+        # The given states of one registration, or of no registration, in one query
+        state_set = self.get_state_set(activity_id, registration, None).filter(registration_id=registration or '')
+        return list(filter_in_batches(state_set, 'state_id', state_ids))
+
     def get_state_ids(self, activity_id, registration, since):
-        state_set = self.get_state_set(activity_id, registration, since)
-        # If state_set isn't empty
-        if state_set:
-            return state_set.values_list('state_id', flat=True)
-        return state_set
+        # Only the ids are selected so the listing index answers the query on its own
+        return list(self.get_state_set(activity_id, registration, since).values_list('state_id', flat=True))
 
     def delete_state(self, request_dict):
         state_id = request_dict['params'].get('stateId', None)
         activity_id = request_dict['params']['activityId']
         registration = request_dict['params'].get('registration', None)
-        try:
-            # Bulk delete if stateId is not in params
-            if not state_id:
-                states = self.get_state_set(activity_id, registration, None)
-                for s in states:
-                    s.delete() # bulk delete skips the custom delete function
-            # Single delete
-            else:
-                self.get_state(activity_id, registration, state_id).delete()
-        except ActivityState.DoesNotExist:
-            pass
-        except IDNotFoundError:
-            pass
\ No newline at end of file
+        # Bulk delete if stateId is not in params, otherwise the one state
+        states = self.get_state_set(activity_id, registration, None)
+        if state_id:
+            states = states.filter(state_id=state_id, registration_id=registration or '')
+        files = [name for name in states.values_list('state', flat=True) if name]
+        delete_in_one_query(states)
+        # The rows are gone in one statement, their files are unlinked by a worker after the request
+        if files:
+            delete_document_files.delay('ActivityState', 'state', files)
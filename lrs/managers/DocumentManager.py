@@ -0,0 +1,99 @@
+import datetime
+import json
+import uuid
+
+from django.core.files.base import ContentFile
+from django.db import transaction, IntegrityError
+from django.utils.timezone import utc
+
+from ..exceptions import ParamError, Conflict
+from ..utils import etag, merge_json_document
+
+# Times a write is tried again after losing a race, past that the error goes back to the client
+DOCUMENT_WRITE_RETRIES = 3
+
+def read_document(document):
+    try:
+        return document.read()
+    except:
+        return str(document)
+
+class DocumentManager():
+    # Shared write path for states and profiles. Subclasses set the model, its file and JSON fields and the
+    # request_dict key holding the document
+    model = None
+    file_field = None
+    json_field = None
+    document_key = None
+
+    def get_current(self, key):
+        # Only the metadata is read, never the stored document
+        try:
+            return self.model.objects.defer(self.json_field).get(**key)
+        except self.model.DoesNotExist:
+            return None
+
+    def write(self, key, values, request_dict=None, required=False, merge=False):
+        # A new document is one INSERT guarded by the unique constraint on its natural key, an existing one is one
+        # UPDATE conditional on the version that was read. A writer that loses a race reads the document again
+        # and checks the etag preconditions against what is there now. Returns the replaced row, if any
+        for attempt in range(DOCUMENT_WRITE_RETRIES + 1):
+            current = self.get_current(key)
+            if current is None:
+                doc = self.model(**dict(key, **values))
+                sid = transaction.savepoint()
+                try:
+                    doc.save(force_insert=True)
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                    # Not a race with another insert of the key if the row still can't be found after the retries
+                    if attempt == DOCUMENT_WRITE_RETRIES:
+                        raise
+                    continue
+                transaction.savepoint_commit(sid)
+                return None
+            if merge:
+                incoming = json.loads(values[self.json_field])
+                if not isinstance(incoming, dict):
+                    raise ParamError("The document was not able to be parsed into a JSON object.")
+                merge_json_document(current, self.json_field, incoming, values['updated'])
+                return None
+            if request_dict is not None:
+                etag.check_preconditions(request_dict, current, required=required)
+            if self.model.objects.filter(pk=current.pk, version=current.version).update(version=current.version + 1, **values):
+                return current
+        raise Conflict("The document kept changing while it was being written, try again")
+
+    def save_document(self, key, request_dict, filename, check=False, required=False, merge=False):
+        # Non JSON documents are written to a new file first, which is removed again if the row could not be
+        # written. The replaced document's file goes once the row points elsewhere
+        headers = request_dict['headers']
+        document = request_dict[self.document_key]
+        values = {'content_type': headers['CONTENT_TYPE'],
+                  'updated': headers.get('updated', None) or datetime.datetime.utcnow().replace(tzinfo=utc)}
+        field = self.model._meta.get_field(self.file_field)
+        new_file = None
+        if "application/json" not in headers['CONTENT_TYPE']:
+            content = read_document(document)
+            values['etag'] = etag.create_tag(content)
+            values[self.json_field] = ''
+            fn = "%s_%s" % (filename, request_dict.get('filename', uuid.uuid4().hex))
+            new_file = field.storage.save(field.generate_filename(None, fn), ContentFile(content))
+            values[self.file_field] = new_file
+            # Only JSON documents are merged, validation refuses anything else posted onto an existing document
+            merge = False
+        else:
+            values['etag'] = etag.create_tag(document)
+            values[self.json_field] = document
+            values[self.file_field] = ''
+        try:
+            replaced = self.write(key, values, request_dict if check else None, required, merge)
+        except:
+            if new_file:
+                field.storage.delete(new_file)
+            raise
+        if replaced and getattr(replaced, self.file_field):
+            try:
+                getattr(replaced, self.file_field).delete(save=False)
+            except OSError:
+                pass
@@ -1,85 +1,147 @@
-from django.core.files.base import ContentFile
-from django.core.cache import get_cache
+import copy
 
-from .ActivityManager import ActivityManager
-from ..models import Verb, Statement, StatementAttachment, SubStatement, Agent 
+from django.db import transaction, IntegrityError
+from django.db.models import Q
 
-att_cache = get_cache('attachment_cache')
+from .ActivityManager import set_activity_definition, merge_activity_definition, can_define_activity
+from ..models import Verb, Statement, StatementAttachment, AttachmentBlob, StatementRole, SubStatement, Agent, Activity
+from ..utils import chunks, bulk_batch_size, bulk_create_in_batches, filter_in_batches, model_cache
+
+agent_ifps_can_only_be_one = ['mbox', 'mbox_sha1sum', 'account', 'openid']
+context_activity_fields = {'parent': 'context_ca_parent', 'grouping': 'context_ca_grouping',
+                           'category': 'context_ca_category', 'other': 'context_ca_other'}
+# Role name and the statement/substatement field holding the agent in that role
+agent_role_fields = [('actor', 'actor'), ('object', 'object_agent'), ('instructor', 'context_instructor'),
+                     ('team', 'context_team')]
+
+def get_agent_ifp_key(agent_data):
+    # Hashable version of the agent's IFP - anonymous groups don't have one
+    for ifp in agent_ifps_can_only_be_one:
+        if agent_data.get(ifp, None) != None:
+            if ifp == 'account':
+                return (ifp, agent_data['account']['homePage'], agent_data['account']['name'])
+            return (ifp, agent_data[ifp])
+    return None
+
+def get_agent_ifp_keys(agent):
+    keys = [(ifp, getattr(agent, ifp)) for ifp in ['mbox', 'mbox_sha1sum', 'openid'] if getattr(agent, ifp)]
+    if agent.account_name:
+        keys.append(('account', agent.account_homePage, agent.account_name))
+    return keys
+
+def get_role_rows(stmt_pk, agent_roles, activity_roles):
+    # Roles are (role, pk) pairs - empty fields and repeats are dropped
+    rows = []
+    seen = set()
+    for field, roles in [('agent_id', agent_roles), ('activity_id', activity_roles)]:
+        for role, pk in roles:
+            if pk and (field, role, pk) not in seen:
+                seen.add((field, role, pk))
+                rows.append(StatementRole(**{'statement_id': stmt_pk, 'role': role, field: pk}))
+    return rows
+
+def insert_rows(model, objs):
+    # Another request could have inserted some of the same verbs/agents/activities since they were
+    # looked up, if so fall back to inserting them one at a time and skip the ones that already exist
+    sid = transaction.savepoint()
+    try:
+        bulk_create_in_batches(model, objs)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        for obj in objs:
+            sid = transaction.savepoint()
+            try:
+                obj.save()
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+    else:
+        transaction.savepoint_commit(sid)
+
+def set_primary_keys(model, objs, field):
+    # bulk_create does not hand back primary keys so look them up by the unique field
+    by_value = dict((getattr(o, field), o) for o in objs)
+    for value, pk in filter_in_batches(model.objects.values_list(field, 'pk'), field, by_value.keys()):
+        by_value[value].pk = pk
+
+def update_definition(obj, merges):
+    # Merges language maps into a verb or activity and only writes the row when one of them changed. The
+    # write is conditional on the version the copy was read at, if another request got there first the
+    # maps are reloaded and merged again
+    model = type(obj)
+    current_row = model.objects.filter(pk=obj.pk, version=obj.version)
+    while True:
+        values = dict((field, dict((getattr(obj, field) or {}).items() + lang_map.items()))
+                      for field, lang_map in merges.items())
+        if all(value == getattr(obj, field) for field, value in values.items()):
+            # The copy can come from the definition cache, nothing changed only if the row is still at its version
+            if current_row.exists():
+                return
+        else:
+            values['version'] = obj.version + 1
+            if current_row.update(**values):
+                for field, value in values.items():
+                    setattr(obj, field, value)
+                return
+        current = model.objects.get(pk=obj.pk)
+        for field in merges.keys() + ['version']:
+            setattr(obj, field, getattr(current, field))
+        current_row = model.objects.filter(pk=obj.pk, version=obj.version)
 
 class StatementManager():
-    def __init__(self, stmt_data, auth_info, payload_sha2s):
+    def __init__(self, stmts_data, auth_info, payloads):
         # auth_info contains define, endpoint, user, and request authority
-        if self.__class__.__name__ == 'StatementManager':
-            # Full statement is for a statement only, same with authority
-            self.set_authority(auth_info, stmt_data)
-        self.populate(auth_info, stmt_data, payload_sha2s)
+        self.auth_info = auth_info
+        # Spooled multipart parts keyed by their sha2
+        self.payloads = payloads
+        # Statements and substatements in the order they were sent, each with its context activities
+        # and attachments (substatements come before the statement that holds them)
+        self.parts = []
+        # Verbs, agents and activities are gathered for the whole batch and resolved with bulk queries
+        self.verb_refs = []
+        self.agent_refs = []
+        self.activity_refs = []
+        self.authority_dicts = {}
+        self.populate(stmts_data)
 
-    def set_authority(self, auth_info, stmt_data):
+    def set_authority(self, stmt_data):
         # Could still have no authority in stmt if HTTP_AUTH and OAUTH are disabled
         # Have to set auth in kwarg dict for Agent auth object to be saved in statement
         # Also have to save auth in full_statement kwargs for when returning exact statements
         # Set object auth as well for when creating other objects in a substatement
-        if auth_info['agent']:
-            stmt_data['authority'] = auth_info['agent']
-            stmt_data['full_statement']['authority'] = auth_info['agent'].to_dict()
+        if self.auth_info['agent']:
+            stmt_data['authority'] = self.auth_info['agent']
+            stmt_data['full_statement']['authority'] = self.get_authority_dict(self.auth_info['agent'])
         # If no auth in request, look in statement
         else:
             # If authority is given in statement
             if 'authority' in stmt_data:
-                auth_info['agent'] = stmt_data['authority'] = Agent.objects.retrieve_or_create(**stmt_data['full_statement']['authority'])[0]
+                self.auth_info['agent'] = stmt_data['authority'] = Agent.objects.retrieve_or_create(**stmt_data['full_statement']['authority'])[0]
             # Empty auth in request or statement
             else:
-                auth_info['agent'] = None
+                self.auth_info['agent'] = None
+
+    def get_authority_dict(self, agent):
+        # Every statement in the batch shares the same authority, only serialize it once
+        if agent.pk not in self.authority_dicts:
+            self.authority_dicts[agent.pk] = agent.to_dict()
+        return copy.deepcopy(self.authority_dicts[agent.pk])
 
-    def build_context_activities(self, stmt, auth_info, con_act_data):
+    def add_activity_ref(self, act_data):
+        ref = {'data': act_data, 'auth': self.auth_info['agent'], 'activity': None}
+        self.activity_refs.append(ref)
+        return ref
+
+    def parse_context_activities(self, part, con_act_data):
         for con_act_group in con_act_data.items():
-            # Incoming contextActivities can either be a list or dict    
+            field = context_activity_fields.get(con_act_group[0], 'context_ca_other')
+            # Incoming contextActivities can either be a list or dict
             if isinstance(con_act_group[1], list):
                 for con_act in con_act_group[1]:
-                    act = ActivityManager(con_act, auth=auth_info['agent'], define=auth_info['define']).Activity
-                    if con_act_group[0] == 'parent':
-                        stmt.context_ca_parent.add(act)
-                    elif con_act_group[0] == 'grouping':
-                        stmt.context_ca_grouping.add(act)
-                    elif con_act_group[0] == 'category':
-                        stmt.context_ca_category.add(act)
-                    else:
-                        stmt.context_ca_other.add(act)
-            else:        
-                act = ActivityManager(con_act_group[1], auth=auth_info['agent'], define=auth_info['define']).Activity
-                if con_act_group[0] == 'parent':
-                    stmt.context_ca_parent.add(act)
-                elif con_act_group[0] == 'grouping':
-                    stmt.context_ca_grouping.add(act)
-                elif con_act_group[0] == 'category':
-                    stmt.context_ca_category.add(act)
-                else:
-                    stmt.context_ca_other.add(act)
-        stmt.save()
-
-    def build_substatement(self, auth_info, stmt_data):
-        # Pop off any context activities
-        con_act_data = stmt_data.pop('context_contextActivities',{})
-        # Delete objectType since it is not a field in the model
-        del stmt_data['objectType']
-        sub = SubStatement.objects.create(**stmt_data)        
-        if con_act_data:
-            self.build_context_activities(sub, auth_info, con_act_data)
-        return sub
-
-    def build_statement(self, auth_info, stmt_data):
-        # Pop off any context activities
-        con_act_data = stmt_data.pop('context_contextActivities',{})
-        stmt_data['user'] = auth_info['user']
-        # Name of id field in models is statement_id
-        if 'id' in stmt_data:
-            stmt_data['statement_id'] = stmt_data['id']
-            del stmt_data['id']
-        # Try to create statement
-        stmt = Statement.objects.create(**stmt_data)
-        if con_act_data:
-            self.build_context_activities(stmt, auth_info, con_act_data)
-        return stmt
+                    part['con_acts'].append((field, self.add_activity_ref(con_act)))
+            else:
+                part['con_acts'].append((field, self.add_activity_ref(con_act_group[1])))
 
     def build_result(self, stmt_data):
         if 'result' in stmt_data:
@@ -93,90 +155,289 @@ class StatementManager():
                 del stmt_data['result_score']
             del stmt_data['result']
 
-    def build_attachments(self, user_info, attachment_data, payload_sha2s):
-        # Iterate through each attachment
-        for attach in attachment_data:
-            sha2 = attach.pop('sha2', None)
-            fileUrl = attach.pop('fileUrl', None)
-            attachment = StatementAttachment.objects.create(**attach)
-            if sha2:
-                attachment.sha2 = sha2
-                if payload_sha2s and sha2 in payload_sha2s:
-                    raw_payload = att_cache.get(sha2)
-                    try:
-                        payload = ContentFile(raw_payload)
-                    except Exception, e:
-                        raise e
-                    attachment.payload.save(sha2, payload)
-            if fileUrl:
-                attachment.fileUrl = fileUrl
-            attachment.statement = self.model_object
-            attachment.save()
-
     def build_context(self, stmt_data):
         if 'context' in stmt_data:
             context = stmt_data['context']
             for k,v in context.iteritems():
                 stmt_data['context_' + k] = v
             if 'context_instructor' in stmt_data:
-                stmt_data['context_instructor'] = Agent.objects.retrieve_or_create(**stmt_data['context_instructor'])[0]
+                self.agent_refs.append((stmt_data, 'context_instructor'))
             if 'context_team' in stmt_data:
-                stmt_data['context_team'] = Agent.objects.retrieve_or_create(**stmt_data['context_team'])[0]
+                self.agent_refs.append((stmt_data, 'context_team'))
             if 'context_statement' in stmt_data:
                 stmt_data['context_statement'] = stmt_data['context_statement']['id']
             del stmt_data['context']
-    
-    def build_verb(self, stmt_data):
-        incoming_verb = stmt_data['verb']
-        verb_id = incoming_verb['id']
-        # Get or create the verb
-        verb_object, created = Verb.objects.get_or_create(verb_id=verb_id)
-        # If existing, get existing keys
-        existing_lang_maps = {}
-        if not created and verb_object.display:
-            existing_lang_maps = verb_object.display    
-
-        # Save verb displays
-        if 'display' in incoming_verb:
-            verb_object.display = dict(existing_lang_maps.items() + incoming_verb['display'].items())
-            verb_object.save()
-        stmt_data['verb'] = verb_object
-
-    def build_statement_object(self, auth_info, stmt_data):
+
+    def build_statement_object(self, stmt_data):
         statement_object_data = stmt_data['object']
-        valid_agent_objects = ['Agent', 'Group']        
+        valid_agent_objects = ['Agent', 'Group']
         # If not specified, the object is assumed to be an activity
         if not 'objectType' in statement_object_data or statement_object_data['objectType'] == 'Activity':
             statement_object_data['objectType'] = 'Activity'
-            stmt_data['object_activity'] = ActivityManager(statement_object_data, auth=auth_info['agent'],
-                define=auth_info['define']).Activity
+            stmt_data['object_activity'] = self.add_activity_ref(statement_object_data)
         elif statement_object_data['objectType'] in valid_agent_objects:
-            stmt_data['object_agent'] = Agent.objects.retrieve_or_create(**statement_object_data)[0]
+            stmt_data['object_agent'] = statement_object_data
+            self.agent_refs.append((stmt_data, 'object_agent'))
         elif statement_object_data['objectType'] == 'SubStatement':
-            stmt_data['object_substatement'] = SubStatementManager(statement_object_data, auth_info).model_object
+            stmt_data['object_substatement'] = self.parse_statement(statement_object_data, substatement=True)
         elif statement_object_data['objectType'] == 'StatementRef':
             stmt_data['object_statementref'] = statement_object_data['id']
         del stmt_data['object']
 
-    def populate(self, auth_info, stmt_data, payload_sha2s):
-        if self.__class__.__name__ == 'StatementManager':
-            stmt_data['voided'] = False
-        
-        self.build_verb(stmt_data)
-        self.build_statement_object(auth_info, stmt_data)
-        stmt_data['actor'] = Agent.objects.retrieve_or_create(**stmt_data['actor'])[0]
+    def parse_statement(self, stmt_data, substatement=False):
+        # Walks the statement in the same order it used to be saved in so verb displays, new agents and
+        # activity definitions are merged the same way
+        part = {'data': stmt_data, 'substatement': substatement, 'con_acts': [], 'model': None}
+        self.verb_refs.append(stmt_data)
+        self.build_statement_object(stmt_data)
+        part['sub_part'] = stmt_data.get('object_substatement', None)
+        self.agent_refs.append((stmt_data, 'actor'))
         self.build_context(stmt_data)
         self.build_result(stmt_data)
-        attachment_data = stmt_data.pop('attachments', None)
-        
-        if self.__class__.__name__ == 'StatementManager':
-            #Save statement/substatement
-            self.model_object = self.build_statement(auth_info, stmt_data)
-        else:
-            self.model_object = self.build_substatement(auth_info, stmt_data)
-        if attachment_data:
-            self.build_attachments(auth_info, attachment_data, payload_sha2s)
+        part['attachments'] = stmt_data.pop('attachments', None)
+        self.parse_context_activities(part, stmt_data.pop('context_contextActivities', {}))
+        if substatement:
+            # Delete objectType since it is not a field in the model
+            del stmt_data['objectType']
+        self.parts.append(part)
+        return part
+
+    def build_verbs(self):
+        verb_ids = set(stmt_data['verb']['id'] for stmt_data in self.verb_refs)
+        verbs = model_cache.get_definitions('verb', verb_ids)
+        missing_ids = verb_ids - set(verbs)
+        if missing_ids:
+            verbs.update((v.verb_id, v) for v in filter_in_batches(Verb.objects.all(), 'verb_id', missing_ids))
+        new_verbs = []
+        displays = {}
+        for stmt_data in self.verb_refs:
+            incoming_verb = stmt_data['verb']
+            verb_id = incoming_verb['id']
+            if verb_id not in verbs:
+                verbs[verb_id] = Verb(verb_id=verb_id, display={})
+                new_verbs.append(verbs[verb_id])
+            # Displays sent for the same verb are merged in the order they came in
+            if 'display' in incoming_verb:
+                displays[verb_id] = dict(displays.get(verb_id, {}).items() + incoming_verb['display'].items())
+            stmt_data['verb'] = verbs[verb_id]
+
+        for verb in new_verbs:
+            verb.display = displays.get(verb.verb_id, {})
+        insert_rows(Verb, new_verbs)
+        set_primary_keys(Verb, new_verbs, 'verb_id')
+        new_ids = set(v.verb_id for v in new_verbs)
+        for verb_id, display in displays.items():
+            if verb_id not in new_ids:
+                update_definition(verbs[verb_id], {'display': display})
+        model_cache.add_definitions('verb', verbs)
+
+    def fetch_agents(self, ifp_keys):
+        agents = {}
+        # Each key is at most two parameters
+        for batch in chunks(ifp_keys, (bulk_batch_size(2) or len(ifp_keys))):
+            agentQ = Q()
+            for ifp in ['mbox', 'mbox_sha1sum', 'openid']:
+                values = [k[1] for k in batch if k[0] == ifp]
+                if values:
+                    agentQ = agentQ | Q(**{'%s__in' % ifp: values})
+            for k in batch:
+                if k[0] == 'account':
+                    agentQ = agentQ | Q(account_homePage=k[1], account_name=k[2])
+            for agent in Agent.objects.filter(agentQ):
+                for key in get_agent_ifp_keys(agent):
+                    agents[key] = agent
+        return agents
+
+    def build_agents(self):
+        ifp_refs = []
+        group_refs = []
+        for container, key in self.agent_refs:
+            ifp_key = get_agent_ifp_key(container[key])
+            # Groups keep going through the manager since their members have to be created with them
+            if container[key].get('objectType', None) == 'Group' or not ifp_key:
+                group_refs.append((container, key))
+            else:
+                ifp_refs.append((container, key, ifp_key))
+
+        ifp_keys = set(r[2] for r in ifp_refs)
+        agents = self.fetch_agents(ifp_keys) if ifp_keys else {}
+        new_agents = []
+        new_keys = set()
+        for container, key, ifp_key in ifp_refs:
+            if ifp_key not in agents and ifp_key not in new_keys:
+                # Kwargs for the new agent have the account split out into its model fields
+                kwargs = dict(container[key])
+                if 'account' in kwargs:
+                    kwargs['account_homePage'] = kwargs['account']['homePage']
+                    kwargs['account_name'] = kwargs['account']['name']
+                    del kwargs['account']
+                new_agents.append(Agent(**kwargs))
+                new_keys.add(ifp_key)
+        if new_agents:
+            insert_rows(Agent, new_agents)
+            agents.update(self.fetch_agents(new_keys))
+
+        for container, key, ifp_key in ifp_refs:
+            container[key] = agents[ifp_key]
+        for container, key in group_refs:
+            container[key] = Agent.objects.retrieve_or_create(**container[key])[0]
+
+    def build_activities(self):
+        define = self.auth_info['define']
+        activity_ids = set(ref['data']['id'] for ref in self.activity_refs)
+        activities = model_cache.get_definitions('activity', activity_ids)
+        missing_ids = activity_ids - set(activities)
+        if missing_ids:
+            activities.update((a.activity_id, a) for a in filter_in_batches(Activity.objects.select_related('authority'),
+                'activity_id', missing_ids))
+        new_activities = []
+        # Language maps to merge into activities that were already stored
+        merges = {}
+        for ref in self.activity_refs:
+            activity_id = ref['data']['id']
+            act = activities.get(activity_id, None)
+            act_created = act is None
+            # If activity DNE and can define - create activity with auth, else create it without auth
+            if act_created:
+                act = activities[activity_id] = Activity(activity_id=activity_id, authority=ref['auth'] if define else None)
+                new_activities.append(act)
+                can_define = define
+            # If activity already exists it can only be defined by its authority
+            else:
+                can_define = define and can_define_activity(act, ref['auth'])
+
+            activity_definition = ref['data'].get('definition', None)
+            if activity_definition and can_define:
+                if act_created:
+                    set_activity_definition(act, activity_definition)
+                # Created earlier in this batch so it is not stored yet
+                elif not act.pk:
+                    merge_activity_definition(act, activity_definition)
+                else:
+                    merge = merges.setdefault(activity_id, {})
+                    for field, key in [('activity_definition_name', 'name'), ('activity_definition_description', 'description')]:
+                        if key in activity_definition:
+                            merge[field] = dict(merge.get(field, {}).items() + activity_definition[key].items())
+            ref['activity'] = act
+
+        insert_rows(Activity, new_activities)
+        set_primary_keys(Activity, new_activities, 'activity_id')
+        for activity_id, merge in merges.items():
+            update_definition(activities[activity_id], merge)
+        model_cache.add_definitions('activity', activities)
+
+    def finish_part(self, part):
+        # Swap the placeholders left while parsing for the model objects they resolved to
+        stmt_data = part['data']
+        if 'object_activity' in stmt_data:
+            stmt_data['object_activity'] = stmt_data['object_activity']['activity']
+        if 'object_substatement' in stmt_data:
+            stmt_data['object_substatement'] = stmt_data['object_substatement']['model']
+        return stmt_data
+
+    def build_substatements(self):
+        # Substatements have no natural key to find them again after a bulk insert so they are saved
+        # one by one - they still get their context activities in bulk
+        for part in self.parts:
+            if part['substatement']:
+                part['model'] = SubStatement.objects.create(**self.finish_part(part))
+
+    def build_statements(self):
+        stmt_parts = [p for p in self.parts if not p['substatement']]
+        for part in stmt_parts:
+            stmt_data = self.finish_part(part)
+            stmt_data['user'] = self.auth_info['user']
+            # Name of id field in models is statement_id
+            if 'id' in stmt_data:
+                stmt_data['statement_id'] = stmt_data['id']
+                del stmt_data['id']
+            part['model'] = Statement(**stmt_data)
+        self.model_objects = [p['model'] for p in stmt_parts]
+        bulk_create_in_batches(Statement, self.model_objects)
+        set_primary_keys(Statement, self.model_objects, 'statement_id')
+
+    def build_attachments(self):
+        attachments = []
+        payload_names = {}
+        for part in self.parts:
+            if not part['attachments']:
+                continue
+            # Iterate through each attachment
+            for attach in part['attachments']:
+                sha2 = attach.pop('sha2', None)
+                fileUrl = attach.pop('fileUrl', None)
+                attachment = StatementAttachment(**attach)
+                if sha2:
+                    attachment.sha2 = sha2
+                    if self.payloads and sha2 in self.payloads:
+                        # Statements in the batch can share the same payload, only write it once
+                        if sha2 in payload_names:
+                            attachment.payload = payload_names[sha2]
+                        else:
+                            attachment.payload.save(sha2, self.payloads[sha2].as_file(), save=False)
+                            payload_names[sha2] = attachment.payload.name
+                if fileUrl:
+                    attachment.fileUrl = fileUrl
+                attachment.statement = part['model']
+                attachments.append(attachment)
+        bulk_create_in_batches(StatementAttachment, attachments)
+        # bulk_create skips signals so the payload references are counted here
+        ref_counts = {}
+        for attachment in attachments:
+            if attachment.payload:
+                ref_counts[attachment.sha2] = ref_counts.get(attachment.sha2, 0) + 1
+        if ref_counts:
+            AttachmentBlob.objects.add_refs(ref_counts)
+
+    def build_context_activities(self):
+        rows = []
+        seen = set()
+        for part in self.parts:
+            model = part['model']
+            owner_field = '%s_id' % model._meta.object_name.lower()
+            for field, ref in part['con_acts']:
+                through = getattr(model.__class__, field).through
+                # Adding the same activity twice to a relation is a no-op
+                row_key = (through, model.pk, ref['activity'].pk)
+                if row_key not in seen:
+                    seen.add(row_key)
+                    rows.append(through(**{owner_field: model.pk, 'activity_id': ref['activity'].pk}))
+
+        for through in set(r.__class__ for r in rows):
+            bulk_create_in_batches(through, [r for r in rows if r.__class__ == through])
+
+    def get_part_roles(self, part, prefix=''):
+        model = part['model']
+        agent_roles = [(prefix + role, getattr(model, field + '_id')) for role, field in agent_role_fields]
+        activity_roles = [(prefix + 'object', model.object_activity_id)]
+        activity_roles.extend([(prefix + field[len('context_ca_'):], ref['activity'].pk) for field, ref in part['con_acts']])
+        return agent_roles, activity_roles
+
+    def build_roles(self):
+        rows = []
+        for part in self.parts:
+            if part['substatement']:
+                continue
+            agent_roles, activity_roles = self.get_part_roles(part)
+            agent_roles.append(('authority', part['model'].authority_id))
+            if part['sub_part']:
+                sub_agent_roles, sub_activity_roles = self.get_part_roles(part['sub_part'], 'sub_')
+                agent_roles.extend(sub_agent_roles)
+                activity_roles.extend(sub_activity_roles)
+            rows.extend(get_role_rows(part['model'].pk, agent_roles, activity_roles))
+        bulk_create_in_batches(StatementRole, rows)
+
+    def populate(self, stmts_data):
+        for stmt_data in stmts_data:
+            self.set_authority(stmt_data)
+            stmt_data['voided'] = False
+            self.parse_statement(stmt_data)
 
-class SubStatementManager(StatementManager):
-    def __init__(self, substmt_data, auth_info):        
-        StatementManager.__init__(self, substmt_data, auth_info, None)
\ No newline at end of file
+        self.build_verbs()
+        self.build_agents()
+        self.build_activities()
+        self.build_substatements()
+        self.build_statements()
+        self.build_attachments()
+        self.build_context_activities()
+        self.build_roles()
@@ -1,17 +1,23 @@
+import hashlib
 import json
+import os
 from collections import OrderedDict
 from datetime import datetime
 from jsonfield import JSONField
 
 from django_extensions.db.fields import UUIDField
-from django.db import models, IntegrityError
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.contrib.auth.models import User
 from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
 from django.utils.timezone import utc
 
 from oauth_provider.consts import MAX_URL_LENGTH
+from oauth_provider.models import Token
+from oauth2_provider.provider.oauth2.models import AccessToken
 
-from .utils import get_lang
+from .utils import get_lang, get_agent_ifp, filter_in_batches, model_cache
 
 AGENT_PROFILE_UPLOAD_TO = "agent_profile"
 ACTIVITY_STATE_UPLOAD_TO = "activity_state"
@@ -21,6 +27,8 @@ STATEMENT_ATTACHMENT_UPLOAD_TO = "attachment_payloads"
 class Verb(models.Model):
     verb_id = models.CharField(max_length=MAX_URL_LENGTH, db_index=True, unique=True)
     display = JSONField(default={}, blank=True)
+    # Bumped on every definition update so writes from a stale copy can be detected
+    version = models.PositiveIntegerField(default=0)
 
     def to_dict(self, lang=None):
         ret = OrderedDict()
@@ -63,14 +71,20 @@ class AgentManager(models.Manager):
                 # Set ifp_dict and kwargs
                 ifp_dict['account_homePage'] = kwargs['account']['homePage']
                 ifp_dict['account_name'] = kwargs['account']['name']
+            return self.retrieve_by_ifp(ifp_dict)
+        else:
+            return None
+
+    def retrieve_by_ifp(self, ifp_dict):
+        # Agents read inside a request are cached by IFP once the request commits
+        agent = model_cache.get_agent(ifp_dict)
+        if agent is None:
             try:
-                # Try getting agent by IFP in ifp_dict
                 agent = Agent.objects.filter(**ifp_dict)[0]
-                return agent
             except IndexError:
                 return None
-        else:
-            return None
+            model_cache.add_agent(ifp_dict, agent)
+        return agent
 
     def retrieve_or_create(self, **kwargs):
         agent_ifps_can_only_be_one = ['mbox', 'mbox_sha1sum', 'account', 'openid']
@@ -98,11 +112,10 @@ class AgentManager(models.Manager):
                 ifp_dict['account_name'] = kwargs['account']['name']
                 kwargs['account_name'] = kwargs['account']['name']
                 del kwargs['account']
-            try:
-                # Try getting agent by IFP in ifp_dict
-                agent = Agent.objects.filter(**ifp_dict)[0]
-                created = False
-            except IndexError:
+            # Try getting agent by IFP in ifp_dict
+            agent = self.retrieve_by_ifp(ifp_dict)
+            created = False
+            if not agent:
                 # If DNE create the agent based off of kwargs (kwargs now includes account_homePage and account_name fields)
                 try:
                     agent = Agent.objects.create(**kwargs)
@@ -118,7 +131,6 @@ class AgentManager(models.Manager):
                 if created:
                     members = [self.retrieve_or_create(**a) for a in member]
                     agent.member.add(*(a for a, c in members))
-                    agent.save()
         # Only way it doesn't have IFP is if anonymous group
         else:
             agent, created = self.retrieve_or_create_anonymous_group(member, kwargs)
@@ -155,18 +167,32 @@ class AgentManager(models.Manager):
                         created = False
             # Non-oauth anonymous group that has 2 members, one having an account
             else:
-                agent = Agent.objects.create(**kwargs)
-                created = True
+                agent, created = self.retrieve_or_create_by_members(member, kwargs)
         # Normal non-oauth anonymous group
         else:
-            agent = Agent.objects.create(**kwargs)
-            created = True
+            agent, created = self.retrieve_or_create_by_members(member, kwargs)
         # If it is a newly created anonymous group, add the members
         if created:
             members = [self.retrieve_or_create(**a) for a in member]
             agent.member.add(*(a for a, c in members))        
         return agent, created
 
+    def retrieve_or_create_by_members(self, member, kwargs):
+        # Anonymous groups have no IFP so they are identified by their name and their members' IFPs
+        member_ifps = sorted(json.dumps(sorted(get_agent_ifp(a).items())) for a in member)
+        member_hash = hashlib.sha1(json.dumps([kwargs.get('name', ''), member_ifps])).hexdigest()
+        try:
+            return Agent.objects.get(member_hash=member_hash), False
+        except Agent.DoesNotExist:
+            sid = transaction.savepoint()
+            try:
+                agent = Agent.objects.create(member_hash=member_hash, **kwargs)
+                transaction.savepoint_commit(sid)
+                return agent, True
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                return Agent.objects.get(member_hash=member_hash), False
+
     def oauth_group(self, **kwargs):
         try:
             g = Agent.objects.get(oauth_identifier=kwargs['oauth_identifier'])
@@ -183,6 +209,8 @@ class Agent(models.Model):
     member = models.ManyToManyField('self', related_name="agents", null=True)
     account_homePage = models.CharField(max_length=MAX_URL_LENGTH, null=True)
     account_name = models.CharField(max_length=50, null=True)
+    # Hash of a non-oauth anonymous group's name and members so the same group is stored once
+    member_hash = models.CharField(max_length=40, null=True, unique=True)
     objects = AgentManager()
 
     class Meta:
@@ -259,6 +287,25 @@ class Agent(models.Model):
     def __unicode__(self):
         return json.dumps(self.to_dict(), sort_keys=False)
 
+def remember_cached_agent_keys(sender, instance, **kwargs):
+    # A save can change the IFP, so the keys the stored row is cached under are read before it is written
+    if instance.pk:
+        stored = Agent.objects.filter(pk=instance.pk).only(*[f for fields in model_cache.AGENT_IFP_FIELDS for f in fields])
+        instance._cached_agent_keys = model_cache.get_agent_keys(stored[0]) if stored else set()
+pre_save.connect(remember_cached_agent_keys, sender=Agent)
+
+def invalidate_cached_agent(sender, instance, created=False, **kwargs):
+    # Cached agents are dropped on any change so renamed agents are never served stale
+    if not created:
+        model_cache.invalidate_agent(instance, getattr(instance, '_cached_agent_keys', ()))
+post_save.connect(invalidate_cached_agent, sender=Agent)
+post_delete.connect(invalidate_cached_agent, sender=Agent)
+
+def invalidate_token_context(sender, instance, **kwargs):
+    model_cache.invalidate_auth_contexts(model_cache.get_token_key(1 if sender is Token else 2, instance.pk))
+post_delete.connect(invalidate_token_context, sender=Token)
+post_delete.connect(invalidate_token_context, sender=AccessToken)
+
 class Activity(models.Model):
     activity_id = models.CharField(max_length=MAX_URL_LENGTH, db_index=True, unique=True)
     objectType = models.CharField(max_length=8,blank=True, default="Activity")
@@ -275,6 +322,8 @@ class Activity(models.Model):
     activity_definition_targets = JSONField(default={}, blank=True)
     activity_definition_steps = JSONField(default={}, blank=True)
     authority = models.ForeignKey(Agent, null=True)
+    # Bumped on every definition update so writes from a stale copy can be detected
+    version = models.PositiveIntegerField(default=0)
 
     def add_interaction_type(self, i_type, ret, lang):
         if i_type == 'scale':
@@ -630,23 +679,72 @@ class Statement(models.Model):
     def __unicode__(self):
         return json.dumps(self.to_dict(), sort_keys=False)
 
+class StatementRole(models.Model):
+    # Denormalized (statement, agent or activity, role) rows written when statements are stored so related_agents
+    # and related_activities can be answered with one indexed lookup instead of joining every FK and M2M table.
+    # Roles of a substatement's agents and activities are recorded against the statement holding it with a sub_ prefix
+    statement = models.ForeignKey(Statement, related_name="roles")
+    agent = models.ForeignKey(Agent, related_name="statement_roles", null=True, db_index=True)
+    activity = models.ForeignKey(Activity, related_name="statement_roles", null=True, db_index=True)
+    role = models.CharField(max_length=20)
+
+    def __unicode__(self):
+        return "%s - %s - %s" % (self.statement_id, self.role, self.agent_id or self.activity_id)
+
+def attachment_payload_path(sha2):
+    # Payloads are stored once per sha2, sharded by its first characters to keep directories small
+    return os.path.join(STATEMENT_ATTACHMENT_UPLOAD_TO, sha2[:2], sha2[2:4], sha2)
+
+def attachment_upload_to(instance, filename):
+    return attachment_payload_path(instance.sha2)
+
 class AttachmentFileSystemStorage(FileSystemStorage):
     def get_available_name(self, name):
         return name
 
     def _save(self, name, content):
         if self.exists(name):
-            # if the file exists, do not call the superclasses _save method
-            return name
+            # Same content is already stored - touch it so garbage collection leaves it alone while the new
+            # reference is committed
+            try:
+                os.utime(self.path(name), None)
+                return name
+            except OSError:
+                pass
         # if the file is new, DO call it
-        return super(AttachmentFileSystemStorage, self)._save(name, content)    
+        return super(AttachmentFileSystemStorage, self)._save(name, content)
+
+class AttachmentBlobManager(models.Manager):
+    def add_refs(self, counts):
+        # counts maps each sha2 to the number of new attachments pointing at it
+        existing = set(filter_in_batches(self.values_list('sha2', flat=True), 'sha2', counts.keys()))
+        for sha2 in set(counts) - existing:
+            sid = transaction.savepoint()
+            try:
+                self.create(sha2=sha2)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+        for sha2, count in counts.items():
+            self.filter(sha2=sha2).update(ref_count=models.F('ref_count') + count)
+
+class AttachmentBlob(models.Model):
+    # One row per stored payload, counting the attachments that use it. Blobs no longer referenced are
+    # removed by the gc_attachment_blobs command
+    sha2 = models.CharField(max_length=128, unique=True)
+    ref_count = models.PositiveIntegerField(default=0)
+    objects = AttachmentBlobManager()
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.sha2, self.ref_count)
+
 class StatementAttachment(models.Model):
     usageType = models.CharField(max_length=MAX_URL_LENGTH)
     contentType = models.CharField(max_length=128)
     length = models.PositiveIntegerField()
     sha2 = models.CharField(max_length=128, blank=True)
     fileUrl = models.CharField(max_length=MAX_URL_LENGTH, blank=True)
-    payload = models.FileField(upload_to=STATEMENT_ATTACHMENT_UPLOAD_TO, storage=AttachmentFileSystemStorage(), null=True)
+    payload = models.FileField(upload_to=attachment_upload_to, storage=AttachmentFileSystemStorage(), null=True)
     display = JSONField(default={}, blank=True)
     description = JSONField(default={}, blank=True)
     statement = models.ForeignKey(Statement, related_name="stmt_attachments", null=True)
@@ -669,9 +767,14 @@ class StatementAttachment(models.Model):
     def __unicode__(self):
         return json.dumps(self.to_dict(), sort_keys=False)
 
+def release_attachment_blob(sender, instance, **kwargs):
+    if instance.payload:
+        AttachmentBlob.objects.filter(sha2=instance.sha2, ref_count__gt=0).update(ref_count=models.F('ref_count') - 1)
+post_delete.connect(release_attachment_blob, sender=StatementAttachment)
+
 class ActivityState(models.Model):
     state_id = models.CharField(max_length=MAX_URL_LENGTH)
-    updated = models.DateTimeField(auto_now_add=True, blank=True, db_index=True)
+    updated = models.DateTimeField(default=timezone.now, blank=True, db_index=True)
     state = models.FileField(upload_to=ACTIVITY_STATE_UPLOAD_TO, null=True)
     json_state = models.TextField(blank=True)
     agent = models.ForeignKey(Agent)
@@ -679,6 +782,7 @@ class ActivityState(models.Model):
     registration_id = models.CharField(max_length=40, db_index=True)
     content_type = models.CharField(max_length=255,blank=True)
     etag = models.CharField(max_length=50,blank=True)
+    version = models.PositiveIntegerField(default=0)
 
     def delete(self, *args, **kwargs):
         if self.state:
@@ -687,12 +791,13 @@ class ActivityState(models.Model):
 
 class ActivityProfile(models.Model):
     profileId = models.CharField(max_length=MAX_URL_LENGTH, db_index=True)
-    updated = models.DateTimeField(auto_now_add=True, blank=True, db_index=True)
+    updated = models.DateTimeField(default=timezone.now, blank=True, db_index=True)
     activityId = models.CharField(max_length=MAX_URL_LENGTH, db_index=True)
     profile = models.FileField(upload_to=ACTIVITY_PROFILE_UPLOAD_TO, null=True)
     json_profile = models.TextField(blank=True)
     content_type = models.CharField(max_length=255,blank=True)
     etag = models.CharField(max_length=50,blank=True)
+    version = models.PositiveIntegerField(default=0)
 
     def delete(self, *args, **kwargs):
         if self.profile:
@@ -701,14 +806,28 @@ class ActivityProfile(models.Model):
 
 class AgentProfile(models.Model):
     profileId = models.CharField(max_length=MAX_URL_LENGTH, db_index=True)
-    updated = models.DateTimeField(auto_now_add=True, blank=True, db_index=True)
+    updated = models.DateTimeField(default=timezone.now, blank=True, db_index=True)
     agent = models.ForeignKey(Agent, db_index=True)
     profile = models.FileField(upload_to=AGENT_PROFILE_UPLOAD_TO, null=True)
     json_profile = models.TextField(blank=True)
     content_type = models.CharField(max_length=255,blank=True)
     etag = models.CharField(max_length=50,blank=True)
+    version = models.PositiveIntegerField(default=0)
 
     def delete(self, *args, **kwargs):
         if self.profile:
             self.profile.delete()
         super(AgentProfile, self).delete(*args, **kwargs)
+
+# Natural keys of the documents and the composite indexes behind the document id listings. syncdb never alters
+# an existing table and Django 1.4 has no index_together, so lrs.management creates them after every syncdb.
+# Each listing ends with the listed id column so the listing is answered from the index alone, except on
+# PostgreSQL where IRIs are indexed by their hash and the listing queries match it
+DOCUMENT_INDEXES = [
+    ('lrs_activitystate_key', ActivityState, ['agent', 'activity_id', 'registration_id', 'state_id'], True),
+    ('lrs_activityprofile_key', ActivityProfile, ['activityId', 'profileId'], True),
+    ('lrs_agentprofile_key', AgentProfile, ['agent', 'profileId'], True),
+    ('lrs_activitystate_listing', ActivityState, ['agent', 'activity_id', 'registration_id', 'updated', 'state_id'], False),
+    ('lrs_activityprofile_listing', ActivityProfile, ['activityId', 'updated', 'profileId'], False),
+    ('lrs_agentprofile_listing', AgentProfile, ['agent', 'updated', 'profileId'], False),
+]
@@ -6,13 +6,14 @@ import hmac
 import requests
 
 from celery import shared_task
-from celery.exceptions import SoftTimeLimitExceeded
+from celery.exceptions import SoftTimeLimitExceeded, MaxRetriesExceededError
 from celery.utils.log import get_task_logger
 
 from django.conf import settings
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, get_model
 
+from .utils import filter_in_batches
 from .utils.StatementValidator import StatementValidator
 
 celery_logger = get_task_logger('celery-task')
@@ -32,6 +33,24 @@ def void_statements(stmts):
     except Exception, e:
         celery_logger.exception("Voiding Statement Error: " + e.message)
 
+@shared_task(bind=True, max_retries=5, default_retry_delay=60)
+def delete_document_files(self, model_name, field_name, names):
+    model = get_model('lrs', model_name)
+    storage = model._meta.get_field(field_name).storage
+    # A file that is still referenced belongs to a delete that has not committed yet or was rolled back
+    referenced = set(filter_in_batches(model.objects.values_list(field_name, flat=True), field_name, names))
+    for name in names:
+        if name not in referenced:
+            try:
+                storage.delete(name)
+            except OSError, e:
+                celery_logger.exception("Could not delete document file %s: %s" % (name, e))
+    if referenced:
+        try:
+            raise self.retry(args=(model_name, field_name, list(referenced)))
+        except MaxRetriesExceededError:
+            pass
+
 @shared_task
 def check_statement_hooks(stmt_ids):
     try:
@@ -132,44 +151,18 @@ def parse_related_filter(related, or_operand):
         return objectQ & innerQ
 
 def set_object_activity_query(q, act_list, or_operand):
+    from .models import StatementRole
+    roleQ = Q(id__in=StatementRole.objects.filter(activity__activity_id__in=act_list).values('statement'))
     if or_operand:
-        return q | (Q(object_activity__activity_id__in=act_list) \
-            | Q(context_ca_parent__activity_id__in=act_list) \
-            | Q(context_ca_grouping__activity_id__in=act_list) \
-            | Q(context_ca_category__activity_id__in=act_list) \
-            | Q(context_ca_other__activity_id__in=act_list) \
-            | Q(object_substatement__object_activity__activity_id__in=act_list) \
-            | Q(object_substatement__context_ca_parent__activity_id__in=act_list) \
-            | Q(object_substatement__context_ca_grouping__activity_id__in=act_list) \
-            | Q(object_substatement__context_ca_category__activity_id__in=act_list) \
-            | Q(object_substatement__context_ca_other__activity_id__in=act_list))
-
-    return q & (Q(object_activity__activity_id__in=act_list) \
-        | Q(context_ca_parent__activity_id__in=act_list) \
-        | Q(context_ca_grouping__activity_id__in=act_list) \
-        | Q(context_ca_category__activity_id__in=act_list) \
-        | Q(context_ca_other__activity_id__in=act_list) \
-        | Q(object_substatement__object_activity__activity_id__in=act_list) \
-        | Q(object_substatement__context_ca_parent__activity_id__in=act_list) \
-        | Q(object_substatement__context_ca_grouping__activity_id__in=act_list) \
-        | Q(object_substatement__context_ca_category__activity_id__in=act_list) \
-        | Q(object_substatement__context_ca_other__activity_id__in=act_list))
+        return q | roleQ
+    return q & roleQ
 
 def set_object_agent_query(q, agent, or_operand):
+    from .models import StatementRole
+    roleQ = Q(id__in=StatementRole.objects.filter(agent=agent).values('statement'))
     if or_operand:
-        return q | (Q(actor=agent) | Q(object_agent=agent) | Q(authority=agent) \
-              | Q(context_instructor=agent) | Q(context_team=agent) \
-              | Q(object_substatement__actor=agent) \
-              | Q(object_substatement__object_agent=agent) \
-              | Q(object_substatement__context_instructor=agent) \
-              | Q(object_substatement__context_team=agent))
-
-    return q & (Q(actor=agent) | Q(object_agent=agent) | Q(authority=agent) \
-          | Q(context_instructor=agent) | Q(context_team=agent) \
-          | Q(object_substatement__actor=agent) \
-          | Q(object_substatement__object_agent=agent) \
-          | Q(object_substatement__context_instructor=agent) \
-          | Q(object_substatement__context_team=agent))
+        return q | roleQ
+    return q & roleQ
 
 # Retrieve JSON data from ID
 def get_activity_metadata(act_id):
@@ -233,4 +226,5 @@ def update_activity_definition(act):
         activity.activity_definition_targets = act['definition'].get('target', {})
         activity.activity_definition_steps = act['definition'].get('steps', {})
         activity.activity_definition_scales = act['definition'].get('scale', {})
+        activity.version += 1
         activity.save()
\ No newline at end of file
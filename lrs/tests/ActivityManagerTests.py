@@ -10,6 +10,7 @@ from django.test.utils import override_settings
 from ..models import Activity, Statement
 from adl_lrs.views import register, home
 from ..views import statements
+from ..utils import model_cache
 
 CURRENT_SITE = settings.SITE_SCHEME + '://' + Site.objects.get_current().domain
 
@@ -19,6 +20,7 @@ class ActivityManagerTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self): 
+        model_cache.clear_local_caches()
         self.username = "tester1"
         self.email = "test1@tester.com"
         self.password = "test"
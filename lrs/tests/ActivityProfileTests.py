@@ -1,13 +1,21 @@
 import ast
+import sys
 import json
 import hashlib
 import urllib
 import base64
+import datetime
+from StringIO import StringIO
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.db import connection, IntegrityError
 from django.conf import settings
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.utils.timezone import utc
 from lrs import models, views
+from lrs.utils import model_cache
+from lrs.management import index_exists, create_document_indexes
 from adl_lrs.views import register
 
 class ActivityProfileTests(TestCase):
@@ -26,6 +34,7 @@ class ActivityProfileTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         self.username = "tester"
         self.email = "test@tester.com"
         self.password = "test"
@@ -490,5 +499,55 @@ class ActivityProfileTests(TestCase):
         self.assertEqual(returned['test']['goal'], sent['test']['goal'])
         self.assertEqual(returned['test']['attempt'], sent['test']['attempt'])
         self.assertEqual(returned['test']['result'], sent['test']['result'])
-        etag = '"%s"' % hashlib.sha1(get.content).hexdigest()
-        self.assertEqual(get.get('etag'), etag)
\ No newline at end of file
+        # A merged document's etag comes from its version instead of a hash of the merged text
+        self.assertNotEqual(get.get('etag'), etag)
+
+        prof = json.dumps({"other": "field"})
+        post = self.client.post(path, prof, content_type="application/json", If_Match=get.get('etag'), Authorization=self.auth,  X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(post.status_code, 204)
+        merged = self.client.get(path, Authorization=self.auth,  X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(json.loads(merged.content), dict(sent.items() + [("other", "field")]))
+        self.assertNotEqual(merged.get('etag'), get.get('etag'))
+        self.assertEqual(models.ActivityProfile.objects.get(profileId="prof:test_json_merge").version, 2)
+
+class DocumentKeyTests(TransactionTestCase):
+    # Index DDL commits on its own, so this runs outside of a test transaction
+    def test_unique_key_after_duplicates(self):
+        cursor = connection.cursor()
+        # A table from before the natural key was unique
+        cursor.execute("DROP INDEX lrs_activityprofile_key")
+        self.assertFalse(index_exists(cursor, 'lrs_activityprofile_key'))
+        models.ActivityProfile.objects.create(activityId="act:dupe", profileId="prof:dupe", json_profile='{"old": 1}',
+            updated=datetime.datetime(2014, 1, 1, tzinfo=utc))
+        newest = models.ActivityProfile.objects.create(activityId="act:dupe", profileId="prof:dupe",
+            json_profile='{"new": 1}', updated=datetime.datetime(2014, 1, 2, tzinfo=utc))
+
+        # syncdb leaves the rows alone and refuses the key
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            create_document_indexes(models, verbosity=0)
+            refusal = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertIn("Not creating index lrs_activityprofile_key", refusal)
+        self.assertIn("activityId=act:dupe, profileId=prof:dupe", refusal)
+        self.assertFalse(index_exists(cursor, 'lrs_activityprofile_key'))
+        self.assertEqual(models.ActivityProfile.objects.filter(activityId="act:dupe").count(), 2)
+
+        out = StringIO()
+        call_command('dedupe_documents', dry_run=True, stdout=out)
+        self.assertIn("Would delete 1 documents", out.getvalue())
+        self.assertEqual(models.ActivityProfile.objects.filter(activityId="act:dupe").count(), 2)
+
+        # The command keeps the most recently updated duplicate and reports the one it deletes
+        out = StringIO()
+        call_command('dedupe_documents', stdout=out)
+        self.assertIn("keeping pk %s" % newest.pk, out.getvalue())
+        self.assertIn("deleting pk", out.getvalue())
+        create_document_indexes(models, verbosity=0)
+        self.assertTrue(index_exists(cursor, 'lrs_activityprofile_key'))
+        self.assertEqual(list(models.ActivityProfile.objects.filter(activityId="act:dupe").values_list('pk', flat=True)),
+            [newest.pk])
+        self.assertRaises(IntegrityError, models.ActivityProfile.objects.create, activityId="act:dupe",
+            profileId="prof:dupe", json_profile='{}')
\ No newline at end of file
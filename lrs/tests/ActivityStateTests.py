@@ -7,11 +7,17 @@ import ast
 import uuid
 
 from django.test import TestCase
+from django.db import connection, IntegrityError
 from django.conf import settings
 from django.core.urlresolvers import reverse
 
 from adl_lrs.views import register
 from ..views import activity_state 
+from ..models import ActivityState
+from ..utils import model_cache, merge_json_document
+from ..managers.ActivityStateManager import ActivityStateManager
+from ..exceptions import PreconditionFail, Conflict
+from ..management import index_exists
 
 class ActivityStateTests(TestCase):
     url = reverse(activity_state)
@@ -31,6 +37,7 @@ class ActivityStateTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         self.username = "test"
         self.email = "test@example.com"        
         self.password = "test"
@@ -689,4 +696,230 @@ class ActivityStateTests(TestCase):
         r = self.client.get(path, Authorization=self.auth, X_Experience_API_Version="1.0.1")
         self.assertEqual(r.status_code, 200)
         self.assertEqual(r['Content-Type'], "text/plain")
-        self.assertEqual(r.content, state)
\ No newline at end of file
+        self.assertEqual(r.content, state)
+
+    def test_nonjson_get_state_offload(self):
+        param = {"stateId": "thisisnotjson", "activityId": "act:test/non.json.accepted", "agent": '{"mbox":"mailto:test@example.com"}'}
+        path = '%s?%s' % (self.url, urllib.urlencode(param))
+        state = "this is not json"
+
+        r = self.client.put(path, state, content_type="text/plain", Authorization=self.auth, X_Experience_API_Version="1.0.1")
+        self.assertEqual(r.status_code, 204)
+
+        r = self.client.get(path, Authorization=self.auth, X_Experience_API_Version="1.0.1")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r['Content-Length'], str(len(state)))
+        self.assertEqual(r['etag'], '"%s"' % hashlib.sha1(state).hexdigest())
+
+        with self.settings(FILE_OFFLOAD='x-sendfile'):
+            r = self.client.get(path, Authorization=self.auth, X_Experience_API_Version="1.0.1")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, '')
+        self.assertEqual(r['Content-Type'], "text/plain")
+        self.assertTrue(r['X-Sendfile'].startswith(os.path.join(settings.MEDIA_ROOT, "activity_state")))
+        with open(r['X-Sendfile']) as f:
+            self.assertEqual(f.read(), state)
+
+        with self.settings(FILE_OFFLOAD='x-accel-redirect', FILE_OFFLOAD_URL='/protected/'):
+            r = self.client.get(path, Authorization=self.auth, X_Experience_API_Version="1.0.1")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, '')
+        self.assertTrue(r['X-Accel-Redirect'].startswith('/protected/activity_state/'))
+
+        self.client.delete(path, Authorization=self.auth, X_Experience_API_Version="1.0.1")
+
+    def test_get_if_none_match(self):
+        r = self.client.get(self.url, self.testparams1, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(r.status_code, 200)
+        tag = r['etag']
+
+        r = self.client.get(self.url, self.testparams1, If_None_Match=tag, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.content, '')
+        self.assertEqual(r['etag'], tag)
+
+        r = self.client.get(self.url, self.testparams2, If_None_Match=tag, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.content), self.teststate2)
+
+        path = '%s?%s' % (self.url, urllib.urlencode(self.testparams1))
+        state = {"test":"changed activity state 1"}
+        r = self.client.put(path, json.dumps(state), content_type=self.content_type, If_Match=tag, Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 204)
+        r = self.client.get(self.url, self.testparams1, If_None_Match=tag, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.content), state)
+
+    def test_get_cached_document(self):
+        model_cache.local_documents.clear()
+        # A document that is not cached yet is read with one query on its table
+        connection.use_debug_cursor = True
+        del connection.queries[:]
+        try:
+            r = self.client.get(self.url, self.testparams1, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+            state_queries = [q for q in connection.queries if 'lrs_activitystate' in q['sql']]
+        finally:
+            connection.use_debug_cursor = None
+        self.assertEqual(len(state_queries), 1)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.content), self.teststate1)
+
+        # A cached document is served without reading its JSON column
+        ActivityState.objects.filter(state_id=self.stateId).update(json_state='{"test":"not read"}')
+        r = self.client.get(self.url, self.testparams1, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(json.loads(r.content), self.teststate1)
+
+        # A changed etag means the cached copy is not used
+        ActivityState.objects.filter(state_id=self.stateId).update(etag='changed')
+        r = self.client.get(self.url, self.testparams1, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(json.loads(r.content), {"test":"not read"})
+
+        with self.settings(DOCUMENT_CACHE_SIZE=0):
+            ActivityState.objects.filter(state_id=self.stateId).update(json_state='{"test":"no cache"}')
+            r = self.client.get(self.url, self.testparams1, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(json.loads(r.content), {"test":"no cache"})
+
+    def test_merge_stale_document(self):
+        stale = ActivityState.objects.get(state_id=self.stateId)
+        current = ActivityState.objects.get(state_id=self.stateId)
+        merge_json_document(current, 'json_state', {"first": 1}, current.updated)
+        # The stale copy's write is refused and the merge runs again on top of the first one
+        merge_json_document(stale, 'json_state', {"second": 2}, stale.updated)
+
+        state = ActivityState.objects.get(state_id=self.stateId)
+        self.assertEqual(json.loads(state.json_state), dict(self.teststate1.items() + [("first", 1), ("second", 2)]))
+        self.assertEqual(state.version, current.version + 1)
+        self.assertNotEqual(state.etag, current.etag)
+
+    def test_write_retries_are_capped(self):
+        state = ActivityState.objects.get(state_id=self.stateId)
+        manager = ActivityStateManager(state.agent)
+        key = {'agent': state.agent, 'activity_id': state.activity_id, 'registration_id': state.registration_id,
+               'state_id': state.state_id}
+        values = {'json_state': '{"capped": 1}', 'content_type': self.content_type, 'etag': 'capped', 'updated': state.updated}
+        real_get_current = manager.get_current
+        try:
+            # An insert failing for any reason other than a racing insert is raised once the retries run out
+            manager.get_current = lambda key: None
+            self.assertRaises(IntegrityError, manager.write, key, values)
+            # So is an update that never finds the version it read
+            def stale_get_current(key):
+                current = real_get_current(key)
+                current.version -= 1
+                return current
+            manager.get_current = stale_get_current
+            self.assertRaises(Conflict, manager.write, key, values)
+        finally:
+            manager.get_current = real_get_current
+        self.assertEqual(ActivityState.objects.get(pk=state.pk).version, state.version)
+
+    def test_put_replaces_in_place(self):
+        param = {"stateId": "replaced", "activityId": self.activityId, "agent": self.testagent}
+        path = '%s?%s' % (self.url, urllib.urlencode(param))
+        r = self.client.put(path, "not json", content_type="text/plain", Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 204)
+        state = ActivityState.objects.get(state_id="replaced")
+        file_path = state.state.path
+        self.assertTrue(os.path.exists(file_path))
+
+        r = self.client.put(path, json.dumps({"now": "json"}), content_type=self.content_type, Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 204)
+        replaced = ActivityState.objects.get(state_id="replaced")
+        self.assertEqual(replaced.pk, state.pk)
+        self.assertEqual(replaced.version, state.version + 1)
+        self.assertFalse(replaced.state)
+        self.assertFalse(os.path.exists(file_path))
+
+        r = self.client.get(path, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(json.loads(r.content), {"now": "json"})
+        self.client.delete(path, Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+
+    def test_put_lost_race_checks_etag_again(self):
+        stale = ActivityState.objects.get(state_id=self.stateId)
+        tag = '"%s"' % stale.etag
+        path = '%s?%s' % (self.url, urllib.urlencode(self.testparams1))
+        r = self.client.put(path, json.dumps({"test": "first writer"}), content_type=self.content_type, If_Match=tag, Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 204)
+
+        # The second writer read the row before the first one wrote it, its update misses the version and the
+        # precondition is checked again against the new etag
+        reads = [stale]
+        manager = ActivityStateManager(stale.agent)
+        get_current = manager.get_current
+        manager.get_current = lambda key: reads.pop() if reads else get_current(key)
+        request_dict = {'params': {'activityId': self.activityId, 'stateId': self.stateId},
+                        'headers': {'CONTENT_TYPE': self.content_type, 'ETAG': {'HTTP_IF_MATCH': tag, 'HTTP_IF_NONE_MATCH': None}},
+                        'state': json.dumps({"test": "second writer"})}
+        self.assertRaises(PreconditionFail, manager.put_state, request_dict)
+        self.assertEqual(json.loads(ActivityState.objects.get(state_id=self.stateId).json_state), {"test": "first writer"})
+
+    def test_get_state_batch(self):
+        param = {"stateId": "notjson", "activityId": self.activityId, "agent": self.testagent}
+        path = '%s?%s' % (self.url, urllib.urlencode(param))
+        r = self.client.put(path, "not json", content_type="text/plain", Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 204)
+
+        params = {"activityId": self.activityId, "agent": self.testagent,
+                  "stateIds": json.dumps([self.stateId, self.stateId2, "notjson", "missing"])}
+        r = self.client.get(self.url, params, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(r.status_code, 200)
+        states = json.loads(r.content)
+        self.assertEqual(set(states.keys()), set([self.stateId, self.stateId2, "notjson"]))
+        self.assertEqual(json.loads(states[self.stateId]['content']), self.teststate1)
+        self.assertEqual(states[self.stateId]['contentType'], self.content_type)
+        single = self.client.get(self.url, self.testparams2, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(states[self.stateId2]['etag'], single['etag'])
+        self.assertEqual(states["notjson"]['encoding'], 'base64')
+        self.assertEqual(base64.b64decode(states["notjson"]['content']), "not json")
+
+        params['stateId'] = self.stateId
+        r = self.client.get(self.url, params, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(r.status_code, 400)
+        del params['stateId']
+        params['stateIds'] = json.dumps({"not": "a list"})
+        r = self.client.get(self.url, params, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(r.status_code, 400)
+        self.client.delete(path, Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+
+    def test_get_ids_listing_index(self):
+        agent = ActivityState.objects.get(state_id=self.stateId).agent
+        manager = ActivityStateManager(agent)
+        self.assertEqual(set(manager.get_state_ids(self.activityId, None, None)), set([self.stateId, self.stateId2]))
+
+        # syncdb created the listing index alongside the table
+        self.assertTrue(index_exists(connection.cursor(), 'lrs_activitystate_listing'))
+
+    def test_bulk_delete_removes_files(self):
+        param = {"activityId": "act:test/bulk.delete", "agent": '{"mbox":"mailto:test@example.com"}'}
+        paths = []
+        for state_id in ["bulk1", "bulk2"]:
+            path = '%s?%s' % (self.url, urllib.urlencode(dict(param, stateId=state_id)))
+            r = self.client.put(path, "not json %s" % state_id, content_type="text/plain", Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(r.status_code, 204)
+            paths.append(ActivityState.objects.get(state_id=state_id).state.path)
+        self.assertTrue(all(os.path.exists(p) for p in paths))
+
+        r = self.client.delete('%s?%s' % (self.url, urllib.urlencode(param)), Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 204)
+        self.assertFalse(ActivityState.objects.filter(activity_id=param['activityId']).exists())
+        # Celery runs eagerly under test so the files are gone already
+        self.assertFalse(any(os.path.exists(p) for p in paths))
+
+    def test_bulk_delete_keeps_other_states(self):
+        param = {"activityId": "act:test/bulk.scope", "agent": '{"mbox":"mailto:test@example.com"}'}
+        others = [dict(param, agent='{"mbox":"mailto:other@example.com"}'), dict(param, activityId="act:test/bulk.other")]
+        for params in [param] + others:
+            for state_id in ["scope1", "scope2"]:
+                path = '%s?%s' % (self.url, urllib.urlencode(dict(params, stateId=state_id)))
+                r = self.client.put(path, '{"state": "%s"}' % state_id, content_type="application/json", Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+                self.assertEqual(r.status_code, 204)
+
+        r = self.client.delete('%s?%s' % (self.url, urllib.urlencode(param)), Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 204)
+        r = self.client.get('%s?%s' % (self.url, urllib.urlencode(param)), Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(json.loads(r.content), [])
+        # The same state ids under another agent or another activity are left alone
+        for params in others:
+            r = self.client.get('%s?%s' % (self.url, urllib.urlencode(params)), Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(sorted(json.loads(r.content)), ["scope1", "scope2"])
+        self.assertEqual(ActivityState.objects.filter(state_id__in=["scope1", "scope2"]).count(), 4)
\ No newline at end of file
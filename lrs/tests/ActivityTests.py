@@ -6,6 +6,7 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 
 from ..views import statements, activities
+from ..utils import model_cache
 from adl_lrs.views import register
 
 class ActivityTests(TestCase):
@@ -14,6 +15,7 @@ class ActivityTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         self.username = "tester"
         self.email = "test@tester.com"
         self.password = "test"
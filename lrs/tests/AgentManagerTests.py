@@ -5,9 +5,11 @@ import base64
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.core.cache import cache
 
 from ..models import Agent, Statement
-from ..views import statements
+from ..views import statements, agents
+from ..utils import model_cache
 from adl_lrs.views import register
 
 class AgentManagerTests(TestCase):
@@ -16,6 +18,7 @@ class AgentManagerTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         self.username = "tester1"
         self.email = "test1@tester.com"
         self.password = "test"
@@ -401,3 +404,61 @@ class AgentManagerTests(TestCase):
                 self.assertEquals(m['mbox'], badguy_m['mbox'])
             else:
                 self.fail("got an unexpected mbox: " % m['mbox'])
+
+    def test_anonymous_group_dedup(self):
+        members = [{"name":"anon a", "mbox":"mailto:anona@example.com"}, {"name":"anon b", "mbox":"mailto:anonb@example.com"}]
+        actors = [{"objectType":"Group", "name":"anon", "member":members},
+                  {"objectType":"Group", "name":"anon", "member":list(reversed(members))},
+                  {"objectType":"Group", "name":"other anon", "member":members}]
+        stmt_ids = []
+        for actor in actors:
+            stmt = json.dumps({"actor":actor, "verb":{"id": "http://example.com/verbs/passed"},
+                "object": {'id': 'act://blah.com'}})
+            response = self.client.post(reverse(statements), stmt, content_type="application/json",
+                Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(response.status_code, 200)
+            stmt_ids.append(json.loads(response.content)[0])
+
+        groups = [Statement.objects.get(statement_id=st_id).actor for st_id in stmt_ids]
+        # Same name and members in any order is the same group, a different name is a new group
+        self.assertEqual(groups[0].pk, groups[1].pk)
+        self.assertNotEqual(groups[0].pk, groups[2].pk)
+        self.assertEqual(Agent.objects.filter(objectType="Group", member_hash__isnull=False).count(), 2)
+        self.assertEqual(groups[0].member.count(), 2)
+
+    def test_agent_cache_name_change(self):
+        agent = json.dumps({"objectType":"Agent", "name":"bob", "mbox":"mailto:bobcache@example.com"})
+        stmt = json.dumps({"actor":json.loads(agent), "verb":{"id": "http://example.com/verbs/passed"},
+            "object": {'id': 'act://blah.com'}})
+        response = self.client.post(reverse(statements), stmt, content_type="application/json",
+            Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(reverse(agents), {'agent':agent}, Authorization=self.auth,
+            X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(json.loads(response.content)['name'], ['bob'])
+        key = model_cache.get_ifp_key({'mbox':'mailto:bobcache@example.com'})
+        self.assertIsNotNone(cache.get(key))
+
+        # Another process's copy stays in its memory, and definitions are not touched by agent changes
+        other_copy = model_cache.local_agents.get(key)
+        model_cache.local_definitions['verb'].set('http://example.com/verbs/passed', 'kept')
+        bob = Agent.objects.get(mbox="mailto:bobcache@example.com")
+        bob.name = "robert"
+        bob.save()
+        self.assertIsNone(cache.get(key))
+        model_cache.local_agents.set(key, other_copy)
+        self.assertEqual(model_cache.local_definitions['verb'].get('http://example.com/verbs/passed'), 'kept')
+        model_cache.local_definitions['verb'].delete('http://example.com/verbs/passed')
+
+        response = self.client.get(reverse(agents), {'agent':agent}, Authorization=self.auth,
+            X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(json.loads(response.content)['name'], ['robert'])
+
+        # Changing the IFP drops the entry under the old one as well
+        self.assertIsNotNone(cache.get(key))
+        bob = Agent.objects.get(mbox="mailto:bobcache@example.com")
+        bob.mbox = "mailto:robertcache@example.com"
+        bob.save()
+        self.assertIsNone(cache.get(key))
+        self.assertIsNone(model_cache.local_agents.get(key))
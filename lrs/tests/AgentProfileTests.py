@@ -9,6 +9,7 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 
 from ..views import agent_profile
+from ..utils import model_cache
 from adl_lrs.views import register
 
 class AgentProfileTests(TestCase):
@@ -25,6 +26,7 @@ class AgentProfileTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         self.username = "tester"
         self.email = "test@tester.com"
         self.password = "test"
@@ -7,6 +7,7 @@ from django.conf import settings
 
 from ..views import agents
 from ..models import Agent
+from ..utils import model_cache
 from adl_lrs.views import register
 
 class AgentTests(TestCase):
@@ -15,6 +16,7 @@ class AgentTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         self.username = "tester"
         self.password = "test"
         self.email = "test@example.com"
@@ -4,6 +4,8 @@ import uuid
 import urllib
 import hashlib
 import os
+import shutil
+from StringIO import StringIO
 
 from datetime import datetime
 from email import message_from_string
@@ -16,10 +18,13 @@ from django.test import TestCase
 from django.core.urlresolvers import reverse
 from django.utils.timezone import utc
 from django.conf import settings
+from django.core.management import call_command
 
-from ..models import Statement, StatementAttachment
+from ..models import Statement, StatementAttachment, AttachmentBlob
 from ..views import statements
+from ..utils import model_cache
 from ..utils.jws import JWS
+from oauth_provider.utils import import_rsa_key, rsa_keys
 from adl_lrs.views import register
 
 class AttachmentAndSignedTests(TestCase):
@@ -28,6 +33,7 @@ class AttachmentAndSignedTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         self.username = "tester1"
         self.email = "test1@tester.com"
         self.password = "test"
@@ -49,10 +55,11 @@ class AttachmentAndSignedTests(TestCase):
         attach_folder_path = os.path.join(settings.MEDIA_ROOT, "attachment_payloads")
         for the_file in os.listdir(attach_folder_path):
             file_path = os.path.join(attach_folder_path, the_file)
-            try:
+            # Payloads are stored in shard directories
+            if os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+            else:
                 os.unlink(file_path)
-            except Exception, e:
-                raise e
     def test_multipart(self):
         stmt = {"actor":{"mbox":"mailto:tom@example.com"},
             "verb":{"id":"http://tom.com/verb/butted"},
@@ -80,6 +87,151 @@ class AttachmentAndSignedTests(TestCase):
             content_type='multipart/mixed; boundary=myboundary', Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
         self.assertEqual(r.status_code, 200)
 
+    def test_multipart_large_payload(self):
+        stmt = {"actor":{"mbox":"mailto:tom@example.com"},
+            "verb":{"id":"http://tom.com/verb/butted"},
+            "object":{"id":"act:tom.com/objs/heads"},
+            "attachments": [
+            {"usageType": "http://example.com/attachment-usage/test",
+            "display": {"en-US": "A large attachment"},
+            "contentType": "application/octet-stream",
+            "length": 300000,
+            "sha2":""}]}
+        # Spans several reads of the request stream and goes over the in-memory spool size
+        data = os.urandom(300000)
+        datasha = hashlib.sha256(data).hexdigest()
+        stmt['attachments'][0]["sha2"] = datasha
+
+        message = MIMEMultipart(boundary="myboundary")
+        stmtdata = MIMEApplication(json.dumps(stmt), _subtype="json", _encoder=json.JSONEncoder)
+        bindata = MIMEApplication(data)
+        bindata.add_header('X-Experience-API-Hash', datasha)
+        message.attach(stmtdata)
+        message.attach(bindata)
+
+        with self.settings(FILE_UPLOAD_MAX_MEMORY_SIZE=100000):
+            r = self.client.post(reverse(statements), message.as_string().replace("\n", "\r\n"),
+                content_type='multipart/mixed; boundary=myboundary', Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 200)
+        saved_stmt = Statement.objects.get(statement_id=json.loads(r.content)[0])
+        self.assertEqual(saved_stmt.stmt_attachments.all()[0].payload.read(), data)
+
+    def test_migrate_attachment_payloads(self):
+        stmt = {"actor":{"mbox":"mailto:tom@example.com"},
+            "verb":{"id":"http://tom.com/verb/butted"},
+            "object":{"id":"act:tom.com/objs/heads"},
+            "attachments": [
+            {"usageType": "http://example.com/attachment-usage/test",
+            "display": {"en-US": "A test attachment"},
+            "contentType": "text/plain; charset=utf-8",
+            "length": 27,
+            "sha2":""}]}
+        txt = "howdy.. this is a converted attachment"
+        txtsha = hashlib.sha256(txt).hexdigest()
+        stmt['attachments'][0]["sha2"] = txtsha
+
+        message = MIMEMultipart(boundary="myboundary")
+        stmtdata = MIMEApplication(json.dumps(stmt), _subtype="json", _encoder=json.JSONEncoder)
+        textdata = MIMEText(txt, 'plain', 'utf-8')
+        textdata.add_header('X-Experience-API-Hash', txtsha)
+        message.attach(stmtdata)
+        message.attach(textdata)
+        r = self.client.post(reverse(statements), message.as_string(),
+            content_type='multipart/mixed; boundary=myboundary', Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 200)
+
+        # Payloads used to be stored base64 encoded in one flat directory
+        attachment = StatementAttachment.objects.get(sha2=txtsha)
+        self.assertEqual(attachment.payload.name, "attachment_payloads/%s/%s/%s" % (txtsha[:2], txtsha[2:4], txtsha))
+        os.remove(attachment.payload.path)
+        flat_path = os.path.join(settings.MEDIA_ROOT, "attachment_payloads", txtsha)
+        with open(flat_path, 'wb') as f:
+            f.write(base64.b64encode(txt))
+        StatementAttachment.objects.filter(pk=attachment.pk).update(payload="attachment_payloads/%s" % txtsha)
+        AttachmentBlob.objects.all().delete()
+
+        call_command('migrate_attachment_payloads', stdout=StringIO())
+        attachment = StatementAttachment.objects.get(pk=attachment.pk)
+        self.assertEqual(attachment.payload.name, "attachment_payloads/%s/%s/%s" % (txtsha[:2], txtsha[2:4], txtsha))
+        self.assertEqual(attachment.payload.read(), txt)
+        self.assertFalse(os.path.exists(flat_path))
+        self.assertEqual(AttachmentBlob.objects.get(sha2=txtsha).ref_count, 1)
+
+    def test_gc_attachment_blobs(self):
+        stmts = []
+        for i in range(2):
+            stmts.append({"actor":{"mbox":"mailto:tom@example.com"},
+                "verb":{"id":"http://tom.com/verb/butted"},
+                "object":{"id":"act:tom.com/objs/heads"},
+                "attachments": [
+                {"usageType": "http://example.com/attachment-usage/test",
+                "display": {"en-US": "A shared attachment"},
+                "contentType": "text/plain; charset=utf-8",
+                "length": 27,
+                "sha2":""}]})
+        txt = "howdy.. this is a shared attachment"
+        txtsha = hashlib.sha256(txt).hexdigest()
+        for stmt in stmts:
+            stmt['attachments'][0]["sha2"] = txtsha
+
+        message = MIMEMultipart(boundary="myboundary")
+        stmtdata = MIMEApplication(json.dumps(stmts), _subtype="json", _encoder=json.JSONEncoder)
+        textdata = MIMEText(txt, 'plain', 'utf-8')
+        textdata.add_header('X-Experience-API-Hash', txtsha)
+        message.attach(stmtdata)
+        message.attach(textdata)
+        r = self.client.post(reverse(statements), message.as_string(),
+            content_type='multipart/mixed; boundary=myboundary', Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 200)
+        stmt_ids = json.loads(r.content)
+        self.assertEqual(AttachmentBlob.objects.get(sha2=txtsha).ref_count, 2)
+        payload_path = StatementAttachment.objects.filter(sha2=txtsha)[0].payload.path
+        orphan_path = os.path.join(settings.MEDIA_ROOT, "attachment_payloads", "00", "00", "00" * 32)
+        os.makedirs(os.path.dirname(orphan_path))
+        with open(orphan_path, 'wb') as f:
+            f.write("left behind by a rolled back request")
+
+        # Still referenced by the second statement
+        Statement.objects.get(statement_id=stmt_ids[0]).delete()
+        self.assertEqual(AttachmentBlob.objects.get(sha2=txtsha).ref_count, 1)
+        call_command('gc_attachment_blobs', grace=0, stdout=StringIO())
+        self.assertTrue(os.path.exists(payload_path))
+        self.assertFalse(os.path.exists(orphan_path))
+
+        Statement.objects.get(statement_id=stmt_ids[1]).delete()
+        # Recently written payloads are left alone
+        call_command('gc_attachment_blobs', stdout=StringIO())
+        self.assertTrue(os.path.exists(payload_path))
+        call_command('gc_attachment_blobs', grace=0, stdout=StringIO())
+        self.assertFalse(os.path.exists(payload_path))
+        self.assertFalse(AttachmentBlob.objects.filter(sha2=txtsha).exists())
+
+    def test_multipart_wrong_hash(self):
+        stmt = {"actor":{"mbox":"mailto:tom@example.com"},
+            "verb":{"id":"http://tom.com/verb/butted"},
+            "object":{"id":"act:tom.com/objs/heads"},
+            "attachments": [
+            {"usageType": "http://example.com/attachment-usage/test",
+            "display": {"en-US": "A test attachment"},
+            "contentType": "text/plain; charset=utf-8",
+            "length": 27,
+            "sha2":""}]}
+        txtsha = hashlib.sha256("howdy.. this is a text attachment").hexdigest()
+        stmt['attachments'][0]["sha2"] = txtsha
+
+        message = MIMEMultipart(boundary="myboundary")
+        stmtdata = MIMEApplication(json.dumps(stmt), _subtype="json", _encoder=json.JSONEncoder)
+        textdata = MIMEText("not the attachment that was hashed", 'plain', 'utf-8')
+        textdata.add_header('X-Experience-API-Hash', txtsha)
+        message.attach(stmtdata)
+        message.attach(textdata)
+
+        r = self.client.post(reverse(statements), message.as_string(),
+            content_type='multipart/mixed; boundary=myboundary', Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.content, "Attachment payload did not match its X-Experience-API-Hash: %s" % txtsha)
+        self.assertEqual(StatementAttachment.objects.count(), 0)
+
     def test_multiple_stmt_multipart(self):
         stmt = [{"actor":{"mbox":"mailto:tom@example.com"},
             "verb":{"id":"http://tom.com/verb/butted"},
@@ -135,8 +287,8 @@ class AttachmentAndSignedTests(TestCase):
         self.assertEqual(len(attachments), 2)
 
         
-        self.assertEqual(saved_stmt1.stmt_attachments.all()[0].payload.read(), base64.b64encode("howdy.. this is a text attachment"))
-        self.assertEqual(saved_stmt2.stmt_attachments.all()[0].payload.read(), base64.b64encode("This is second attachment."))
+        self.assertEqual(saved_stmt1.stmt_attachments.all()[0].payload.read(), "howdy.. this is a text attachment")
+        self.assertEqual(saved_stmt2.stmt_attachments.all()[0].payload.read(), "This is second attachment.")
 
     def test_multiple_stmt_multipart_same_attachment(self):
         stmt = [{"actor":{"mbox":"mailto:tom@example.com"},
@@ -187,8 +339,8 @@ class AttachmentAndSignedTests(TestCase):
         self.assertEqual(len(stmts), 2)
         self.assertEqual(len(attachments), 2)
 
-        self.assertEqual(saved_stmt1.stmt_attachments.all()[0].payload.read(), base64.b64encode("howdy.. this is a text attachment"))
-        self.assertEqual(saved_stmt2.stmt_attachments.all()[0].payload.read(), base64.b64encode("howdy.. this is a text attachment"))
+        self.assertEqual(saved_stmt1.stmt_attachments.all()[0].payload.read(), "howdy.. this is a text attachment")
+        self.assertEqual(saved_stmt2.stmt_attachments.all()[0].payload.read(), "howdy.. this is a text attachment")
 
     def test_multiple_stmt_multipart_one_attachment_one_fileurl(self):
         stmt = [{"actor":{"mbox":"mailto:tom@example.com"},
@@ -237,7 +389,7 @@ class AttachmentAndSignedTests(TestCase):
         self.assertEqual(len(stmts), 2)
         self.assertEqual(len(attachments), 2)
 
-        self.assertEqual(saved_stmt1.stmt_attachments.all()[0].payload.read(), base64.b64encode("howdy.. this is a text attachment"))
+        self.assertEqual(saved_stmt1.stmt_attachments.all()[0].payload.read(), "howdy.. this is a text attachment")
         self.assertEqual(saved_stmt2.stmt_attachments.all()[0].fileUrl, "http://my/file/url")
 
     def test_multiple_stmt_multipart_multiple_attachments_each(self):
@@ -326,10 +478,10 @@ class AttachmentAndSignedTests(TestCase):
 
         stmt1_contents = ["This is a text attachment11","This is a text attachment12"]
         stmt2_contents = ["This is a text attachment21","This is a text attachment22"]
-        self.assertIn(base64.b64decode(saved_stmt1.stmt_attachments.all()[0].payload.read()), stmt1_contents)
-        self.assertIn(base64.b64decode(saved_stmt1.stmt_attachments.all()[1].payload.read()), stmt1_contents)
-        self.assertIn(base64.b64decode(saved_stmt2.stmt_attachments.all()[0].payload.read()), stmt2_contents)
-        self.assertIn(base64.b64decode(saved_stmt2.stmt_attachments.all()[1].payload.read()), stmt2_contents)
+        self.assertIn(saved_stmt1.stmt_attachments.all()[0].payload.read(), stmt1_contents)
+        self.assertIn(saved_stmt1.stmt_attachments.all()[1].payload.read(), stmt1_contents)
+        self.assertIn(saved_stmt2.stmt_attachments.all()[0].payload.read(), stmt2_contents)
+        self.assertIn(saved_stmt2.stmt_attachments.all()[1].payload.read(), stmt2_contents)
 
     def test_multipart_wrong_sha(self):
         stmt = {"actor":{"mbox":"mailto:tom@example.com"},
@@ -919,6 +1071,104 @@ class AttachmentAndSignedTests(TestCase):
         self.assertEqual(parts[2].get('Content-Type'), 'image/png')
         self.assertEqual(parts[2].get('Content-Transfer-Encoding'), 'binary')
 
+    def test_multipart_get_streams_payloads(self):
+        stmt = [{"actor":{"mbox":"mailto:tom@example.com"},
+            "verb":{"id":"http://tom.com/verb/butted"},
+            "object":{"id":"act:tom.com/objs/heads1"},
+            "attachments": [
+                {"usageType": "http://example.com/attachment-usage/test1",
+                "display": {"en-US": "A test attachment1"},
+                "contentType": "text/plain; charset=utf-8",
+                "length": 26,
+                "sha2":""}]},
+            {"actor":{"mbox":"mailto:tom@example.com"},
+            "verb":{"id":"http://tom.com/verb/butted"},
+            "object":{"id":"act:tom.com/objs/heads2"},
+            "attachments": [
+                {"usageType": "http://example.com/attachment-usage/test1",
+                "display": {"en-US": "A test attachment1"},
+                "contentType": "text/plain; charset=utf-8",
+                "length": 26,
+                "sha2":""},
+                {"usageType": "http://example.com/attachment-usage/test2",
+                "display": {"en-US": "A test attachment2"},
+                "contentType": "application/octet-stream",
+                "length": 300000,
+                "sha2":""}]}
+            ]
+
+        message = MIMEMultipart(boundary="myboundary")
+        txt = u"This is a text attachment1"
+        txtsha = hashlib.sha256(txt).hexdigest()
+        data = os.urandom(300000)
+        datasha = hashlib.sha256(data).hexdigest()
+        stmt[0]['attachments'][0]["sha2"] = str(txtsha)
+        stmt[1]['attachments'][0]["sha2"] = str(txtsha)
+        stmt[1]['attachments'][1]["sha2"] = str(datasha)
+
+        stmtdata = MIMEApplication(json.dumps(stmt), _subtype="json", _encoder=json.JSONEncoder)
+        textdata = MIMEText(txt, 'plain', 'utf-8')
+        textdata.add_header('X-Experience-API-Hash', txtsha)
+        bindata = MIMEApplication(data)
+        bindata.add_header('X-Experience-API-Hash', datasha)
+        message.attach(stmtdata)
+        message.attach(textdata)
+        message.attach(bindata)
+
+        r = self.client.post(reverse(statements), message.as_string(), content_type="multipart/mixed",
+            Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 200)
+
+        param = {"attachments":True}
+        path = "%s?%s" % (reverse(statements), urllib.urlencode(param))
+        r = self.client.get(path, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r['Content-Type'], 'multipart/mixed; boundary=======ADL_LRS======')
+        # The body is streamed so it can only be read once
+        content = r.content
+        self.assertEqual(int(r['Content-Length']), len(content))
+
+        msg = message_from_string("Content-Type:multipart/mixed; boundary=======ADL_LRS======" + content)
+        parts = [part for part in msg.walk()][1:]
+        # The payload shared by both statements is only sent once
+        self.assertEqual(len(parts), 3)
+        self.assertEqual(len(json.loads(parts[0].get_payload())['statements']), 2)
+        payloads = dict((part.get("X-Experience-API-Hash"), part.get_payload()) for part in parts[1:])
+        self.assertEqual(payloads[txtsha], txt)
+        self.assertEqual(payloads[datasha], data)
+
+    def test_multipart_get_missing_payload(self):
+        stmt = {"actor":{"mbox":"mailto:tom@example.com"},
+            "verb":{"id":"http://tom.com/verb/butted"},
+            "object":{"id":"act:tom.com/objs/heads"},
+            "attachments": [
+            {"usageType": "http://example.com/attachment-usage/test",
+            "display": {"en-US": "A test attachment"},
+            "contentType": "text/plain; charset=utf-8",
+            "length": 26,
+            "sha2":""}]}
+
+        message = MIMEMultipart(boundary="myboundary")
+        txt = u"This is a text attachment1"
+        txtsha = hashlib.sha256(txt).hexdigest()
+        stmt['attachments'][0]["sha2"] = str(txtsha)
+        stmtdata = MIMEApplication(json.dumps(stmt), _subtype="json", _encoder=json.JSONEncoder)
+        textdata = MIMEText(txt, 'plain', 'utf-8')
+        textdata.add_header('X-Experience-API-Hash', txtsha)
+        message.attach(stmtdata)
+        message.attach(textdata)
+
+        r = self.client.post(reverse(statements), message.as_string(), content_type="multipart/mixed",
+            Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 200)
+        os.remove(StatementAttachment.objects.get(sha2=txtsha).payload.path)
+
+        param = {"attachments":True}
+        path = "%s?%s" % (reverse(statements), urllib.urlencode(param))
+        r = self.client.get(path, X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(r.status_code, 500)
+        self.assertIn(txtsha, r.content)
+
     def test_example_signed_statement(self):
         header = base64.urlsafe_b64decode(fixpad(encodedhead))
         payload = base64.urlsafe_b64decode(fixpad(encodedpayload))
@@ -943,6 +1193,26 @@ class AttachmentAndSignedTests(TestCase):
             content_type='multipart/mixed', Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
         self.assertEqual(r.status_code, 200)
 
+    def test_signed_statement_key_cache(self):
+        header = base64.urlsafe_b64decode(fixpad(encodedhead))
+        payload = base64.urlsafe_b64decode(fixpad(encodedpayload))
+        thejws = JWS(header, payload).create(privatekey)
+        cert = json.loads(header)['x5c'][0]
+
+        parsed = []
+        def counting_cert_to_key(cert):
+            parsed.append(cert)
+            return JWS._cert_to_key(cert)
+        key = import_rsa_key(cert, counting_cert_to_key)
+        self.assertIs(import_rsa_key(cert, counting_cert_to_key), key)
+        self.assertEqual(len(parsed), 1)
+
+        # Statements signed with the same certificate share one parsed key
+        self.assertTrue(JWS(jws=thejws).verify())
+        cached = rsa_keys[(JWS._cert_to_key, hashlib.sha256(cert).digest())]
+        self.assertTrue(JWS(jws=thejws).verify())
+        self.assertIs(rsa_keys[(JWS._cert_to_key, hashlib.sha256(cert).digest())], cached)
+
     def test_example_signed_statement_bad(self):
         header = base64.urlsafe_b64decode(fixpad(encodedhead))
         payload = base64.urlsafe_b64decode(fixpad(encodedpayload))
@@ -9,10 +9,11 @@ from django.test import TestCase
 from django.core.urlresolvers import reverse
 from django.utils.timezone import utc
 from django.conf import settings
+from django.contrib.auth.models import User
 
 from ..models import Statement, Agent, Verb, Activity, SubStatement
 from ..views import statements
-from ..utils import retrieve_statement
+from ..utils import retrieve_statement, authorization, model_cache
 from adl_lrs.views import register
 
 class AuthTests(TestCase):
@@ -22,6 +23,7 @@ class AuthTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         if not settings.ALLOW_EMPTY_HTTP_AUTH:
             settings.ALLOW_EMPTY_HTTP_AUTH = True
 
@@ -1109,4 +1111,32 @@ class AuthTests(TestCase):
             "object": {"id":"act:i.pity.the.fool"}, "authority": {"objectType":ot, "name":name, "mbox":mbox,"member":[{"name":"agentA","mbox":"mailto:agentA@example.com"},{"name":"agentB","mbox":"mailto:agentB@example.com"}]}})
         
         response = self.client.post(reverse(statements), stmt, content_type="application/json", Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
-        self.assertEqual(response.status_code, 400)
\ No newline at end of file
+        self.assertEqual(response.status_code, 400)
+
+    def test_basic_auth_credential_cache(self):
+        form = {'username':'cached','email':'cached@example.com','password':'cached','password2':'cached'}
+        self.client.post(reverse(register), form, X_Experience_API_Version=settings.XAPI_VERSION)
+        auth = "Basic %s" % base64.b64encode("cached:cached")
+
+        calls = []
+        real_authenticate = authorization.authenticate
+        def counting_authenticate(**credentials):
+            calls.append(credentials['username'])
+            return real_authenticate(**credentials)
+        authorization.authenticate = counting_authenticate
+        try:
+            for i in range(2):
+                response = self.client.get(reverse(statements), Authorization=auth, X_Experience_API_Version=settings.XAPI_VERSION)
+                self.assertEqual(response.status_code, 200)
+            # Only the first request hashed the password
+            self.assertEqual(calls, ['cached'])
+
+            # Changing the password drops the cached credentials
+            user = User.objects.get(username='cached')
+            user.set_password('changed')
+            user.save()
+            response = self.client.get(reverse(statements), Authorization=auth, X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(calls, ['cached', 'cached'])
+        finally:
+            authorization.authenticate = real_authenticate
\ No newline at end of file
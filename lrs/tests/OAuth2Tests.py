@@ -12,8 +12,9 @@ from django.utils.html import escape
 from django.test import TestCase
 from django.contrib.auth.models import User
 
-from ..models import Activity
+from ..models import Activity, Statement
 from ..views import statements
+from ..utils import authorization, model_cache
 
 from oauth2_provider.provider import constants
 from oauth2_provider.provider.utils import now as date_now
@@ -45,6 +46,9 @@ class OAuth2Tests(TestCase):
     def access_token_url(self):
         return reverse('oauth2:access_token')
 
+    def setUp(self):
+        model_cache.clear_local_caches()
+
     def get_client(self, cid=2):
         return Client.objects.get(id=cid)
 
@@ -673,6 +677,66 @@ class AccessTokenTest(OAuth2Tests):
         token = self._login_authorize_get_token()
         self.assertEqual(token['token_type'], constants.TOKEN_TYPE, token)
 
+    def test_auth_context_cache(self):
+        token = self._login_authorize_get_token()
+        auth = "Bearer " + token['access_token']
+
+        calls = []
+        real_resolve = authorization.resolve_oauth_context
+        def counting_resolve(request, token, version):
+            calls.append(token.token)
+            return real_resolve(request, token, version)
+        authorization.resolve_oauth_context = counting_resolve
+        try:
+            for i in range(2):
+                response = self.client.get(reverse(statements), X_Experience_API_Version=settings.XAPI_VERSION, Authorization=auth)
+                self.assertEqual(response.status_code, 200)
+            # The group agent and scopes were only resolved for the first request
+            self.assertEqual(len(calls), 1)
+
+            # Saving the user without changing its name, email or active flag keeps the context
+            user = User.objects.get(username='test-user-1')
+            user.last_login = datetime.datetime.now()
+            user.save()
+            response = self.client.get(reverse(statements), X_Experience_API_Version=settings.XAPI_VERSION, Authorization=auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(calls), 1)
+
+            # The group is built from the user's email so changing it resolves the context again
+            user.email = 'changed@example.com'
+            user.save()
+            response = self.client.get(reverse(statements), X_Experience_API_Version=settings.XAPI_VERSION, Authorization=auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(calls), 2)
+
+            # Revoking the token drops its context along with it
+            access_token = AccessToken.objects.get(token=token['access_token'])
+            key = model_cache.get_token_key(2, access_token.pk)
+            self.assertIsNotNone(model_cache.local_auth_contexts.get(key))
+            access_token.delete()
+            self.assertIsNone(model_cache.local_auth_contexts.get(key))
+            response = self.client.get(reverse(statements), X_Experience_API_Version=settings.XAPI_VERSION, Authorization=auth)
+            self.assertEqual(response.status_code, 401)
+        finally:
+            authorization.resolve_oauth_context = real_resolve
+
+    def test_auth_context_cache_user(self):
+        token = self._login_authorize_get_token()
+        auth = "Bearer " + token['access_token']
+        # The token belongs to test-user-1, the client to test-user-2
+        owner = self.get_client().user
+        self.assertNotEqual(owner, self.get_user())
+
+        # Statements are saved under the client's owner whether the context was resolved or cached
+        for i in range(2):
+            stmt = json.dumps({"verb":{"id": "http://example.com/verbs/created"}, "object": {"id":"act:cached_user"},
+                "actor":{"objectType":"Agent","mbox":"mailto:cached_user@example.com"}})
+            response = self.client.post(reverse(statements), stmt, content_type="application/json",
+                Authorization=auth, X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(Statement.objects.get(statement_id=json.loads(response.content)[0]).user, owner)
+        access_token = AccessToken.objects.get(token=token['access_token'])
+        self.assertIsNotNone(model_cache.local_auth_contexts.get(model_cache.get_token_key(2, access_token.pk)))
 
 class AuthBackendTest(OAuth2Tests):
     fixtures = ['test_oauth2']
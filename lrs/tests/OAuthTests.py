@@ -13,12 +13,17 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.core.management import call_command
 
 from ..views import statements
 from ..models import Activity, Agent
+from ..exceptions import Forbidden
+from ..utils import model_cache
+from ..utils.authorization import get_scope_mask, validate_oauth_scope
 from adl_lrs.views import register, reg_client
 
 from oauth_provider.models import Consumer, Token, Nonce
+from oauth_provider.store.nonce import LocalNonceStore, CacheNonceStore
 from oauth_provider.utils import SignatureMethod_RSA_SHA1
 
 # Django client uses testserver
@@ -33,6 +38,7 @@ class OAuthTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         if not settings.OAUTH_ENABLED:
             settings.OAUTH_ENABLED = True
 
@@ -2935,4 +2941,37 @@ Lw03eHTNQghS0A==
         self.assertEqual(len(content['statements']), 3)
 
         jane_clients = Consumer.objects.filter(user=self.user)
-        self.assertEqual(len(jane_clients), 2)
\ No newline at end of file
+        self.assertEqual(len(jane_clients), 2)
+
+    def test_scope_mask(self):
+        token = Token(scope="statements/write statements/read/mine")
+        mask = get_scope_mask(token)
+        self.assertEqual(mask, settings.STATEMENTS_WRITE | settings.STATEMENTS_READ_MINE)
+
+        req_dict = {'method': 'GET', 'auth': {'endpoint': '/statements'}}
+        validate_oauth_scope(req_dict, mask)
+        self.assertTrue(req_dict['auth']['statements_mine_only'])
+        self.assertFalse(req_dict['auth']['define'])
+
+        req_dict = {'method': 'PUT', 'auth': {'endpoint': '/activities/state'}}
+        self.assertRaises(Forbidden, validate_oauth_scope, req_dict, mask)
+
+        req_dict = {'method': 'DELETE', 'auth': {'endpoint': '/activities/state'}}
+        validate_oauth_scope(req_dict, get_scope_mask(Token(scope="all")))
+        self.assertTrue(req_dict['auth']['define'])
+
+    def test_expiring_nonce_stores(self):
+        now = int(time.time())
+        for store in [LocalNonceStore(), CacheNonceStore()]:
+            nonce = uuid.uuid4().hex
+            self.assertTrue(store.check_nonce('consumer', 'token', nonce, now))
+            self.assertFalse(store.check_nonce('consumer', 'token', nonce, now))
+            # The same nonce under another token is a different request
+            self.assertTrue(store.check_nonce('consumer', 'other', nonce, now))
+
+    def test_purge_nonces(self):
+        now = int(time.time())
+        Nonce.objects.create(consumer_key='consumer', token_key='', key='old', timestamp=now - settings.OAUTH_NONCE_VALID_PERIOD - 10)
+        Nonce.objects.create(consumer_key='consumer', token_key='', key='new', timestamp=now)
+        call_command('purge_oauth_nonces', batch=1, stdout=open(os.devnull, 'w'))
+        self.assertEqual(list(Nonce.objects.filter(consumer_key='consumer').values_list('key', flat=True)), ['new'])
\ No newline at end of file
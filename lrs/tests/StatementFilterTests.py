@@ -2,10 +2,13 @@
 import json
 import base64
 import os
+import shutil
 import uuid
 import math
 import urllib
 import hashlib
+import types
+from StringIO import StringIO
 
 from email import message_from_string
 from email.mime.multipart import MIMEMultipart
@@ -16,10 +19,11 @@ from django.test import TestCase
 from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.core.management import call_command
 
-from ..models import Statement
+from ..models import Statement, StatementRole
 from ..views import statements, statements_more
-from ..utils import convert_to_utc
+from ..utils import convert_to_utc, retrieve_statement, model_cache
 from adl_lrs.views import register
 
 class StatementFilterTests(TestCase):
@@ -29,6 +33,7 @@ class StatementFilterTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         self.saved_stmt_limit=settings.SERVER_STMT_LIMIT
         settings.SERVER_STMT_LIMIT=100
         self.username = "tom"
@@ -44,10 +49,11 @@ class StatementFilterTests(TestCase):
         attach_folder_path = os.path.join(settings.MEDIA_ROOT, "attachment_payloads")
         for the_file in os.listdir(attach_folder_path):
             file_path = os.path.join(attach_folder_path, the_file)
-            try:
+            # Payloads are stored in shard directories
+            if os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+            else:
                 os.unlink(file_path)
-            except Exception, e:
-                raise e
     
     def test_limit_filter(self):
         # Test limit
@@ -406,6 +412,44 @@ class StatementFilterTests(TestCase):
         stmts = obj['statements']
         self.assertEqual(len(stmts), 3)
 
+    def test_related_filters_backfill(self):
+        stmts = [{"actor":{"mbox":"mailto:timmy@example.com"},
+                    "verb":{"id":"http://special.adlnet.gov/xapi/verbs/started"},
+                    "object":{"id":"act:adlnet.gov/website"},
+                    "context":{"instructor":{"mbox":"mailto:louo@example.com"},
+                        "contextActivities":{"parent":{"id":"act:adlnet.gov/course"}}}},
+                {"actor":{"mbox":"mailto:timmy@example.com"},
+                    "verb":{"id":"http://special.adlnet.gov/xapi/verbs/stopped"},
+                    "object":{"objectType":"SubStatement", "actor":{"mbox":"mailto:louo@example.com"},
+                        "verb":{"id":"http://special.adlnet.gov/xapi/verbs/hacked"}, "object":{"id":"act:adlnet.gov/website"},
+                        "context":{"contextActivities":{"grouping":[{"id":"act:adlnet.gov/course"}]}}}},
+                {"actor":{"mbox":"mailto:blobby@example.com"},
+                    "verb":{"id":"http://special.adlnet.gov/xapi/verbs/started"},
+                    "object":{"id":"act:adlnet.gov/other"}}]
+        resp = self.client.post(reverse(statements), json.dumps(stmts), Authorization=self.auth, content_type="application/json", X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(resp.status_code, 200)
+        roles = sorted(StatementRole.objects.values_list('statement', 'agent', 'activity', 'role'))
+        self.assertIn('sub_grouping', [r[3] for r in roles])
+
+        def related_count(param):
+            path = "%s?%s" % (reverse(statements), urllib.urlencode(param))
+            r = self.client.get(path, X_Experience_API_Version="1.0", Authorization=self.auth)
+            self.assertEqual(r.status_code, 200)
+            return len(json.loads(r.content)['statements'])
+
+        self.assertEqual(related_count({"agent":{"mbox":"mailto:louo@example.com"}, "related_agents":True}), 2)
+        self.assertEqual(related_count({"activity":"act:adlnet.gov/course", "related_activities":True}), 2)
+        self.assertEqual(related_count({"activity":"act:adlnet.gov/website", "related_activities":True}), 2)
+        self.assertEqual(related_count({"activity":"act:adlnet.gov/website"}), 1)
+
+        # Related filters only look at the index so it has to be rebuilt for existing statements
+        StatementRole.objects.all().delete()
+        self.assertEqual(related_count({"activity":"act:adlnet.gov/course", "related_activities":True}), 0)
+        call_command('backfill_statement_roles', batch=2, stdout=StringIO())
+        self.assertEqual(sorted(StatementRole.objects.values_list('statement', 'agent', 'activity', 'role')), roles)
+        self.assertEqual(related_count({"agent":{"mbox":"mailto:louo@example.com"}, "related_agents":True}), 2)
+        self.assertEqual(related_count({"activity":"act:adlnet.gov/course", "related_activities":True}), 2)
+
     def test_agent_filter_since_and_until(self):
         batch = [
         {
@@ -1608,6 +1652,114 @@ class StatementFilterTests(TestCase):
         stmt_obj = json.loads(r.content)
         self.assertNotIn('definition', stmt_obj['object'])
 
+    @override_settings(CELERY_ALWAYS_EAGER=True,
+                        TEST_RUNNER = 'djcelery.contrib.test_runner.CeleryTestSuiteRunner') 
+    def test_complex_get_query_count(self):
+        guids = [str(uuid.uuid1()) for i in range(12)]
+        stmts = [{"id":guid, "actor":{"mbox":"mailto:runner@example.com"}, "verb":{"id":"http://tom.com/verb/ran"},
+            "object":{"id":"act:my/track"}} for guid in guids]
+        resp = self.client.post(reverse(statements), json.dumps(stmts), content_type="application/json", Authorization=self.auth, X_Experience_API_Version="1.0")
+        self.assertEqual(resp.status_code, 200)
+
+        # One voided statement, a reference to another and a reference to that reference
+        ref_guid = str(uuid.uuid1())
+        ref2_guid = str(uuid.uuid1())
+        refs = [{"actor":{"mbox":"mailto:coach@example.com"}, "verb":{"id":"http://adlnet.gov/expapi/verbs/voided"},
+                    "object":{"objectType":"StatementRef", "id":guids[0]}},
+                {"id":ref_guid, "actor":{"mbox":"mailto:coach@example.com"}, "verb":{"id":"http://tom.com/verb/timed"},
+                    "object":{"objectType":"StatementRef", "id":guids[1]}},
+                {"id":ref2_guid, "actor":{"mbox":"mailto:coach@example.com"}, "verb":{"id":"http://tom.com/verb/checked"},
+                    "object":{"objectType":"StatementRef", "id":ref_guid}}]
+        resp = self.client.post(reverse(statements), json.dumps(refs), content_type="application/json", Authorization=self.auth, X_Experience_API_Version="1.0")
+        self.assertEqual(resp.status_code, 200)
+        void_guid = json.loads(resp.content)[0]
+
+        def get_all(params, first_queries):
+            # First page finds how deep the statement refs go, later pages are a single query each
+            with self.assertNumQueries(first_queries):
+                pieces, content_length, stmt_ids = retrieve_statement.complex_get(params, 5, None, 'exact', False)
+            # Nothing is joined until the result is written out
+            self.assertIsInstance(pieces, types.GeneratorType)
+            content = "".join(pieces)
+            self.assertEqual(len(content), content_length)
+            result = json.loads(content)
+            found = [st['id'] for st in result['statements']]
+            self.assertEqual(stmt_ids, found)
+            while result['more']:
+                self.assertEqual(len(result['statements']), 5)
+                with self.assertNumQueries(1):
+                    result = json.loads("".join(retrieve_statement.parse_more_request(result['more'].split('/')[-1])[0][0]))
+                found.extend([st['id'] for st in result['statements']])
+            return found
+
+        expected = guids[1:] + [void_guid, ref_guid, ref2_guid]
+        # Filter, two levels of refs found and the empty third level, then the page
+        found = get_all({"verb":"http://tom.com/verb/ran"}, 4)
+        self.assertEqual(len(found), len(expected))
+        self.assertEqual(set(found), set(expected))
+        # Agent lookup and its groups on top of that
+        found = get_all({"agent":{"mbox":"mailto:runner@example.com"}}, 6)
+        self.assertEqual(set(found), set(expected))
+        # No statement refs are looked for with only a time filter
+        found = get_all({"since":"2000-01-01T00:00:00Z"}, 1)
+        self.assertEqual(set(found), set(expected))
+
+    @override_settings(CELERY_ALWAYS_EAGER=True,
+                        TEST_RUNNER = 'djcelery.contrib.test_runner.CeleryTestSuiteRunner') 
+    def test_page_serializer_query_count(self):
+        team = {"objectType":"Group", "name":"team", "member":[{"mbox":"mailto:one@example.com"}, {"mbox":"mailto:two@example.com"}]}
+        stmts = []
+        for i in range(6):
+            stmts.append({"actor":team if i % 2 else {"mbox":"mailto:player%s@example.com" % i, "name":"player"},
+                "verb":{"id":"http://tom.com/verb/played", "display":{"en-US":"played", "fr":"joue"}},
+                "object":{"id":"act:game/%s" % i, "definition":{"name":{"en-US":"game", "fr":"jeu"},
+                    "interactionType":"choice", "correctResponsesPattern":["a"],
+                    "choices":[{"id":"a", "description":{"en-US":"A", "fr":"Un"}}]}},
+                "result":{"score":{"raw":i}},
+                "context":{"team":team, "instructor":{"mbox":"mailto:coach@example.com"},
+                    "contextActivities":{"parent":[{"id":"act:league"}], "other":[{"id":"act:season"}, {"id":"act:game/0"}]}},
+                "attachments":[{"usageType":"http://example.com/usage", "display":{"en-US":"score sheet"},
+                    "contentType":"text/plain", "length":10, "fileUrl":"http://example.com/sheet%s" % i}]})
+        stmts.append({"actor":{"mbox":"mailto:ref@example.com"}, "verb":{"id":"http://tom.com/verb/played"},
+            "object":{"objectType":"SubStatement", "actor":team, "verb":{"id":"http://tom.com/verb/watched"},
+                "object":{"id":"act:game/1"}, "context":{"instructor":team, "contextActivities":{"grouping":{"id":"act:league"}}}}})
+        resp = self.client.post(reverse(statements), json.dumps(stmts), content_type="application/json", Authorization=self.auth, X_Experience_API_Version="1.0")
+        self.assertEqual(resp.status_code, 200)
+
+        for format in ['canonical', 'ids']:
+            # The page, then one query per related table - agent members, attachments, context activities and
+            # the same for the substatement - no matter how many statements are on the page. Agent fields that
+            # are empty on every statement (object agents, the substatement's team) are skipped
+            with self.assertNumQueries(16):
+                pieces, content_length, stmt_ids = retrieve_statement.complex_get({"since":"2000-01-01T00:00:00Z"}, 10, 'fr', format, False)
+            result = json.loads("".join(pieces))
+            self.assertEqual(len(result['statements']), 7)
+            self.assertEqual(stmt_ids, [st['id'] for st in result['statements']])
+            # Output matches serializing each statement on its own
+            for st in result['statements']:
+                expected = Statement.objects.get(statement_id=st['id']).to_dict('fr', format)
+                self.assertEqual(st, json.loads(json.dumps(expected)))
+
+    @override_settings(CELERY_ALWAYS_EAGER=True,
+                        TEST_RUNNER = 'djcelery.contrib.test_runner.CeleryTestSuiteRunner') 
+    def test_exact_format_stored_text(self):
+        guid = str(uuid.uuid1())
+        stmt = {"id":guid, "actor":{"mbox":"mailto:writer@example.com"}, "verb":{"id":"http://tom.com/verb/wrote"},
+            "object":{"id":"act:my/essay", "definition":{"name":{"en-US":u"essay \u00e9"}}}}
+        resp = self.client.post(reverse(statements), json.dumps(stmt), content_type="application/json", Authorization=self.auth, X_Experience_API_Version="1.0")
+        self.assertEqual(resp.status_code, 200)
+
+        param = {"verb":"http://tom.com/verb/wrote"}
+        path = "%s?%s" % (reverse(statements), urllib.urlencode(param))
+        r = self.client.get(path, X_Experience_API_Version="1.0", Authorization=self.auth)
+        self.assertEqual(r.status_code, 200)
+        # Statements are sent as the text that was stored, no re-encoding
+        stored_text = Statement.objects.filter(statement_id=guid).values_list('full_statement', flat=True)[0]
+        content = r.content
+        self.assertEqual(content, '{"statements": [%s], "more": ""}' % stored_text)
+        self.assertEqual(r['Content-Length'], str(len(content)))
+        self.assertEqual(json.loads(content)['statements'][0]['object']['definition']['name']['en-US'], u"essay \u00e9")
+
     @override_settings(CELERY_ALWAYS_EAGER=True,
                         TEST_RUNNER = 'djcelery.contrib.test_runner.CeleryTestSuiteRunner') 
     def test_voidedStatementId(self):
@@ -1942,7 +2094,7 @@ class StatementFilterTests(TestCase):
         self.assertIn('attachments', obj_from_json['statements'][1].keys())        
 
         resp_url = obj_from_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url.split('/')[-1]
 
         more_get = self.client.get(reverse(statements_more,kwargs={'more_id':resp_id}),
             X_Experience_API_Version=settings.XAPI_VERSION,HTTP_AUTHORIZATION=self.auth)
@@ -2059,7 +2211,7 @@ class StatementFilterTests(TestCase):
         self.assertTrue(isinstance(returned_json, dict))
         self.assertEqual(len(returned_json['statements']), 2)
         resp_url = returned_json['more']
-        resp_id = resp_url[-32:]        
+        resp_id = resp_url.split('/')[-1]        
 
         for part in parts[2:]:
             self.assertIn(part.get_payload(), payload_list2)
@@ -2181,7 +2333,7 @@ class StatementFilterTests(TestCase):
         obj_from_json = json.loads(r.content)
 
         resp_url = obj_from_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url.split('/')[-1]
 
         more_get = self.client.get(reverse(statements_more,kwargs={'more_id':resp_id}),
             X_Experience_API_Version=settings.XAPI_VERSION,HTTP_AUTHORIZATION=self.auth)
@@ -9,6 +9,7 @@ from django.conf import settings
 
 from ..models import *
 from ..views import statements
+from ..utils import model_cache
 from ..managers.ActivityManager import ActivityManager
 from adl_lrs.views import register
 
@@ -19,6 +20,7 @@ class StatementManagerTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         self.username = "tester1"
         self.email = "test1@tester.com"
         self.password = "test"
@@ -784,3 +786,89 @@ class StatementManagerTests(TestCase):
         self.assertEqual(acts, 2)
         self.assertIn('true', act1.Activity.activity_definition_crpanswers)
         self.assertIn('true', act2.Activity.activity_definition_crpanswers)
+
+    def test_batch_shared_objects(self):
+        stmts = []
+        for i in range(20):
+            stmts.append({"actor":{"objectType":"Agent","mbox":"mailto:batch%s@adlnet.gov" % (i % 3), "name":"batch%s" % (i % 3)},
+                "verb":{"id": "http://example.com/verbs/batched","display": {"en-US":"batched" if i % 2 else "batched-%s" % i}},
+                "object":{"id":"act:batch/%s" % (i % 4), "definition": {"name": {"en-US":"batch %s" % (i % 4)}}},
+                "context":{"instructor":{"objectType":"Agent","mbox":"mailto:batchinstructor@adlnet.gov"},
+                    "contextActivities":{"parent":[{"id":"act:batch/parent"}, {"id":"act:batch/parent"}],
+                    "grouping":{"id":"act:batch/0"}}}})
+        stmts.append({"actor":{"objectType":"Agent","mbox":"mailto:batch0@adlnet.gov"},
+            "verb":{"id": "http://example.com/verbs/batched","display": {"en-GB":"batched"}},
+            "object":{"objectType":"SubStatement",
+                "actor":{"objectType":"Agent","mbox":"mailto:batchsub@adlnet.gov"},
+                "verb":{"id":"http://example.com/verbs/subbatched"},
+                "object":{"id":"act:batch/1"},
+                "context":{"contextActivities":{"category":[{"id":"act:batch/category"}]}}}})
+        response = self.client.post(reverse(statements), json.dumps(stmts), content_type="application/json",
+            Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+        stmt_ids = json.loads(response.content)
+        self.assertEqual(len(stmt_ids), 21)
+        self.assertEqual(Statement.objects.filter(statement_id__in=stmt_ids).count(), 21)
+
+        # Every statement resolved to the same shared rows
+        self.assertEqual(Verb.objects.filter(verb_id="http://example.com/verbs/batched").count(), 1)
+        verb = Verb.objects.get(verb_id="http://example.com/verbs/batched")
+        self.assertEqual(verb.display, {"en-US":"batched", "en-GB":"batched"})
+        self.assertEqual(Agent.objects.filter(mbox__startswith="mailto:batch").count(), 5)
+        self.assertEqual(Agent.objects.get(mbox="mailto:batch0@adlnet.gov").name, "batch0")
+        self.assertEqual(Activity.objects.filter(activity_id__startswith="act:batch/").count(), 6)
+        self.assertEqual(Activity.objects.get(activity_id="act:batch/2").activity_definition_name, {"en-US":"batch 2"})
+
+        for i, stmt_id in enumerate(stmt_ids[:20]):
+            st = Statement.objects.get(statement_id=stmt_id)
+            self.assertEqual(st.actor.mbox, "mailto:batch%s@adlnet.gov" % (i % 3))
+            self.assertEqual(st.object_activity.activity_id, "act:batch/%s" % (i % 4))
+            self.assertEqual(st.context_instructor.mbox, "mailto:batchinstructor@adlnet.gov")
+            self.assertEqual([a.activity_id for a in st.context_ca_parent.all()], ["act:batch/parent"])
+            self.assertEqual([a.activity_id for a in st.context_ca_grouping.all()], ["act:batch/0"])
+            self.assertEqual(st.full_statement['id'], stmt_id)
+            self.assertEqual(st.authority.mbox, "mailto:%s" % self.email)
+
+        sub = Statement.objects.get(statement_id=stmt_ids[20]).object_substatement
+        self.assertEqual(sub.actor.mbox, "mailto:batchsub@adlnet.gov")
+        self.assertEqual(sub.verb.verb_id, "http://example.com/verbs/subbatched")
+        self.assertEqual(sub.object_activity.activity_id, "act:batch/1")
+        self.assertEqual([a.activity_id for a in sub.context_ca_category.all()], ["act:batch/category"])
+
+    def test_definition_writes_only_on_change(self):
+        def post(display, name):
+            stmt = json.dumps({"actor":{"objectType":"Agent","mbox":"mailto:defcache@adlnet.gov"},
+                "verb":{"id": "http://example.com/verbs/defcached","display": display},
+                "object":{"id":"act:defcache", "definition": {"name": name}}})
+            response = self.client.post(reverse(statements), stmt, content_type="application/json",
+                Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(response.status_code, 200)
+
+        post({"en-US":"cached"}, {"en-US":"cached act"})
+        verb = Verb.objects.get(verb_id="http://example.com/verbs/defcached")
+        act = Activity.objects.get(activity_id="act:defcache")
+        self.assertEqual((verb.version, act.version), (0, 0))
+
+        # Same language maps again leave the rows alone
+        post({"en-US":"cached"}, {"en-US":"cached act"})
+        self.assertEqual(Verb.objects.get(pk=verb.pk).version, 0)
+        self.assertEqual(Activity.objects.get(pk=act.pk).version, 0)
+
+        # Rows changed behind the cached copies are reloaded and merged instead of overwritten
+        Verb.objects.filter(pk=verb.pk).update(display={"en-US":"cached", "fr":"mis en cache"}, version=5)
+        Activity.objects.filter(pk=act.pk).update(activity_definition_name={"en-US":"cached act", "fr":"acte"}, version=2)
+        post({"es":"almacenado"}, {"es":"acto"})
+        verb = Verb.objects.get(pk=verb.pk)
+        act = Activity.objects.get(pk=act.pk)
+        self.assertEqual(verb.display, {"en-US":"cached", "fr":"mis en cache", "es":"almacenado"})
+        self.assertEqual(verb.version, 6)
+        self.assertEqual(act.activity_definition_name, {"en-US":"cached act", "fr":"acte", "es":"acto"})
+        self.assertEqual(act.version, 3)
+
+        # A merge that changes nothing on a stale cached copy still goes by the row's version
+        Verb.objects.filter(pk=verb.pk).update(display={"fr":"mis en cache"}, version=7)
+        post({"es":"almacenado"}, {"es":"acto"})
+        verb = Verb.objects.get(pk=verb.pk)
+        self.assertEqual(verb.display, {"fr":"mis en cache", "es":"almacenado"})
+        self.assertEqual(verb.version, 8)
+        self.assertEqual(Activity.objects.get(pk=act.pk).version, 3)
@@ -1,4 +1,5 @@
 import os
+import shutil
 import json
 import base64
 import uuid
@@ -6,12 +7,13 @@ from datetime import datetime, timedelta
 
 from django.test import TestCase
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.utils.timezone import utc
 
 from ..models import Statement
 from ..views import statements, statements_more
-from ..utils import retrieve_statement
+from ..utils import retrieve_statement, model_cache
 from adl_lrs.views import register
 
 
@@ -22,6 +24,7 @@ class StatementMoreTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         settings.SERVER_STMT_LIMIT=10    
         
         self.username = "auth1"
@@ -342,10 +345,11 @@ class StatementMoreTests(TestCase):
         attach_folder_path = os.path.join(settings.MEDIA_ROOT, "attachment_payloads")
         for the_file in os.listdir(attach_folder_path):
             file_path = os.path.join(attach_folder_path, the_file)
-            try:
+            # Payloads are stored in shard directories
+            if os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+            else:
                 os.unlink(file_path)
-            except Exception, e:
-                raise e
 
     def test_unknown_more_id_url(self):
         moreURLGet = self.client.get(reverse(statements_more,kwargs={'more_id':'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'}),
@@ -425,7 +429,7 @@ class StatementMoreTests(TestCase):
         rsp = sincePostResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url.split('/')[-1]
 
         self.assertIn(self.guid15, rsp)
         self.assertIn(self.guid14, rsp)
@@ -494,7 +498,7 @@ class StatementMoreTests(TestCase):
         rsp = sincePostResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url.split('/')[-1]
 
         self.assertIn(self.guid20, rsp)
         self.assertIn(self.guid19, rsp)
@@ -563,7 +567,7 @@ class StatementMoreTests(TestCase):
         rsp = sinceGetResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url.split('/')[-1]
 
         self.assertEqual(len(resp_json['statements']), 10)
 
@@ -600,7 +604,7 @@ class StatementMoreTests(TestCase):
         more_rsp = moreURLGet.content
         more_json = json.loads(more_rsp)
         more_resp_url = more_json['more']
-        more_resp_id = more_resp_url[-32:]
+        more_resp_id = more_resp_url.split('/')[-1]
 
         self.assertIn(self.guid14, more_rsp)
         self.assertIn(self.guid13, more_rsp)
@@ -669,7 +673,7 @@ class StatementMoreTests(TestCase):
         rsp = sinceGetResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url.split('/')[-1]
 
         self.assertEqual(len(resp_json['statements']), 8)
 
@@ -706,7 +710,7 @@ class StatementMoreTests(TestCase):
         more_rsp = moreURLGet.content
         more_json = json.loads(more_rsp)
         more_resp_url = more_json['more']
-        more_resp_id = more_resp_url[-32:]
+        more_resp_id = more_resp_url.split('/')[-1]
 
         self.assertIn(self.guid16, more_rsp)
         self.assertIn(self.guid15, more_rsp)
@@ -776,7 +780,7 @@ class StatementMoreTests(TestCase):
         rsp = sinceGetResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url.split('/')[-1]
 
         self.assertEqual(len(resp_json['statements']), 10)
 
@@ -813,7 +817,7 @@ class StatementMoreTests(TestCase):
         more_rsp = moreURLGet.content
         more_json = json.loads(more_rsp)
         more_resp_url = more_json['more']
-        more_resp_id = more_resp_url[-32:]
+        more_resp_id = more_resp_url.split('/')[-1]
 
         self.assertIn(self.guid14, more_rsp)
         self.assertIn(self.guid13, more_rsp)
@@ -881,7 +885,7 @@ class StatementMoreTests(TestCase):
         rsp = sinceGetResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url.split('/')[-1]
 
         self.assertEqual(len(resp_json['statements']), 10)        
         self.assertIn(self.guid24, rsp)
@@ -917,7 +921,7 @@ class StatementMoreTests(TestCase):
         more_rsp = moreURLGet.content
         more_json = json.loads(more_rsp)
         more_resp_url = more_json['more']
-        more_resp_id = more_resp_url[-32:]
+        more_resp_id = more_resp_url.split('/')[-1]
 
         self.assertIn(self.guid14, more_rsp)
         self.assertIn(self.guid13, more_rsp)
@@ -987,7 +991,7 @@ class StatementMoreTests(TestCase):
         rsp = sinceGetResponse.content        
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url.split('/')[-1]
 
         self.assertIn(self.guid24, rsp)
         self.assertIn(self.guid23, rsp)
@@ -1022,7 +1026,7 @@ class StatementMoreTests(TestCase):
         more_rsp = moreURLGet.content
         more_json = json.loads(more_rsp)
         more_resp_url = more_json['more']
-        more_resp_id = more_resp_url[-32:]
+        more_resp_id = more_resp_url.split('/')[-1]
 
         self.assertEqual(moreURLGet.status_code, 200)
         self.assertIn(self.guid14, more_rsp)
@@ -1090,7 +1094,7 @@ class StatementMoreTests(TestCase):
         another_more_rsp = anotherMoreURLGet.content
         another_more_json = json.loads(another_more_rsp)
         another_more_resp_url = another_more_json['more']
-        another_more_resp_id = another_more_resp_url[-32:]
+        another_more_resp_id = another_more_resp_url.split('/')[-1]
 
         self.assertEqual(anotherMoreURLGet.status_code, 200)
         self.assertIn(self.guid14, another_more_rsp)
@@ -1158,7 +1162,7 @@ class StatementMoreTests(TestCase):
         self.assertEqual(r.status_code, 200)
         c = r.content        
         sresults = json.loads(c)
-        more = sresults['more'][-32:]
+        more = sresults['more'].split('/')[-1]
         stmts = sresults['statements']
 
         self.assertEqual(len(stmts), 10)
@@ -1178,7 +1182,7 @@ class StatementMoreTests(TestCase):
         self.assertEqual(r.status_code, 200)
         c = r.content        
         sresults = json.loads(c)
-        more = sresults['more'][-32:]
+        more = sresults['more'].split('/')[-1]
         stmts = sresults['statements']
 
         self.assertEqual(len(stmts), 10)
@@ -1213,7 +1217,7 @@ class StatementMoreTests(TestCase):
         self.assertEqual(r.status_code, 200)
         c = r.content        
         sresults = json.loads(c)
-        more = sresults['more'][-32:]
+        more = sresults['more'].split('/')[-1]
         stmts = sresults['statements']
 
         self.assertEqual(len(stmts), 10)
@@ -1233,7 +1237,7 @@ class StatementMoreTests(TestCase):
         self.assertEqual(r.status_code, 200)
         c = r.content        
         sresults = json.loads(c)
-        more = sresults['more'][-32:]
+        more = sresults['more'].split('/')[-1]
         stmts = sresults['statements']
 
         self.assertEqual(len(stmts), 10)
@@ -1260,4 +1264,29 @@ class StatementMoreTests(TestCase):
         self.assertEqual(stmts[1]['id'], self.guid22)
         self.assertEqual(stmts[2]['id'], self.guid23)
         self.assertEqual(stmts[3]['id'], self.guid24)
-        self.assertEqual(stmts[4]['id'], self.guid25)
\ No newline at end of file
+        self.assertEqual(stmts[4]['id'], self.guid25)
+
+    def test_more_cursor_stateless(self):
+        r = self.client.get(reverse(statements), {"limit":10, "format":"ids"},
+            X_Experience_API_Version=settings.XAPI_VERSION,HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200)
+        more = json.loads(r.content)['more'].split('/')[-1]
+
+        # Nothing about the result is kept server side, the cursor carries the filter and position
+        cache.clear()
+        r = self.client.get(reverse(statements_more,kwargs={'more_id':more}),
+            X_Experience_API_Version=settings.XAPI_VERSION,HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200)
+        stmts = json.loads(r.content)['statements']
+        self.assertEqual([s['id'] for s in stmts], [self.guid15, self.guid14, self.guid13, self.guid12, self.guid11,
+            self.guid10, self.guid9, self.guid8, self.guid7, self.guid6])
+
+        # Same cursor gives the same page again
+        again = self.client.get(reverse(statements_more,kwargs={'more_id':more}),
+            X_Experience_API_Version=settings.XAPI_VERSION,HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(json.loads(again.content)['statements'], stmts)
+
+        # Tampered cursors are rejected
+        r = self.client.get(reverse(statements_more,kwargs={'more_id':more[:-1] + ('A' if more[-1] != 'A' else 'B')}),
+            X_Experience_API_Version=settings.XAPI_VERSION,HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 404)
@@ -8,6 +8,7 @@ import hashlib
 from datetime import datetime, timedelta
 
 from django.test import TestCase
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.utils.timezone import utc
 from django.conf import settings
@@ -15,7 +16,7 @@ from django.test.utils import override_settings
 
 from ..models import Statement, Activity, Agent, Verb, SubStatement
 from ..views import statements
-from ..utils import retrieve_statement
+from ..utils import retrieve_statement, req_validate, req_process, model_cache
 from adl_lrs.views import register
 
 class StatementTests(TestCase):
@@ -24,6 +25,7 @@ class StatementTests(TestCase):
         print "\n%s" % __name__
 
     def setUp(self):
+        model_cache.clear_local_caches()
         self.username = "tester1"
         self.email = "test1@tester.com"
         self.password = "test"
@@ -1768,3 +1770,63 @@ class StatementTests(TestCase):
         response = self.client.post(reverse(statements), json.dumps(post_payload), content_type="application/json",
             Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
         self.assertEqual(response.status_code, 200)
+
+    def test_consistent_through(self):
+        stmt = {"verb":{"id": "http://example.com/verbs/passed"},"object": {"id":"act:consistent"}, "actor":{"mbox":"mailto:t@t.com"}}
+        for i in range(2):
+            response = self.client.post(reverse(statements), json.dumps(stmt), content_type="application/json",
+                Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(response.status_code, 200)
+        latest = Statement.objects.latest('stored').stored
+
+        # Header comes from the watermark kept when statements are stored
+        response = self.client.get(reverse(statements), Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Experience-API-Consistent-Through'], str(latest))
+
+        # And is looked up again if the cache loses it
+        cache.clear()
+        response = self.client.get(reverse(statements), Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Experience-API-Consistent-Through'], str(latest))
+
+        # A writer finishing late never moves it back
+        req_process.set_consistent_through(latest - timedelta(seconds=5))
+        self.assertEqual(req_process.get_consistent_through(), latest)
+        # Nor does one that finds the lock taken, and a newer time still goes in once the lock is free
+        cache.add(req_process.CONSISTENT_THROUGH_LOCK_KEY, True)
+        req_process.set_consistent_through(latest - timedelta(seconds=5))
+        self.assertEqual(req_process.get_consistent_through(), latest)
+        cache.delete(req_process.CONSISTENT_THROUGH_LOCK_KEY)
+        req_process.set_consistent_through(latest + timedelta(seconds=5))
+        self.assertEqual(req_process.get_consistent_through(), latest + timedelta(seconds=5))
+
+    def test_batch_validation(self):
+        existing_id = str(uuid.uuid1())
+        stmt = {"id":existing_id, "actor":{"mbox":"mailto:batchval@example.com"},
+            "verb":{"id":"http://example.com/verbs/passed"}, "object":{"id":"act:batchval"}}
+        r = self.client.post(reverse(statements), json.dumps(stmt), content_type="application/json",
+            Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 200)
+
+        new_stmt = {"id":str(uuid.uuid1()), "actor":{"mbox":"mailto:batchval@example.com"},
+            "verb":{"id":"http://example.com/verbs/passed"}, "object":{"id":"act:batchval"}}
+        void_stmt = {"actor":{"mbox":"mailto:batchval@example.com"},
+            "verb":{"id":"http://adlnet.gov/expapi/verbs/voided"},
+            "object":{"objectType":"StatementRef", "id":existing_id}}
+        # Every id and void target in the batch is checked with one query each
+        with self.assertNumQueries(2):
+            req_validate.validate_body([new_stmt, void_stmt, dict(void_stmt)], {'agent':None}, None, "application/json")
+
+        r = self.client.post(reverse(statements), json.dumps([new_stmt, stmt]), content_type="application/json",
+            Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(r.content, "A statement with ID %s already exists" % existing_id)
+
+        r = self.client.post(reverse(statements), json.dumps(void_stmt), content_type="application/json",
+            Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 200)
+        r = self.client.post(reverse(statements), json.dumps([new_stmt, void_stmt]), content_type="application/json",
+            Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.content, "Statement with ID: %s is already voided, cannot unvoid. Please re-issue the statement under a new ID." % existing_id)
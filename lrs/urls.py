@@ -3,7 +3,7 @@ from django.views.generic import RedirectView
 
 urlpatterns = patterns('lrs.views',
     url(r'^$', RedirectView.as_view(url='/')),
-    url(r'^statements/more/(?P<more_id>.{32})$', 'statements_more'),
+    url(r'^statements/more/(?P<more_id>[^/]+)$', 'statements_more'),
     url(r'^statements/more', 'statements_more_placeholder'),
     url(r'^statements', 'statements'),
     url(r'^activities/state', 'activity_state'),
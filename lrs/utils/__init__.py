@@ -2,13 +2,20 @@ import ast
 import json
 import urllib
 import urlparse
+import uuid
 from isodate.isodatetime import parse_datetime
 
+from django.conf import settings
+from django.db import connection, connections, transaction
 from django.db.models import get_models, get_app
 from django.contrib import admin
 from django.contrib.admin.sites import AlreadyRegistered
 
 from ..exceptions import ParamError
+from .etag import create_version_tag
+
+# SQLite refuses statements with more than 999 bound parameters
+SQLITE_MAX_VARIABLES = 999
 
 agent_ifps_can_only_be_one = ['mbox', 'mbox_sha1sum', 'openid', 'account']
 def get_agent_ifp(data):
@@ -74,4 +81,91 @@ def autoregister(*app_list):
             try:
                 admin.site.register(model)
             except AlreadyRegistered:
-                pass    
\ No newline at end of file
+                pass    
+
+def chunks(items, size):
+    # No size (or nothing to split) is a single chunk
+    items = list(items)
+    size = size or len(items) or 1
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+def bulk_batch_size(field_count):
+    # Postgres takes the whole batch in one INSERT, SQLite has to be split up by its parameter limit
+    if connection.vendor == 'sqlite':
+        return max(SQLITE_MAX_VARIABLES / max(field_count, 1), 1)
+    return None
+
+def bulk_create_in_batches(model, objs):
+    objs = list(objs)
+    size = bulk_batch_size(len(model._meta.local_fields)) or len(objs)
+    for batch in chunks(objs, size):
+        model.objects.bulk_create(batch)
+    return objs
+
+def filter_in_batches(queryset, field, values):
+    # Runs field__in lookups in slices small enough for every backend
+    values = list(values)
+    size = bulk_batch_size(1) or len(values)
+    for batch in chunks(values, size):
+        for obj in queryset.filter(**{'%s__in' % field: batch}):
+            yield obj
+
+def delete_in_one_query(queryset):
+    # QuerySet.delete loads every row to run signals and cascades first, for tables with neither one DELETE will do
+    # The filters, joins included, are kept as a subquery on the primary keys
+    qn = connections[queryset.db].ops.quote_name
+    meta = queryset.model._meta
+    subquery, params = queryset.order_by().values('pk').query.sql_with_params()
+    cursor = connections[queryset.db].cursor()
+    cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (qn(meta.db_table), qn(meta.pk.column), subquery), params)
+    transaction.commit_unless_managed(using=queryset.db)
+
+def json_text_column(model, field):
+    # JSONFields are json columns on Postgres 9.3+ which the driver decodes, cast them back to the stored text
+    qn = connection.ops.quote_name
+    column = '%s.%s' % (qn(model._meta.db_table), qn(model._meta.get_field(field).column))
+    if connection.vendor == 'postgresql':
+        return '%s::text' % column
+    return column
+
+def match_iri_hash(queryset, field, value):
+    # IRI columns are indexed by their md5 on PostgreSQL (see lrs.management), so the hash is matched along with
+    # the value for those indexes to be used
+    if connection.vendor != 'postgresql':
+        return queryset
+    qn = connection.ops.quote_name
+    column = '%s.%s' % (qn(queryset.model._meta.db_table), qn(queryset.model._meta.get_field(field).column))
+    return queryset.extra(where=['md5(%s) = md5(%%s)' % column], params=[value])
+
+def jsonb_merge_enabled():
+    # jsonb and its || operator need Postgres 9.5+, so the database merge has to be turned on
+    return settings.DOCUMENT_JSONB_MERGE and connection.vendor == 'postgresql'
+
+def merge_json_document(doc, field, incoming, updated):
+    # Merges the incoming JSON object into a stored state or profile document and bumps its version. The etag is
+    # built from the row and the new version so the merged text is never hashed. The prefix is random so a row
+    # id reused after a delete never repeats an old etag
+    model = type(doc)
+    prefix = '%s:%s:' % (doc.pk, uuid.uuid4().hex)
+    if jsonb_merge_enabled():
+        # Postgres merges under the row lock, the stored document never comes back to Python
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %(table)s SET %(field)s = (%(field)s::jsonb || %%s::jsonb)::text, version = version + 1, "
+                       "etag = md5(%%s || (version + 1)::text), updated = %%s WHERE id = %%s RETURNING version, etag"
+                       % {'table': qn(model._meta.db_table), 'field': qn(model._meta.get_field(field).column)},
+                       [json.dumps(incoming), prefix, updated, doc.pk])
+        doc.version, doc.etag = cursor.fetchone()
+        doc.updated = updated
+        return
+    # Elsewhere the merge happens here and is only written if nobody changed the document since it was read
+    while True:
+        merged = json.dumps(dict(json.loads(getattr(doc, field)).items() + incoming.items()))
+        values = {field: merged, 'version': doc.version + 1, 'etag': create_version_tag(prefix, doc.version + 1),
+                  'updated': updated}
+        if model.objects.filter(pk=doc.pk, version=doc.version).update(**values):
+            for name, value in values.items():
+                setattr(doc, name, value)
+            return
+        doc = model.objects.get(pk=doc.pk)
@@ -8,10 +8,45 @@ from django.contrib.auth.models import User
 
 from ..exceptions import Unauthorized, BadRequest, Forbidden
 from ..models import Agent
+from . import model_cache
 
 from oauth_provider.models import Consumer
 from oauth2_provider.provider.oauth2.models import Client
 
+SCOPE_MASKS = dict((name, value) for value, name in settings.OAUTH_SCOPES)
+
+def build_scope_permissions():
+    # The scopes allowing each method at each endpoint, a token may go ahead if its mask shares a bit with them
+    read = {"/statements": settings.ALL | settings.ALL_READ | settings.STATEMENTS_READ | settings.STATEMENTS_READ_MINE,
+            "/statements/more": settings.ALL | settings.ALL_READ | settings.STATEMENTS_READ | settings.STATEMENTS_READ_MINE,
+            "/activities": settings.ALL | settings.ALL_READ,
+            "/activities/profile": settings.ALL | settings.ALL_READ | settings.PROFILE,
+            "/activities/state": settings.ALL | settings.ALL_READ | settings.STATE,
+            "/agents": settings.ALL | settings.ALL_READ,
+            "/agents/profile": settings.ALL | settings.ALL_READ | settings.PROFILE}
+    write = {"/statements": settings.ALL | settings.STATEMENTS_WRITE,
+             "/activities": settings.ALL | settings.DEFINE,
+             "/activities/profile": settings.ALL | settings.PROFILE,
+             "/activities/state": settings.ALL | settings.STATE,
+             "/agents": settings.ALL | settings.DEFINE,
+             "/agents/profile": settings.ALL | settings.PROFILE}
+    permissions = {}
+    for methods, endpoints in ((('GET', 'HEAD'), read), (('PUT', 'POST', 'DELETE'), write)):
+        for method in methods:
+            for endpoint, mask in endpoints.items():
+                permissions[(method, endpoint)] = mask
+    return permissions
+SCOPE_PERMISSIONS = build_scope_permissions()
+
+def get_scope_mask(token, version=1):
+    # OAuth 2 tokens store the scope as a mask already, OAuth 1 tokens as space separated names
+    if version == 2:
+        return token.scope
+    mask = 0
+    for name in token.scope_to_list():
+        mask |= SCOPE_MASKS.get(name, 0)
+    return mask
+
 # A decorator, that can be used to authenticate some requests at the site.
 def auth(func):
     @wraps(func)
@@ -53,66 +88,44 @@ def get_user_from_auth(auth):
             user = Client.objects.get(client_id__exact=key).user
     return user
 
-def validate_oauth_scope(req_dict):
+def validate_oauth_scope(req_dict, scope_mask):
     method = req_dict['method']
     endpoint = req_dict['auth']['endpoint']
-    token = req_dict['auth']['oauth_token']
-    scopes = token.scope_to_list()
 
     err_msg = "Incorrect permissions to %s at %s" % (str(method), str(endpoint))
 
-    validator = {'GET':{"/statements": True if 'all' in scopes or 'all/read' in scopes or 'statements/read' in scopes or 'statements/read/mine' in scopes else False,
-                    "/statements/more": True if 'all' in scopes or 'all/read' in scopes or 'statements/read' in scopes or 'statements/read/mine' in scopes else False,
-                    "/activities": True if 'all' in scopes or 'all/read' in scopes else False,
-                    "/activities/profile": True if 'all' in scopes or 'all/read' in scopes or 'profile' in scopes else False,
-                    "/activities/state": True if 'all' in scopes or 'all/read' in scopes or 'state' in scopes else False,
-                    "/agents": True if 'all' in scopes or 'all/read' in scopes else False,
-                    "/agents/profile": True if 'all' in scopes or 'all/read' in scopes or 'profile' in scopes else False
-                },
-             'HEAD':{"/statements": True if 'all' in scopes or 'all/read' in scopes or 'statements/read' in scopes or 'statements/read/mine' in scopes else False,
-                    "/statements/more": True if 'all' in scopes or 'all/read' in scopes or 'statements/read' in scopes or 'statements/read/mine' in scopes else False,
-                    "/activities": True if 'all' in scopes or 'all/read' in scopes else False,
-                    "/activities/profile": True if 'all' in scopes or 'all/read' in scopes or 'profile' in scopes else False,
-                    "/activities/state": True if 'all' in scopes or 'all/read' in scopes or 'state' in scopes else False,
-                    "/agents": True if 'all' in scopes or 'all/read' in scopes else False,
-                    "/agents/profile": True if 'all' in scopes or 'all/read' in scopes or 'profile' in scopes else False
-                },   
-             'PUT':{"/statements": True if 'all' in scopes or 'statements/write' in scopes else False,
-                    "/activities": True if 'all' in scopes or 'define' in scopes else False,
-                    "/activities/profile": True if 'all' in scopes or 'profile' in scopes else False,
-                    "/activities/state": True if 'all' in scopes or 'state' in scopes else False,
-                    "/agents": True if 'all' in scopes or 'define' in scopes else False,
-                    "/agents/profile": True if 'all' in scopes or 'profile' in scopes else False
-                },
-             'POST':{"/statements": True if 'all' in scopes or 'statements/write' in scopes else False,
-                    "/activities": True if 'all' in scopes or 'define' in scopes else False,
-                    "/activities/profile": True if 'all' in scopes or 'profile' in scopes else False,
-                    "/activities/state": True if 'all' in scopes or 'state' in scopes else False,
-                    "/agents": True if 'all' in scopes or 'define' in scopes else False,
-                    "/agents/profile": True if 'all' in scopes or 'profile' in scopes else False
-                },
-             'DELETE':{"/statements": True if 'all' in scopes or 'statements/write' in scopes else False,
-                    "/activities": True if 'all' in scopes or 'define' in scopes else False,
-                    "/activities/profile": True if 'all' in scopes or 'profile' in scopes else False,
-                    "/activities/state": True if 'all' in scopes or 'state' in scopes else False,
-                    "/agents": True if 'all' in scopes or 'define' in scopes else False,
-                    "/agents/profile": True if 'all' in scopes or 'profile' in scopes else False
-                }
-             }
-
     # Raise forbidden if requesting wrong endpoint or with wrong method than what's in scope
-    if not validator[method][endpoint]:
+    if not SCOPE_PERMISSIONS.get((method, endpoint), 0) & scope_mask:
         raise Forbidden(err_msg)
 
     # Set flag to read only statements owned by user
-    if 'statements/read/mine' in scopes:
+    if scope_mask & settings.STATEMENTS_READ_MINE:
         req_dict['auth']['statements_mine_only'] = True
 
     # Set flag for define - allowed to update global representation of activities/agents
-    if 'define' in scopes or 'all' in scopes:
-        req_dict['auth']['define'] = True
-    else:
-        req_dict['auth']['define'] = False
+    req_dict['auth']['define'] = bool(scope_mask & (settings.DEFINE | settings.ALL))
+
+def basic_auth_credentials(header, uname, passwd):
+    # A header verified a moment ago skips the password hash and the agent lookup, as long as the user's
+    # stamp shows no password change or deactivation since
+    key = model_cache.get_credential_key(header)
+    cached = model_cache.get_credentials(key)
+    if cached:
+        user_id, agent_id, stamp = cached
+        try:
+            user = User.objects.get(pk=user_id)
+            agent = Agent.objects.get(pk=agent_id)
+        except (User.DoesNotExist, Agent.DoesNotExist):
+            pass
+        else:
+            if model_cache.get_user_stamp(user) == stamp:
+                return user, agent
+    user = authenticate(username=uname, password=passwd)
+    if not user:
+        return None, None
+    agent = Agent.objects.retrieve_or_create(**{'name':user.username, 'mbox':'mailto:%s' % user.email, 'objectType': 'Agent'})[0]
+    model_cache.add_credentials(key, user, agent)
+    return user, agent
 
 def http_auth_helper(request):
     if request['headers'].has_key('Authorization'):
@@ -128,12 +141,12 @@ def http_auth_helper(request):
                     request['auth']['user'] = None
                     request['auth']['agent'] = None
                 elif uname or passwd:
-                    user = authenticate(username=uname, password=passwd)
+                    user, agent = basic_auth_credentials(auth[1], uname, passwd)
                     if user:
                         # If the user successfully logged in, then add/overwrite
                         # the user object of this request.
                         request['auth']['user'] = user
-                        request['auth']['agent'] = Agent.objects.retrieve_or_create(**{'name':user.username, 'mbox':'mailto:%s' % user.email, 'objectType': 'Agent'})[0]
+                        request['auth']['agent'] = agent
                     else:
                         raise Unauthorized("Authorization failed, please verify your username and password")
                 request['auth']['define'] = True
@@ -145,8 +158,33 @@ def http_auth_helper(request):
         # The username/password combo was incorrect, or not provided.
         raise Unauthorized("Authorization header missing")
 
+def get_token_stamp(token, version=1):
+    # A token row edited to another key, scope, user or consumer is resolved again, as is one whose user changed
+    # the name, email or active flag the group is built from
+    user_stamp = model_cache.get_user_stamp(token.user)
+    if version == 1:
+        return (token.key, token.scope, token.user_id, token.consumer_id, user_stamp)
+    return (token.token, token.scope, token.user_id, token.client_id, user_stamp)
+
 def oauth_helper(request, version=1):
     token = request['auth']['oauth_token']
+    # Revoked and expired tokens never get this far, req_parse refuses them before
+    key = model_cache.get_token_key(version, token.pk)
+    stamp = get_token_stamp(token, version)
+    context = model_cache.get_auth_context(key, stamp)
+    if context:
+        # The user is the consumer's owner, the one a fresh resolve finds from the group
+        try:
+            request['auth']['agent'] = Agent.objects.get(pk=context['agent'])
+            request['auth']['user'] = User.objects.get(pk=context['user']) if context['user'] else None
+        except (Agent.DoesNotExist, User.DoesNotExist):
+            context = None
+    if not context:
+        context = resolve_oauth_context(request, token, version)
+        model_cache.add_auth_context(key, stamp, context)
+    validate_oauth_scope(request, context['scope_mask'])
+
+def resolve_oauth_context(request, token, version):
     user = token.user
     user_name = user.username
     if user.email.startswith('mailto:'):
@@ -179,4 +217,5 @@ def oauth_helper(request, version=1):
     oauth_group, created = Agent.objects.oauth_group(**kwargs)
     request['auth']['agent'] = oauth_group
     request['auth']['user'] = get_user_from_auth(oauth_group)
-    validate_oauth_scope(request)
\ No newline at end of file
+    user_id = request['auth']['user'].pk if request['auth']['user'] else None
+    return {'agent': oauth_group.pk, 'user': user_id, 'scope_mask': get_scope_mask(token, version)}
\ No newline at end of file
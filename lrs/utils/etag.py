@@ -26,6 +26,23 @@ def get_etag_info(headers, required=True):
         raise MissingEtagInfo("If-Match and If-None-Match headers were missing. One of these headers is required for this request.")
     return etag
 
+def create_version_tag(prefix, version):
+    # Merged documents get a tag built from the row and its version instead of hashing the whole document
+    return hashlib.md5('%s%s' % (prefix, version)).hexdigest()
+
+def get_none_match(request):
+    try:
+        return request['headers']['ETAG'][IF_NONE_MATCH]
+    except KeyError:
+        return None
+
+def none_match(request, contents):
+    # True when a GET's If-None-Match already names the current version of the document
+    request_etag = get_none_match(request)
+    if not request_etag or not contents.etag:
+        return False
+    return request_etag.strip() == "*" or contents.etag in request_etag
+
 def check_preconditions(request, contents, required=False):
     try:
         request_etag = request['headers']['ETAG']
@@ -0,0 +1,25 @@
+import urllib
+from django.conf import settings
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse
+
+SENDFILE = 'x-sendfile'
+ACCEL_REDIRECT = 'x-accel-redirect'
+
+def file_response(field_file, content_type):
+    # Stat first so a missing file fails the same way in every mode
+    size = field_file.size
+    mode = settings.FILE_OFFLOAD
+    if mode == SENDFILE:
+        # Apache mod_xsendfile reads the file at the absolute path itself
+        response = HttpResponse('', content_type=content_type)
+        response['X-Sendfile'] = field_file.path.encode('utf-8')
+    elif mode == ACCEL_REDIRECT:
+        # nginx maps the internal location onto MEDIA_ROOT
+        response = HttpResponse('', content_type=content_type)
+        response['X-Accel-Redirect'] = settings.FILE_OFFLOAD_URL + urllib.quote(field_file.name.encode('utf-8'))
+    else:
+        field_file.open('rb')
+        response = HttpResponse(FileWrapper(field_file.file, settings.ATTACHMENT_CHUNK_SIZE), content_type=content_type)
+        response['Content-Length'] = str(size)
+    return response
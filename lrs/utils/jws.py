@@ -7,6 +7,8 @@ from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5, PKCS1_PSS
 from Crypto.Util.asn1 import DerSequence
 
+from oauth_provider.utils import import_rsa_key
+
 # https://www.dlitz.net/software/pycrypto/api/current/
 
 fixb64padding = lambda s: s if len(s) % 4 == 0 else s + '=' * (4 - (len(s) % 4))
@@ -55,7 +57,7 @@ class JWS(object):
         if not self.should_verify:
             return True
         try:
-            pubkey = self._cert_to_key(self.headerobj['x5c'][0])
+            pubkey = import_rsa_key(self.headerobj['x5c'][0], self._cert_to_key)
         except:
             raise JWSException("Error importing public key")
         
@@ -163,7 +165,8 @@ class JWS(object):
     def _hash(self):
         return algs[self.headerobj['alg']].new('.'.join([self.encheader,self.encpayload]).encode('ascii'))
         
-    def _cert_to_key(self, cert):
+    @staticmethod
+    def _cert_to_key(cert):
         # Convert from PEM to DER
         if not cert.startswith('-----BEGIN CERTIFICATE-----') and not cert.endswith('-----END CERTIFICATE-----'):
             cert = "-----BEGIN CERTIFICATE-----\n%s\n-----END CERTIFICATE-----" % cert
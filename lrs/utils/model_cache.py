@@ -0,0 +1,239 @@
+import copy
+import cPickle
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+
+AGENT_IFP_FIELDS = [['mbox'], ['mbox_sha1sum'], ['openid'], ['account_homePage', 'account_name']]
+
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return None
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+local_agents = LRUCache(settings.AGENT_CACHE_SIZE)
+# Verbs and activities by IRI along with the time they were cached, these stay in the process only
+local_definitions = {'verb': LRUCache(settings.DEFINITION_CACHE_SIZE),
+                     'activity': LRUCache(settings.DEFINITION_CACHE_SIZE)}
+# Hot JSON documents by document key, each entry holds the etag and content type it was read with
+local_documents = LRUCache(settings.DOCUMENT_CACHE_SIZE)
+# Verified Basic auth headers by keyed hash, each entry holds when it was verified, the user and agent ids and the
+# user's stamp at that time
+local_credentials = LRUCache(settings.CREDENTIAL_CACHE_SIZE)
+# Resolved OAuth contexts by access token, each entry holds when it was resolved, the token's stamp and the group
+# agent id, user id and scope mask it resolved to
+local_auth_contexts = LRUCache(settings.CREDENTIAL_CACHE_SIZE)
+# Rows read during the current request, only cached once the request's transaction has committed
+request_state = threading.local()
+
+def get_ifp_key(ifp_dict):
+    return 'agent:%s' % hashlib.md5(json.dumps(sorted(ifp_dict.items()))).hexdigest()
+
+def get_version_key(key):
+    # Shared version of an IFP's cached agent, every copy of the agent is stored along with it
+    return '%s:version' % key
+
+def in_request():
+    return getattr(request_state, 'pending', None) is not None
+
+def get_agent(ifp_dict):
+    # Lookups outside of a request (celery tasks, managers used directly) always go to the database
+    if not in_request():
+        return None
+    key = get_ifp_key(ifp_dict)
+    version_key = get_version_key(key)
+    # A local copy is only used while its version is still the shared one, an invalidation deletes that
+    entry = local_agents.get(key)
+    if entry is not None and cache.get(version_key) == entry[0]:
+        return cPickle.loads(entry[1])
+    shared = cache.get_many([key, version_key])
+    entry = shared.get(key)
+    if entry is None or entry[0] != shared.get(version_key):
+        local_agents.delete(key)
+        return None
+    local_agents.set(key, entry)
+    return cPickle.loads(entry[1])
+
+def add_agent(ifp_dict, agent):
+    if in_request():
+        request_state.pending.append((local_agents, get_ifp_key(ifp_dict), cPickle.dumps(agent, cPickle.HIGHEST_PROTOCOL)))
+
+def share_agent(key, data):
+    # Joins the shared version if another process already cached the agent, otherwise starts one
+    version_key = get_version_key(key)
+    version = uuid.uuid4().hex
+    if not cache.add(version_key, version):
+        version = cache.get(version_key)
+        if version is None:
+            return
+    local_agents.set(key, (version, data))
+    cache.set(key, (version, data))
+
+def get_agent_keys(agent):
+    keys = set()
+    for fields in AGENT_IFP_FIELDS:
+        ifp_dict = dict((f, getattr(agent, f)) for f in fields)
+        if all(v is not None for v in ifp_dict.values()):
+            keys.add(get_ifp_key(ifp_dict))
+    return keys
+
+def invalidate_agent(agent, previous_keys=()):
+    # previous_keys are the ones the stored row was cached under before a save changed its IFP
+    keys = get_agent_keys(agent) | set(previous_keys)
+    if not keys:
+        return
+    for key in keys:
+        local_agents.delete(key)
+    # Copies other processes hold are refused once the version they were stored with is gone
+    cache.delete_many(list(keys) + [get_version_key(key) for key in keys])
+    if in_request():
+        request_state.pending = [p for p in request_state.pending if not (p[0] is local_agents and p[1] in keys)]
+
+def get_definitions(kind, ids):
+    # Copies of the cached verbs or activities, entries past the timeout are left for the database
+    found = {}
+    if not in_request():
+        return found
+    oldest = time.time() - settings.DEFINITION_CACHE_TIMEOUT
+    for obj_id in ids:
+        entry = local_definitions[kind].get(obj_id)
+        if entry and entry[0] > oldest:
+            found[obj_id] = copy.copy(entry[1])
+    return found
+
+def add_definitions(kind, objs):
+    if in_request():
+        now = time.time()
+        request_state.pending.extend((local_definitions[kind], obj_id, (now, copy.copy(obj)))
+                                     for obj_id, obj in objs.items() if obj.pk)
+
+def get_document(key, etag, content_type):
+    # Entries are checked against the etag and content type just read from the database so they never go stale
+    entry = local_documents.get(key)
+    if entry and entry[0] == etag and entry[1] == content_type:
+        return entry[2]
+    return None
+
+def has_document(key):
+    return bool(settings.DOCUMENT_CACHE_SIZE) and local_documents.get(key) is not None
+
+def add_document(key, etag, content_type, body):
+    if settings.DOCUMENT_CACHE_SIZE and len(body) <= settings.DOCUMENT_CACHE_MAX_LENGTH:
+        local_documents.set(key, (etag, content_type, body))
+
+def get_credential_key(header):
+    # Keyed with the secret so nothing held in memory could be replayed as the header itself
+    return hmac.new(settings.SECRET_KEY, header, hashlib.sha256).hexdigest()
+
+def get_user_stamp(user):
+    # Changes whenever the password, the active flag or the fields the agent is built from change
+    return hashlib.md5(repr((user.password, user.is_active, user.username, user.email))).hexdigest()
+
+def get_credentials(key):
+    if not in_request():
+        return None
+    entry = local_credentials.get(key)
+    if entry and entry[0] > time.time() - settings.CREDENTIAL_CACHE_TIMEOUT:
+        return entry[1:]
+    return None
+
+def add_credentials(key, user, agent):
+    if in_request() and settings.CREDENTIAL_CACHE_TIMEOUT:
+        request_state.pending.append((local_credentials, key, (time.time(), user.pk, agent.pk, get_user_stamp(user))))
+
+def get_token_key(version, token_id):
+    return 'oauth%s:%s' % (version, token_id)
+
+def get_auth_context(key, stamp):
+    if not in_request():
+        return None
+    entry = local_auth_contexts.get(key)
+    if entry and entry[0] > time.time() - settings.CREDENTIAL_CACHE_TIMEOUT and entry[1] == stamp:
+        return entry[2]
+    return None
+
+def add_auth_context(key, stamp, context):
+    if in_request() and settings.CREDENTIAL_CACHE_TIMEOUT:
+        request_state.pending.append((local_auth_contexts, key, (time.time(), stamp, context)))
+
+def invalidate_auth_contexts(key):
+    # A revoked token only drops its own context, other processes refuse the token before looking it up. A changed
+    # user needs nothing here since the user is part of the token's stamp
+    local_auth_contexts.delete(key)
+    if in_request():
+        request_state.pending = [p for p in request_state.pending
+                                 if not (p[0] is local_auth_contexts and p[1] == key)]
+
+def call_after_commit(func, *args):
+    # Shared writes that should not hold up the request's transaction, run straight away outside of a request
+    if in_request():
+        request_state.pending.append((None, func, args))
+    else:
+        func(*args)
+
+def clear_local_caches():
+    # Entries outlive the rows they were read from when a transaction is rolled back after all, as in tests
+    for local in [local_agents, local_documents, local_credentials, local_auth_contexts] + local_definitions.values():
+        local.clear()
+
+def start_request():
+    request_state.pending = []
+
+def finish_request(committed):
+    pending, request_state.pending = request_state.pending, None
+    if committed:
+        for local, key, value in pending:
+            if local is None:
+                key(*value)
+            # Only agents are shared between processes
+            elif local is local_agents:
+                share_agent(key, value)
+            else:
+                local.set(key, value)
+
+def cache_committed_rows(func):
+    # Has to wrap the view outside of its transaction so rows are only cached after they are committed
+    @wraps(func)
+    def inner(*args, **kwargs):
+        start_request()
+        committed = False
+        try:
+            response = func(*args, **kwargs)
+            committed = True
+            return response
+        finally:
+            finish_request(committed)
+    return inner
@@ -0,0 +1,203 @@
+import binascii
+import cgi
+import hashlib
+import quopri
+import re
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.files.base import File
+
+from ..exceptions import BadRequest
+
+CHUNK_SIZE = 64 * 1024
+# Longest header line accepted in a part, anything longer is not a header block
+MAX_HEADER_LINE = 8 * 1024
+WHITESPACE = re.compile(r'\s+')
+
+class Base64Decoder(object):
+    # Decodes base64 that arrives in arbitrary slices, leftover characters wait for the next slice
+    def __init__(self):
+        self.pending = ''
+
+    def decode(self, data):
+        data = self.pending + WHITESPACE.sub('', data)
+        usable = len(data) - len(data) % 4
+        self.pending = data[usable:]
+        try:
+            return binascii.a2b_base64(data[:usable]) if usable else ''
+        except binascii.Error:
+            raise BadRequest("Attachment payload was not valid base64")
+
+    def flush(self):
+        if self.pending.rstrip('='):
+            raise BadRequest("Attachment payload was not valid base64")
+        return ''
+
+class QuotedPrintableDecoder(object):
+    # Soft line breaks can only be decoded with the rest of their line
+    def __init__(self):
+        self.pending = ''
+
+    def decode(self, data):
+        data = self.pending + data
+        end = data.rfind('\n') + 1
+        self.pending = data[end:]
+        return quopri.decodestring(data[:end]) if end else ''
+
+    def flush(self):
+        data, self.pending = self.pending, ''
+        return quopri.decodestring(data)
+
+class IdentityDecoder(object):
+    def decode(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+def get_decoder(headers):
+    encoding = headers.get('content-transfer-encoding', '').strip().lower()
+    if encoding == 'base64':
+        return Base64Decoder()
+    if encoding == 'quoted-printable':
+        return QuotedPrintableDecoder()
+    return IdentityDecoder()
+
+def get_boundary(content_type):
+    return cgi.parse_header(content_type or '')[1].get('boundary', None)
+
+class MultipartPart(object):
+    # A decoded part spooled to memory or disk along with its SHA-256
+    def __init__(self, headers):
+        self.headers = headers
+        self.file = SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        self.sha2 = hashlib.sha256()
+        self.length = 0
+        self.decoder = get_decoder(headers)
+
+    def write(self, data):
+        self.write_decoded(self.decoder.decode(data))
+
+    def close(self):
+        self.write_decoded(self.decoder.flush())
+        self.file.seek(0)
+
+    def write_decoded(self, data):
+        if data:
+            self.file.write(data)
+            self.sha2.update(data)
+            self.length += len(data)
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def hexdigest(self):
+        return self.sha2.hexdigest()
+
+    def as_file(self):
+        content = File(self.file)
+        content.size = self.length
+        return content
+
+class MultipartReader(object):
+    # Reads a multipart body from a stream a chunk at a time. Part bodies are handed to the part as they
+    # come in so only the tail that could still be the start of a delimiter is kept in memory
+    def __init__(self, stream, boundary=None):
+        self.stream = stream
+        # A newline is assumed in front of the body so the first boundary looks like every other delimiter
+        self.buffer = '\n'
+        self.eof = False
+        if not boundary:
+            boundary = self.read_body_boundary()
+        # Lines may end in CRLF or just LF, a CR in front of the delimiter is dropped from the part
+        self.delimiter = '\n--' + boundary
+
+    def fill(self):
+        if self.eof:
+            return False
+        data = self.stream.read(CHUNK_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+    def readline(self):
+        while True:
+            end = self.buffer.find('\n')
+            if end >= 0:
+                line, self.buffer = self.buffer[:end + 1], self.buffer[end + 1:]
+                return line
+            if len(self.buffer) > MAX_HEADER_LINE or not self.fill():
+                line, self.buffer = self.buffer, ''
+                return line
+
+    def read_headers(self):
+        headers = {}
+        name = None
+        while True:
+            line = self.readline()
+            if len(line) > MAX_HEADER_LINE:
+                raise BadRequest("Multipart header line was too long")
+            stripped = line.rstrip('\r\n')
+            if not stripped:
+                return headers
+            # Folded header lines continue the one before
+            if stripped[0] in ' \t' and name:
+                headers[name] += ' ' + stripped.strip()
+            elif ':' in stripped:
+                name, value = stripped.split(':', 1)
+                name = name.strip().lower()
+                headers[name] = value.strip()
+
+    def read_body_boundary(self):
+        # Some clients send the multipart headers in the body instead of the Content-Type header
+        self.buffer = ''
+        boundary = get_boundary(self.read_headers().get('content-type', None))
+        if not boundary:
+            raise BadRequest("Could not find the boundary for the multipart content")
+        self.buffer = '\n' + self.buffer
+        return boundary
+
+    def read_until_delimiter(self, write):
+        # Feeds everything up to the next delimiter to write, returns False if the body ran out first
+        keep = len(self.delimiter)
+        while True:
+            end = self.buffer.find(self.delimiter)
+            if end >= 0:
+                data = self.buffer[:end]
+                if data.endswith('\r'):
+                    data = data[:-1]
+                write(data)
+                self.buffer = self.buffer[end + len(self.delimiter):]
+                return True
+            if len(self.buffer) > keep:
+                write(self.buffer[:-keep])
+                self.buffer = self.buffer[-keep:]
+            if not self.fill():
+                return False
+
+    def read_delimiter_end(self):
+        # Returns True when the delimiter closed the body
+        while len(self.buffer) < 2 and self.fill():
+            pass
+        if self.buffer.startswith('--'):
+            return True
+        self.readline()
+        return False
+
+    def __iter__(self):
+        # Anything before the first boundary is preamble
+        if not self.read_until_delimiter(lambda data: None) or self.read_delimiter_end():
+            return
+        while True:
+            part = MultipartPart(self.read_headers())
+            found = self.read_until_delimiter(part.write)
+            part.close()
+            if not found:
+                raise BadRequest("Multipart content ended before its closing boundary")
+            yield part
+            if self.read_delimiter_end():
+                return
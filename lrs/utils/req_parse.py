@@ -1,16 +1,14 @@
-import email
 import urllib
 import json
 import itertools
-from base64 import b64decode, b64encode
 from isodate.isoerror import ISO8601Error
 from isodate.isodatetime import parse_datetime
 
-from django.core.cache import get_cache
 from django.http import QueryDict
 
 from . import convert_to_datatype, convert_post_body_to_dict
 from etag import get_etag_info
+from multipart import MultipartReader, get_boundary
 from jws import JWS, JWSException
 from ..exceptions import OauthUnauthorized, OauthBadRequest, ParamError, BadRequest
 
@@ -19,8 +17,6 @@ from oauth_provider.decorators import CheckOauth
 from oauth_provider.store import store
 from oauth2_provider.provider.oauth2.models import AccessToken
 
-att_cache = get_cache('attachment_cache')  
-
 def parse(request, more_id=None):
     # Parse request into body, headers, and params
     r_dict = {}
@@ -224,60 +220,48 @@ def parse_normal_request(request, r_dict):
     set_agent_param(r_dict)
 
 def parse_attachment(request, r_dict):
-    # Email library insists on having the multipart header in the body - workaround
-    message = request.body
-    if 'boundary' not in message[:message.index("--")]:
-        if 'boundary' in r_dict['headers']['CONTENT_TYPE']:
-            message = "Content-Type:" + r_dict['headers']['CONTENT_TYPE'] + "\r\n" + message
-        else:
-            raise BadRequest("Could not find the boundary for the multipart content")
-
-    msg = email.message_from_string(message)
-    if msg.is_multipart():
-        parts = msg.get_payload()
-        stmt_part = parts.pop(0)
-        if stmt_part['Content-Type'] != "application/json":
-            raise ParamError("Content-Type of statement was not application/json")
-
-        try:
-            r_dict['body'] = json.loads(stmt_part.get_payload())
-        except Exception:
-            raise ParamError("Statement was not valid JSON")
+    # Parts are read off the request stream and spooled one at a time, the boundary can also be given in
+    # a header block at the top of the body
+    parts = MultipartReader(request, get_boundary(r_dict['headers']['CONTENT_TYPE']))
+    stmt_part = None
+    payloads = {}
+    for part in parts:
+        if stmt_part is None:
+            stmt_part = part
+            continue
+        xhash = part.headers.get('x-experience-api-hash', None)
+        if not xhash:
+            raise BadRequest("X-Experience-API-Hash header was missing from attachment")
+        if part.hexdigest() != xhash:
+            raise BadRequest("Attachment payload did not match its X-Experience-API-Hash: %s" % xhash)
+        payloads[xhash] = part
+    if stmt_part is None:
+        raise ParamError("This content was not multipart for the multipart request.")
 
-        # Find the signature sha2 from the list attachment values in the statements (there should only be one)
-        if isinstance(r_dict['body'], list):
-            signature_att = list(itertools.chain(*[[a.get('sha2', None) for a in s['attachments'] if a.get('usageType', None) == "http://adlnet.gov/expapi/attachments/signature"] for s in r_dict['body'] if 'attachments' in s]))
-        else:        
-            signature_att = [a.get('sha2', None) for a in r_dict['body']['attachments'] if a.get('usageType', None) == "http://adlnet.gov/expapi/attachments/signature" and 'attachments' in r_dict['body']]
+    if stmt_part.headers.get('content-type', None) != "application/json":
+        raise ParamError("Content-Type of statement was not application/json")
+    try:
+        r_dict['body'] = json.loads(stmt_part.read())
+    except Exception:
+        raise ParamError("Statement was not valid JSON")
 
-        # Get all sha2s from the request
-        payload_sha2s = [p.get('X-Experience-API-Hash', None) for p in msg.get_payload()]
-        # Check each sha2 in payload, if even one of them is None then there is a missing hash
-        for sha2 in payload_sha2s:
-            if not sha2:
-                raise BadRequest("X-Experience-API-Hash header was missing from attachment")
+    # Find the signature sha2 from the list attachment values in the statements (there should only be one)
+    if isinstance(r_dict['body'], list):
+        signature_att = list(itertools.chain(*[[a.get('sha2', None) for a in s['attachments'] if a.get('usageType', None) == "http://adlnet.gov/expapi/attachments/signature"] for s in r_dict['body'] if 'attachments' in s]))
+    else:        
+        signature_att = [a.get('sha2', None) for a in r_dict['body']['attachments'] if a.get('usageType', None) == "http://adlnet.gov/expapi/attachments/signature" and 'attachments' in r_dict['body']]
 
-        # Check the sig sha2 in statements if it not in the payload sha2s then the sig sha2 is missing
-        for sig in signature_att:
-            if sig:
-                if sig not in payload_sha2s:
-                    raise BadRequest("Signature attachment is missing from request")
-            else:
-                raise BadRequest("Signature attachment is missing from request")   
+    # Check the sig sha2 in statements if it not in the payload sha2s then the sig sha2 is missing
+    for sig in signature_att:
+        if sig:
+            if sig not in payloads:
+                raise BadRequest("Signature attachment is missing from request")
+        else:
+            raise BadRequest("Signature attachment is missing from request")   
 
-        # We know all sha2s are there so set it and loop through each payload
-        r_dict['payload_sha2s'] = payload_sha2s
-        for part in msg.get_payload():
-            xhash = part.get('X-Experience-API-Hash')
-            c_type = part['Content-Type']
-            # Payloads are base64 encoded implictly from email lib (except for plaintext)
-            if "text/plain" in c_type:
-                payload = b64encode(part.get_payload())
-            else:
-                payload = part.get_payload()
-            att_cache.set(xhash, payload)
-    else:
-        raise ParamError("This content was not multipart for the multipart request.")
+    # We know all sha2s are there and match their payloads, the spooled payloads are saved with the statements
+    r_dict['payload_sha2s'] = payloads.keys()
+    r_dict['payloads'] = payloads
     # See if the posted statements have attachments
     att_stmts = []
     if isinstance(r_dict['body'], list):
@@ -290,8 +274,7 @@ def parse_attachment(request, r_dict):
         # find if any of those statements with attachments have a signed statement
         signed_stmts = [(s,a) for s in att_stmts for a in s.get('attachments', None) if a['usageType'] == "http://adlnet.gov/expapi/attachments/signature"]
         for ss in signed_stmts:
-            attmnt = b64decode(att_cache.get(ss[1]['sha2']))
-            jws = JWS(jws=attmnt)
+            jws = JWS(jws=payloads[ss[1]['sha2']].read())
             try:
                 if not jws.verify() or not jws.validate(ss[0]):
                     raise BadRequest("The JSON Web Signature is not valid")
@@ -1,22 +1,64 @@
+import base64
 import json
 import uuid
 import copy
-from base64 import b64decode
+import time
 from datetime import datetime
 
-from django.http import HttpResponse, HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseNotModified
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.timezone import utc
 
+from . import convert_to_utc, etag, model_cache
+from .file_response import file_response
 from retrieve_statement import complex_get, parse_more_request
-from ..models import Statement, Agent, Activity
+from ..models import Statement, StatementAttachment, Agent, Activity
 from ..managers.ActivityProfileManager import ActivityProfileManager
 from ..managers.ActivityStateManager import ActivityStateManager 
 from ..managers.AgentProfileManager import AgentProfileManager
 from ..managers.StatementManager import StatementManager
 from ..tasks import check_activity_metadata, void_statements
 
-def process_statement(stmt, auth, version, payload_sha2s):
+# Cache key for the stored time of the newest statement, used for the X-Experience-API-Consistent-Through header
+CONSISTENT_THROUGH_KEY = 'lrs_consistent_through'
+# Held while the watermark is compared and set so two writers can't put an older time back
+CONSISTENT_THROUGH_LOCK_KEY = 'lrs_consistent_through_lock'
+CONSISTENT_THROUGH_LOCK_TIMEOUT = 5
+CONSISTENT_THROUGH_RETRIES = 5
+
+def set_consistent_through(stored):
+    # Only ever move the watermark forward - the first writer adds it, later ones compare and set under the lock
+    if cache.add(CONSISTENT_THROUGH_KEY, stored):
+        return
+    for attempt in range(CONSISTENT_THROUGH_RETRIES):
+        if cache.add(CONSISTENT_THROUGH_LOCK_KEY, True, CONSISTENT_THROUGH_LOCK_TIMEOUT):
+            try:
+                current = cache.get(CONSISTENT_THROUGH_KEY)
+                if current is None or stored > current:
+                    cache.set(CONSISTENT_THROUGH_KEY, stored)
+            finally:
+                cache.delete(CONSISTENT_THROUGH_LOCK_KEY)
+            return
+        # Whoever holds the lock may already have moved it past this time
+        current = cache.get(CONSISTENT_THROUGH_KEY)
+        if current is not None and current >= stored:
+            return
+        time.sleep(0.01 * (attempt + 1))
+    # Still locked - leaving the watermark behind is safe, it only claims less than is stored
+
+def get_consistent_through():
+    stored = cache.get(CONSISTENT_THROUGH_KEY)
+    # Cache could have expired or been cleared - look it up once and keep it again
+    if stored is None:
+        try:
+            stored = Statement.objects.latest('stored').stored
+        except Statement.DoesNotExist:
+            return datetime.now()
+        set_consistent_through(stored)
+    return stored
+
+def prepare_statement(stmt, version):
     # Add id to statement if not present
     if not 'id' in stmt:
         stmt['id'] = str(uuid.uuid1())
@@ -45,19 +87,21 @@ def process_statement(stmt, auth, version, payload_sha2s):
     if not 'timestamp' in stmt:
         stmt['timestamp'] = stmt['stored']
 
-    # Copy full statement and send off to StatementManager to save
+    # Copy full statement for when returning exact statements
     stmt['full_statement'] = copy.deepcopy(stmt)
-    st = StatementManager(stmt, auth, payload_sha2s).model_object
-
-    if stmt['verb'].verb_id == 'http://adlnet.gov/expapi/verbs/voided':
-        return st.statement_id, st.object_statementref
-    return st.statement_id, None
-
-def process_body(stmts, auth, version, payload_sha2s):
-    return [process_statement(st, auth, version, payload_sha2s) for st in stmts]
+    return stmt
+
+def process_body(stmts, auth, version, payloads):
+    # Send the whole batch off to StatementManager to save
+    stmts = [prepare_statement(st, version) for st in stmts]
+    stmt_objects = StatementManager(stmts, auth, payloads).model_objects
+    # Stored times are ISO 8601 UTC strings so the greatest one is the newest
+    # Moved once the statements are committed, outside of the request's transaction
+    model_cache.call_after_commit(set_consistent_through, convert_to_utc(max(st['stored'] for st in stmts)))
+    return [(st.statement_id, st.object_statementref if st.verb.verb_id == 'http://adlnet.gov/expapi/verbs/voided' else None) \
+        for st in stmt_objects]
 
 def process_complex_get(req_dict):
-    mime_type = "application/json"
     # Parse out params into single dict-GET data not in body
     param_dict = {}
     try:
@@ -93,25 +137,19 @@ def process_complex_get(req_dict):
         attachments = False
 
     # Create returned stmt list from the req dict
-    stmt_result = complex_get(param_dict, limit, language, format, attachments)
-    
-    # Get the length of the response - make sure in string format to count every character
-    if isinstance(stmt_result, dict):
-        content_length = len(json.dumps(stmt_result))
-    else:
-        content_length = len(stmt_result)
+    pieces, content_length, stmt_ids = complex_get(param_dict, limit, language, format, attachments)
+    return build_stmt_result_response(pieces, content_length, stmt_ids, attachments)
 
+def build_stmt_result_response(pieces, content_length, stmt_ids, attachments):
+    mime_type = "application/json"
     # If attachments=True in req_dict then include the attachment payload and return different mime type
     if attachments:
-        stmt_result, mime_type, content_length = build_response(stmt_result)
-        resp = HttpResponse(stmt_result, content_type=mime_type, status=200)
-    # Else attachments are false for the complex get so just dump the stmt_result
-    else:
-        if isinstance(stmt_result, dict):
-            stmt_result = json.dumps(stmt_result)
-
-        resp = HttpResponse(stmt_result, content_type=mime_type, status=200)    
-    return resp, content_length
+        payloads = get_attachment_payloads(stmt_ids)
+        # Has attachments but no payloads so just send the stmt_result
+        if payloads:
+            body, mime_type, content_length = build_response(pieces, content_length, payloads)
+            return HttpResponse(body, content_type=mime_type, status=200), content_length
+    return HttpResponse(iter(pieces), content_type=mime_type, status=200), content_length
 
 def statements_post(req_dict):
     auth = req_dict['auth']
@@ -121,7 +159,7 @@ def statements_post(req_dict):
     else:
         body = req_dict['body']
 
-    stmt_responses = process_body(body, auth, req_dict['headers']['X-Experience-API-Version'], req_dict.get('payload_sha2s', None))
+    stmt_responses = process_body(body, auth, req_dict['headers']['X-Experience-API-Version'], req_dict.get('payloads', None))
     stmt_ids = [stmt_tup[0] for stmt_tup in stmt_responses]
     stmts_to_void = [stmt_tup[1] for stmt_tup in stmt_responses if stmt_tup[1]]
     check_activity_metadata.delay(stmt_ids)
@@ -132,7 +170,7 @@ def statements_post(req_dict):
 def statements_put(req_dict):
     auth = req_dict['auth']
     # Since it is single stmt put in list
-    stmt_responses = process_body([req_dict['body']], auth, req_dict['headers']['X-Experience-API-Version'], req_dict.get('payload_sha2s', None))
+    stmt_responses = process_body([req_dict['body']], auth, req_dict['headers']['X-Experience-API-Version'], req_dict.get('payloads', None))
     stmt_ids = [stmt_tup[0] for stmt_tup in stmt_responses]
     stmts_to_void = [stmt_tup[1] for stmt_tup in stmt_responses if stmt_tup[1]]
     check_activity_metadata.delay(stmt_ids)
@@ -141,30 +179,11 @@ def statements_put(req_dict):
     return HttpResponse("No Content", status=204)
 
 def statements_more_get(req_dict):
-    stmt_result, attachments = parse_more_request(req_dict['more_id'])     
-
-    if isinstance(stmt_result, dict):
-        content_length = len(json.dumps(stmt_result))
-    else:
-        content_length = len(stmt_result)
-    mime_type = "application/json"
+    (pieces, content_length, stmt_ids), attachments = parse_more_request(req_dict['more_id'])
+    resp, content_length = build_stmt_result_response(pieces, content_length, stmt_ids, attachments)
 
-    # If there are attachments, include them in the payload
-    if attachments:
-        stmt_result, mime_type, content_length = build_response(stmt_result)
-        resp = HttpResponse(stmt_result, content_type=mime_type, status=200)
-    # If not, just dump the stmt_result
-    else:
-        if isinstance(stmt_result, basestring):
-            resp = HttpResponse(stmt_result, content_type=mime_type, status=200)
-        else:
-            resp = HttpResponse(json.dumps(stmt_result), content_type=mime_type, status=200)
-    
     # Add consistent header and set content-length
-    try:
-        resp['X-Experience-API-Consistent-Through'] = str(Statement.objects.latest('stored').stored)
-    except:
-        resp['X-Experience-API-Consistent-Through'] = str(datetime.now())
+    resp['X-Experience-API-Consistent-Through'] = str(get_consistent_through())
     resp['Content-Length'] = str(content_length)
     
     # If it's a HEAD request
@@ -192,10 +211,7 @@ def statements_get(req_dict):
         resp, content_length = process_complex_get(req_dict)
         
     # Set consistent through and content length headers for all responses
-    try:
-        resp['X-Experience-API-Consistent-Through'] = str(Statement.objects.latest('stored').stored)
-    except:
-        resp['X-Experience-API-Consistent-Through'] = str(datetime.now())
+    resp['X-Experience-API-Consistent-Through'] = str(get_consistent_through())
     
     resp['Content-Length'] = str(content_length) 
 
@@ -205,62 +221,85 @@ def statements_get(req_dict):
 
     return resp
 
-def build_response(stmt_result):
-    sha2s = []
-    mime_type = "application/json"
-    if isinstance(stmt_result, dict):
-        statements = stmt_result['statements']
-    else:
-        statements = json.loads(stmt_result)['statements']
-
-    # Iterate through each attachment in each statement
-    for stmt in statements:
-        if 'attachments' in stmt:
-            st_atts = Statement.objects.get(statement_id=stmt['id']).stmt_attachments
-            if st_atts:
-                for att in st_atts.all():
-                    if att.payload:
-                        sha2s.append((att.sha2, att.payload, att.contentType))
-    # If attachments have payloads
-    if sha2s:
-        # Create multipart message and attach json message to it
-        string_list =[]
-        line_feed = "\r\n"
-        boundary = "======ADL_LRS======"
-        string_list.append(line_feed + "--" + boundary + line_feed)
-        string_list.append("Content-Type:application/json" + line_feed + line_feed)
-        if isinstance(stmt_result, dict):
-            string_list.append(json.dumps(stmt_result) + line_feed)
+def get_attachment_payloads(stmt_ids):
+    # Payloads of every attachment on the page in one query, in statement order and each sha2 only once
+    order = dict((stmt_id, i) for i, stmt_id in enumerate(stmt_ids))
+    atts = StatementAttachment.objects.filter(statement__statement_id__in=stmt_ids).exclude(payload='') \
+        .exclude(payload=None).order_by('id').values_list('statement__statement_id', 'sha2', 'contentType', 'payload')
+    payloads = []
+    seen = set()
+    for stmt_id, sha2, content_type, name in sorted(atts, key=lambda att: order[att[0]]):
+        if sha2 not in seen:
+            seen.add(sha2)
+            payloads.append((sha2, content_type, name))
+    return payloads
+
+def stream_multipart(pieces, storage, chunk_size):
+    # Strings are written as they are, the statement result as it is built and payload names are read from
+    # storage a chunk at a time
+    for piece in pieces:
+        if isinstance(piece, basestring):
+            yield piece
+        elif not isinstance(piece, tuple):
+            for stmt_piece in piece:
+                yield stmt_piece
         else:
-            string_list.append(stmt_result + line_feed)
-        
-        for sha2 in sha2s:
-            string_list.append("--" + boundary + line_feed)
-            string_list.append("Content-Type:%s" % str(sha2[2]) + line_feed)
-            string_list.append("Content-Transfer-Encoding:binary" + line_feed)
-            string_list.append("X-Experience-API-Hash:" + str(sha2[0]) + line_feed + line_feed)
-
-            chunks = []
+            payload = storage.open(piece[0])
             try:
-                # Default chunk size is 64kb
-                for chunk in sha2[1].chunks():
-                    decoded_data = b64decode(chunk)
-                    chunks.append(decoded_data)
-            except OSError:
-                raise OSError(2, "No such file or directory", sha2[1].name.split("/")[1])
-            string_list.append("".join(chunks) + line_feed)
-        
-        string_list.append("--" + boundary + "--") 
-        mime_type = "multipart/mixed; boundary=" + boundary
-        attachment_body = "".join([s for s in string_list])
-        return attachment_body, mime_type, len(attachment_body)
-    # Has attachments but no payloads so just dump the stmt_result
+                for chunk in payload.chunks(chunk_size):
+                    yield chunk
+            finally:
+                payload.close()
+
+def build_response(stmt_pieces, stmt_length, payloads):
+    # Lays out the multipart body without reading any payload, the length comes from the stored file sizes
+    storage = StatementAttachment._meta.get_field('payload').storage
+    line_feed = "\r\n"
+    boundary = "======ADL_LRS======"
+    pieces = [line_feed + "--" + boundary + line_feed, "Content-Type:application/json" + line_feed + line_feed]
+    pieces.append(stmt_pieces)
+    pieces.append(line_feed)
+    content_length = stmt_length
+    for sha2, content_type, name in payloads:
+        pieces.append("--" + boundary + line_feed + "Content-Type:%s" % str(content_type) + line_feed +
+                      "Content-Transfer-Encoding:binary" + line_feed + "X-Experience-API-Hash:" + str(sha2) +
+                      line_feed + line_feed)
+        try:
+            content_length += storage.size(name)
+        except OSError:
+            raise OSError("Could not find the payload file for attachment %s" % sha2)
+        pieces.append((name,))
+        pieces.append(line_feed)
+    pieces.append("--" + boundary + "--")
+    content_length += sum(len(piece) for piece in pieces if isinstance(piece, basestring))
+    mime_type = "multipart/mixed; boundary=" + boundary
+    return stream_multipart(pieces, storage, settings.ATTACHMENT_CHUNK_SIZE), mime_type, content_length
+
+def document_get(req_dict, key, get_document, file_field, json_field):
+    # When a client sends If-None-Match or the document is cached the etag is looked at before the JSON column
+    # is read, so an unchanged document is answered without loading it. Otherwise the row is read in one go
+    if etag.get_none_match(req_dict) or model_cache.has_document(key):
+        resource = get_document(defer=(json_field,))
+        if etag.none_match(req_dict, resource):
+            response = HttpResponseNotModified()
+        elif getattr(resource, file_field):
+            response = file_response(getattr(resource, file_field), resource.content_type)
+        else:
+            body = model_cache.get_document(key, resource.etag, resource.content_type)
+            if body is None:
+                body = getattr(resource, json_field)
+                model_cache.add_document(key, resource.etag, resource.content_type, body)
+            response = HttpResponse(body, content_type=resource.content_type)
     else:
-        if isinstance(stmt_result, dict):
-            res = json.dumps(stmt_result)
-            return res, mime_type, len(res)
+        resource = get_document()
+        if getattr(resource, file_field):
+            response = file_response(getattr(resource, file_field), resource.content_type)
         else:
-            return stmt_result, mime_type, len(stmt_result)
+            body = getattr(resource, json_field)
+            model_cache.add_document(key, resource.etag, resource.content_type, body)
+            response = HttpResponse(body, content_type=resource.content_type)
+    response['ETag'] = '"%s"' % resource.etag
+    return response
 
 def activity_state_post(req_dict):
     # test ETag for concurrency
@@ -278,6 +317,20 @@ def activity_state_put(req_dict):
     actstate.put_state(req_dict)
     return HttpResponse("", status=204)
 
+def state_document(state):
+    # JSON documents are sent as their stored text so the etag still matches, anything else is base64 encoded
+    document = {'contentType': state.content_type, 'etag': '"%s"' % state.etag}
+    if state.state:
+        state.state.open('rb')
+        try:
+            document['content'] = base64.b64encode(state.state.read())
+        finally:
+            state.state.close()
+        document['encoding'] = 'base64'
+    else:
+        document['content'] = state.json_state
+    return document
+
 def activity_state_get(req_dict):
     # add ETag for concurrency
     state_id = req_dict['params'].get('stateId', None)
@@ -291,12 +344,14 @@ def activity_state_get(req_dict):
         actstate = ActivityStateManager(a)
         # state id means we want only 1 item
         if state_id:
-            resource = actstate.get_state(activity_id, registration, state_id)
-            if resource.state:
-                response = HttpResponse(resource.state.read(), content_type=resource.content_type)
-            else:
-                response = HttpResponse(resource.json_state, content_type=resource.content_type)
-            response['ETag'] = '"%s"' % resource.etag
+            key = ('state', a.id, activity_id, registration, state_id)
+            response = document_get(req_dict, key, lambda **kwargs: actstate.get_state(activity_id, registration, state_id, **kwargs),
+                'state', 'json_state')
+        # Extension - several states in one response, each with its own etag
+        elif 'stateIds' in req_dict['params']:
+            states = actstate.get_states(activity_id, registration, req_dict['params']['stateIds'])
+            response = HttpResponse(json.dumps(dict((s.state_id, state_document(s)) for s in states)),
+                content_type="application/json")
         # no state id means we want an array of state ids
         else:
             since = req_dict['params'].get('since', None)
@@ -343,15 +398,12 @@ def activity_profile_get(req_dict):
     
     #If the profileId exists, get the profile and return it in the response
     if profileId:
-        resource = ap.get_profile(profileId, activityId)
-        if resource.profile:
-            try:
-                response = HttpResponse(resource.profile.read(), content_type=resource.content_type)
-            except IOError:
-                response = HttpResponseNotFound("Error reading file, could not find: %s" % profileId)
-        else:
-            response = HttpResponse(resource.json_profile, content_type=resource.content_type)            
-        response['ETag'] = '"%s"' % resource.etag
+        key = ('activity_profile', activityId, profileId)
+        try:
+            response = document_get(req_dict, key, lambda **kwargs: ap.get_profile(profileId, activityId, **kwargs),
+                'profile', 'json_profile')
+        except EnvironmentError:
+            response = HttpResponseNotFound("Error reading file, could not find: %s" % profileId)
         return response
 
     #Return IDs of profiles stored since profileId was not submitted
@@ -414,13 +466,9 @@ def agent_profile_get(req_dict):
 
         profileId = req_dict['params'].get('profileId', None) if 'params' in req_dict else None
         if profileId:
-            resource = ap.get_profile(profileId)
-            if resource.profile:
-                response = HttpResponse(resource.profile.read(), content_type=resource.content_type)
-            else:
-                response = HttpResponse(resource.json_profile, content_type=resource.content_type)            
-            response['ETag'] = '"%s"' % resource.etag
-            return response
+            key = ('agent_profile', a.id, profileId)
+            return document_get(req_dict, key, lambda **kwargs: ap.get_profile(profileId, **kwargs),
+                'profile', 'json_profile')
 
         since = req_dict['params'].get('since', None) if 'params' in req_dict else None
         resource = ap.get_profile_ids(since)
@@ -444,8 +492,7 @@ def agent_profile_delete(req_dict):
     return HttpResponse('', status=204)
 
 def agents_get(req_dict):
-    a = Agent.objects.get(**req_dict['agent_ifp'])    
-    agent_data = json.dumps(a.to_dict_person(), sort_keys=False)
+    agent_data = json.dumps(req_dict['agent'].to_dict_person(), sort_keys=False)
     resp = HttpResponse(agent_data, mimetype="application/json")
     resp['Content-Length'] = str(len(agent_data))
     # If it's a HEAD request
@@ -2,15 +2,22 @@ import json
 from isodate.isodatetime import parse_datetime
 from isodate.isoerror import ISO8601Error
 
-from . import get_agent_ifp
+from . import get_agent_ifp, filter_in_batches
 from authorization import auth
 from StatementValidator import StatementValidator
 
 from ..models import Statement, Agent, Activity, ActivityState, ActivityProfile, AgentProfile
 from ..exceptions import ParamConflict, ParamError, Forbidden, NotFound, BadRequest, IDNotFoundError
 
-def check_for_existing_statementId(stmtID):
-    return Statement.objects.filter(statement_id=stmtID).exists()
+def get_existing_statement_ids(stmt_ids):
+    return set(filter_in_batches(Statement.objects.values_list('statement_id', flat=True), 'statement_id', stmt_ids))
+
+def get_void_targets(void_ids):
+    # Voided flags of the statements with each targeted id
+    targets = {}
+    for stmt_id, voided in filter_in_batches(Statement.objects.values_list('statement_id', 'voided'), 'statement_id', void_ids):
+        targets.setdefault(stmt_id, []).append(voided)
+    return targets
 
 def check_for_no_other_params_supplied(query_dict):
     supplied = True
@@ -36,14 +43,13 @@ def validate_oauth_state_or_profile_agent(req_dict, endpoint):
             err_msg = "Authorization doesn't match agent in %s" % endpoint
             raise Forbidden(err_msg)
 
-def validate_void_statement(void_id):
+def validate_void_statement(void_id, voided_flags):
     # Retrieve statement, check if the verb is 'voided' - if not then set the voided flag to true else return error 
     # since you cannot unvoid a statement and should just reissue the statement under a new ID.
-    stmts = Statement.objects.filter(statement_id=void_id)
-    if len(stmts) > 1:
-        raise IDNotFoundError("Something went wrong. %s statements found with id %s" % (len(stmts), void_id))
-    elif len(stmts) == 1:
-        if stmts[0].voided:
+    if len(voided_flags) > 1:
+        raise IDNotFoundError("Something went wrong. %s statements found with id %s" % (len(voided_flags), void_id))
+    elif len(voided_flags) == 1:
+        if voided_flags[0]:
             err_msg = "Statement with ID: %s is already voided, cannot unvoid. Please re-issue the statement under a new ID." % void_id
             raise BadRequest(err_msg)
             
@@ -59,17 +65,23 @@ def validate_stmt_authority(stmt, auth):
                 raise ParamError(err_msg)
 
 def validate_body(body, auth, payload_sha2s, content_type):
-        [server_validate_statement(stmt, auth, payload_sha2s, content_type) for stmt in body]
+    # Existing ids and void targets are looked up for the whole batch, then each statement is checked in order
+    existing_ids = get_existing_statement_ids(stmt['id'] for stmt in body if 'id' in stmt)
+    void_targets = get_void_targets(stmt['object']['id'] for stmt in body
+                                    if stmt['verb']['id'] == 'http://adlnet.gov/expapi/verbs/voided')
+    for stmt in body:
+        server_validate_statement(stmt, auth, payload_sha2s, content_type, existing_ids, void_targets)
     
-def server_validate_statement(stmt, auth, payload_sha2s, content_type):
+def server_validate_statement(stmt, auth, payload_sha2s, content_type, existing_ids, void_targets):
     if 'id' in stmt:
         statement_id = stmt['id']
-        if check_for_existing_statementId(statement_id):
+        if statement_id in existing_ids:
             err_msg = "A statement with ID %s already exists" % statement_id
             raise ParamConflict(err_msg)
 
     if stmt['verb']['id'] == 'http://adlnet.gov/expapi/verbs/voided':
-        validate_void_statement(stmt['object']['id'])
+        void_id = stmt['object']['id']
+        validate_void_statement(void_id, void_targets.get(void_id, []))
 
     validate_stmt_authority(stmt, auth)
     if 'attachments' in stmt:
@@ -297,20 +309,12 @@ def activity_state_post(req_dict):
     agent = req_dict['params']['agent']
     a = Agent.objects.retrieve_or_create(**agent)[0]    
     exists = False
-    if registration:
-        try:
-            s = ActivityState.objects.get(state_id=req_dict['params']['stateId'], agent=a,
-                activity_id=req_dict['params']['activityId'], registration_id=req_dict['params']['registration'])
-            exists = True
-        except ActivityState.DoesNotExist:
-            pass
-    else:
-        try:
-            s = ActivityState.objects.get(state_id=req_dict['params']['stateId'], agent=a,
-                activity_id=req_dict['params']['activityId'])
-            exists = True
-        except ActivityState.DoesNotExist:
-            pass
+    try:
+        s = ActivityState.objects.only('content_type').get(state_id=req_dict['params']['stateId'], agent=a,
+            activity_id=req_dict['params']['activityId'], registration_id=registration or '')
+        exists = True
+    except ActivityState.DoesNotExist:
+        pass
     if exists:
         if str(s.content_type) != "application/json" or ("application/json" not in req_dict['headers']['CONTENT_TYPE'] or \
             req_dict['headers']['CONTENT_TYPE'] != "application/json"):
@@ -366,7 +370,7 @@ def activity_state_put(req_dict):
 
 @auth
 def activity_state_get(req_dict):
-    rogueparams = set(req_dict['params']) - set(["activityId", "agent", "stateId", "registration", "since"])
+    rogueparams = set(req_dict['params']) - set(["activityId", "agent", "stateId", "stateIds", "registration", "since"])
     if rogueparams:
         raise ParamError("The get activity state request contained unexpected parameters: %s" % ", ".join(rogueparams))
 
@@ -397,6 +401,17 @@ def activity_state_get(req_dict):
         except (Exception, ISO8601Error):
             raise ParamError("Since parameter was not a valid ISO8601 timestamp")
 
+    # Extension - several states fetched at once
+    if 'stateIds' in req_dict['params']:
+        if 'stateId' in req_dict['params'] or 'since' in req_dict['params']:
+            raise ParamError("stateIds param for activity state cannot be used with the stateId or since params")
+        try:
+            state_ids = json.loads(req_dict['params']['stateIds'])
+        except Exception:
+            raise ParamError("stateIds param for activity state is not valid")
+        if not isinstance(state_ids, list) or not all(isinstance(state_id, basestring) for state_id in state_ids):
+            raise ParamError("stateIds param for activity state must be an array of stateIds")
+        req_dict['params']['stateIds'] = state_ids
 
     # Extra validation if oauth
     if req_dict['auth']['type'] == 'oauth':
@@ -459,7 +474,7 @@ def activity_profile_post(req_dict):
     # Check the content type if the document already exists 
     exists = False
     try:
-        p = ActivityProfile.objects.get(activityId=req_dict['params']['activityId'], 
+        p = ActivityProfile.objects.only('content_type').get(activityId=req_dict['params']['activityId'], 
             profileId=req_dict['params']['profileId'])
         exists = True
     except ActivityProfile.DoesNotExist:
@@ -595,7 +610,7 @@ def agent_profile_post(req_dict):
     agent = req_dict['params']['agent']
     a = Agent.objects.retrieve_or_create(**agent)[0]   
     try:
-        p = AgentProfile.objects.get(profileId=req_dict['params']['profileId'],agent=a)
+        p = AgentProfile.objects.only('content_type').get(profileId=req_dict['params']['profileId'],agent=a)
         exists = True
     except AgentProfile.DoesNotExist:
         pass
@@ -713,8 +728,9 @@ def agents_get(req_dict):
     agent = json.loads(req_dict['params']['agent'])
     params = get_agent_ifp(agent)
 
-    if not Agent.objects.filter(**params).exists():
+    agent = Agent.objects.retrieve_by_ifp(params)
+    if not agent:
         raise IDNotFoundError("Error with Agent. The agent partial did not match any agents on record")
 
-    req_dict['agent_ifp'] = params
+    req_dict['agent'] = agent
     return req_dict
\ No newline at end of file
@@ -1,36 +1,65 @@
-import bencode
-import hashlib
 import json
-from datetime import datetime
-from itertools import chain
 
-from django.core.cache import cache
 from django.conf import settings
-from django.core.paginator import Paginator
+from django.core import signing
 from django.core.urlresolvers import reverse
 from django.db.models import Q
 
-from . import convert_to_utc
-from ..models import Statement, Agent
+from . import convert_to_utc, json_text_column
+from ..models import Statement, StatementRole, Agent
 from ..exceptions import NotFound
 
-def complex_get(param_dict, limit, language, format, attachments):
-    voidQ = Q(voided=False)
+# Params that make up the statement filter - they are carried in the more cursor so any page can rebuild the query
+filter_params = ['agent', 'related_agents', 'verb', 'activity', 'related_activities', 'registration', 'since',
+                 'until', 'ascending']
+MORE_CURSOR_SALT = 'lrs.statements.more'
+# Everything Statement.to_dict touches for canonical and ids formats, loaded for the whole page up front so building
+# the dicts does not query per statement
+agent_fields = ['actor', 'object_agent', 'context_instructor', 'context_team']
+stmt_select_related = ['verb', 'object_activity', 'object_substatement', 'authority', 'object_substatement__verb',
+                       'object_substatement__object_activity'] + agent_fields + \
+                      ['object_substatement__%s' % f for f in agent_fields]
+stmt_prefetch_related = ['stmt_attachments', 'authority__member'] + \
+                        ['%s__member' % f for f in agent_fields] + \
+                        ['object_substatement__%s__member' % f for f in agent_fields] + \
+                        ['context_ca_%s' % ca for ca in ['parent', 'grouping', 'category', 'other']] + \
+                        ['object_substatement__context_ca_%s' % ca for ca in ['parent', 'grouping', 'category', 'other']]
+
+def get_filters(param_dict):
+    filters = dict((k, v) for k, v in param_dict.items() if k in filter_params)
+    # For statements/read/mine oauth scope
+    if 'auth' in param_dict and (param_dict['auth'] and 'statements_mine_only' in param_dict['auth']):
+        filters['mine_only'] = param_dict['auth']['agent'].pk
+    # Agents are resolved once and later pages reuse their primary keys
+    if 'agent' in filters:
+        filters['agent'] = get_agent_pks(filters['agent'])
+    return filters
+
+def get_agent_pks(data):
+    agent = Agent.objects.retrieve(**data)
+    if not agent:
+        return []
+    # If agent is already a group, it can't be part of another group
+    if agent.objectType == "Group":
+        return [agent.pk]
+    # Since single agent, return all groups it is in
+    return [agent.pk] + list(agent.member.values_list('pk', flat=True))
+
+def build_filter(filters):
     # keep track if a filter other than time or sequence is used
     reffilter = False
 
     sinceQ = Q()
-    if 'since' in param_dict:
-        sinceQ = Q(stored__gt=convert_to_utc(param_dict['since']))
+    if 'since' in filters:
+        sinceQ = Q(stored__gt=convert_to_utc(filters['since']))
 
     untilQ = Q()
-    if 'until' in param_dict:
-        untilQ = Q(stored__lte=convert_to_utc(param_dict['until']))
+    if 'until' in filters:
+        untilQ = Q(stored__lte=convert_to_utc(filters['until']))
 
-    # For statements/read/mine oauth scope
     authQ = Q()
-    if 'auth' in param_dict and (param_dict['auth'] and 'statements_mine_only' in param_dict['auth']):
-        q_auth = param_dict['auth']['agent']
+    if 'mine_only' in filters:
+        q_auth = Agent.objects.get(pk=filters['mine_only'])
 
         # If oauth - set authority to look for as the user
         if q_auth.oauth_identifier:
@@ -43,246 +72,146 @@ def complex_get(param_dict, limit, language, format, attachments):
                 authQ = authQ | Q(authority=client.get_user_from_oauth_group())
 
     agentQ = Q()
-    if 'agent' in param_dict:
+    if 'agent' in filters:
         reffilter = True
-        agent = None
-        data = param_dict['agent']
-        related = 'related_agents' in param_dict and param_dict['related_agents']        
-
-        agent = Agent.objects.retrieve(**data)
-        if agent:
-            # If agent is already a group, it can't be part of another group
-            if agent.objectType == "Group":
-                groups = []
-            # Since single agent, return all groups it is in
-            else:
-                groups = agent.member.all()
-            agentQ = Q(actor=agent) | Q(object_agent=agent)
-            for g in groups:
-                agentQ = agentQ | Q(actor=g) | Q(object_agent=g)
+        me = filters['agent']
+        related = 'related_agents' in filters and filters['related_agents']
+        if me:
+            agentQ = Q(actor__in=me) | Q(object_agent__in=me)
             if related:
-                me = chain([agent], groups)
-                for a in me:
-                    agentQ = agentQ | Q(object_agent=a) | Q(authority=a) \
-                          | Q(context_instructor=a) | Q(context_team=a) \
-                          | Q(object_substatement__actor=a) \
-                          | Q(object_substatement__object_agent=a) \
-                          | Q(object_substatement__context_instructor=a) \
-                          | Q(object_substatement__context_team=a)
+                # Every role the agent or its groups hold is in the role index
+                agentQ = Q(id__in=StatementRole.objects.filter(agent__in=me).values('statement'))
 
     verbQ = Q()
-    if 'verb' in param_dict:
+    if 'verb' in filters:
         reffilter = True
-        verbQ = Q(verb__verb_id=param_dict['verb'])
+        verbQ = Q(verb__verb_id=filters['verb'])
         
     # activity
     activityQ = Q()
-    if 'activity' in param_dict:
+    if 'activity' in filters:
         reffilter = True
-        activityQ = Q(object_activity__activity_id=param_dict['activity'])
-        if 'related_activities' in param_dict and param_dict['related_activities']:
-            activityQ = activityQ | Q(context_ca_parent__activity_id=param_dict['activity']) \
-                    | Q(context_ca_grouping__activity_id=param_dict['activity']) \
-                    | Q(context_ca_category__activity_id=param_dict['activity']) \
-                    | Q(context_ca_other__activity_id=param_dict['activity']) \
-                    | Q(object_substatement__object_activity__activity_id=param_dict['activity']) \
-                    | Q(object_substatement__context_ca_parent__activity_id=param_dict['activity']) \
-                    | Q(object_substatement__context_ca_grouping__activity_id=param_dict['activity']) \
-                    | Q(object_substatement__context_ca_category__activity_id=param_dict['activity']) \
-                    | Q(object_substatement__context_ca_other__activity_id=param_dict['activity'])
+        activityQ = Q(object_activity__activity_id=filters['activity'])
+        if 'related_activities' in filters and filters['related_activities']:
+            activityQ = Q(id__in=StatementRole.objects.filter(activity__activity_id=filters['activity']).values('statement'))
 
     registrationQ = Q()
-    if 'registration' in param_dict:
+    if 'registration' in filters:
         reffilter = True
-        registrationQ = Q(context_registration=param_dict['registration'])
-
-    # If want ordered by ascending
-    stored_param = '-stored'
-    if 'ascending' in param_dict and param_dict['ascending']:
-            stored_param = 'stored'
-
-    stmtset = Statement.objects.prefetch_related('object_agent','object_activity','object_substatement','actor','verb','context_team','context_instructor','authority', \
-        'context_ca_parent', 'context_ca_grouping', 'context_ca_category', 'context_ca_other') \
-        .filter(untilQ & sinceQ & authQ & agentQ & verbQ & activityQ & registrationQ)
-    
-    stmtset = list(set(stmtset.values_list('statement_id', flat=True)))
+        registrationQ = Q(context_registration=filters['registration'])
+
+    filterQ = untilQ & sinceQ & authQ & agentQ & verbQ & activityQ & registrationQ
+    return filterQ, untilQ, sinceQ, reffilter
+
+def get_ref_levels(stmts, untilQ, sinceQ, depth=None):
+    # find statements where ids in the set are used in other statements' objects, then the statements referring
+    # to those and so on - each level stays a subquery so it can be rerun for every page. Once the depth is known
+    # (later pages) the levels are built without checking them
+    levels = []
+    level = Statement.objects.filter(Q(object_statementref__in=stmts.values('statement_id')) & untilQ & sinceQ)
+    while (len(levels) < depth) if depth is not None else level.exists():
+        levels.append(level)
+        level = Statement.objects.filter(Q(object_statementref__in=level.values('statement_id')) & untilQ & sinceQ)
+    return levels
+
+def get_statement_set(filters, ref_depth=None):
+    filterQ, untilQ, sinceQ, reffilter = build_filter(filters)
+    stmtset = Statement.objects.filter(filterQ)
+    levels = []
     # only find references when a filter other than
     # since, until, or limit was used 
     if reffilter:
-        stmtset = stmtset + stmt_ref_search(stmtset, untilQ, sinceQ)
-    
-    # Calculate limit of stmts to return
-    return_limit = set_limit(limit)
-
-    actual_length = len(list(set(Statement.objects.filter(Q(statement_id__in=stmtset) & voidQ))))
-
-    # If there are more stmts than the limit, need to break it up and return more id
-    if actual_length > return_limit:
-        return create_over_limit_stmt_result(stmtset, stored_param, return_limit, language, format, attachments)
-    else:
-        return create_under_limit_stmt_result(stmtset, stored_param, language, format)
-
-def stmt_ref_search(stmt_list, untilQ, sinceQ):
-    # find statements where ids in list are used in other statements' objects, context, substatements, and substatement context
-    stmtreflist = list(Statement.objects.filter(Q(object_statementref__in=stmt_list) & untilQ & sinceQ).values_list('statement_id', flat=True))
-    stmtreflist = list(set(stmtreflist))
-    if not stmtreflist:
-        return stmt_list
-
-    # get the statements that have a statement ref_id in the stmtreflist, recurse
-    return stmtreflist + list(set(stmt_ref_search(Statement.objects.filter(Q(object_statementref__in=stmt_list) & untilQ & sinceQ).values_list('statement_id', flat=True),
-        untilQ, sinceQ)))
+        levels = get_ref_levels(stmtset, untilQ, sinceQ, ref_depth)
+        if levels:
+            refQ = Q(id__in=stmtset.values('id'))
+            for level in levels:
+                refQ = refQ | Q(id__in=level.values('id'))
+            stmtset = Statement.objects.filter(refQ)
+    return stmtset.filter(voided=False), len(levels)
 
 def set_limit(req_limit):
     if not req_limit or req_limit > settings.SERVER_STMT_LIMIT:
         req_limit = settings.SERVER_STMT_LIMIT
     return req_limit
 
-def create_under_limit_stmt_result(stmt_set, stored, language, format):
-    stmt_result = {}
-    if stmt_set:
-        stmt_ids = list(set(Statement.objects.filter(Q(statement_id__in=stmt_set) & Q(voided=False)).values_list('statement_id', flat=True)))
-        stmt_set = Statement.objects.filter(statement_id__in=stmt_ids)
-        if format == 'exact':
-            stmt_result = '{"statements": [%s], "more": ""}' % ",".join([json.dumps(stmt.full_statement, sort_keys=False) for stmt in stmt_set.order_by(stored)])
-        else:
-            stmt_result['statements'] = [stmt.to_dict(language, format) for stmt in \
-                stmt_set.order_by(stored)]
-            stmt_result['more'] = ""
+def get_page(stmtset, cursor):
+    # Keyset page ordered by stored with the primary key breaking ties, one extra row tells if there is another page
+    ascending = 'ascending' in cursor['filters'] and cursor['filters']['ascending']
+    if ascending:
+        stmtset = stmtset.order_by('stored', 'id')
     else:
-        stmt_result['statements'] = []
-        stmt_result['more'] = ""
-    return stmt_result
+        stmtset = stmtset.order_by('-stored', '-id')
 
-def create_cache_key(stmt_list):
-    # Create unique hash data to use for the cache key
-    hash_data = []
-    hash_data.append(str(datetime.now()))
-    hash_data.append(str(stmt_list))
+    if cursor['last']:
+        last_stored, last_id = convert_to_utc(cursor['last'][0]), cursor['last'][1]
+        if ascending:
+            stmtset = stmtset.filter(Q(stored__gt=last_stored) | Q(stored=last_stored, id__gt=last_id))
+        else:
+            stmtset = stmtset.filter(Q(stored__lt=last_stored) | Q(stored=last_stored, id__lt=last_id))
+
+    # Exact statements are returned as the JSON text they were stored as so there is no need to build models
+    if cursor['format'] == 'exact':
+        stmtset = stmtset.extra(select={'full_statement_text': json_text_column(Statement, 'full_statement')})
+        # Encoded once here so the response length is known before the text is streamed
+        stmts = [row[:3] + (row[3].encode('utf-8'),) for row in
+                 stmtset.values_list('stored', 'id', 'statement_id', 'full_statement_text')[:cursor['limit'] + 1]]
+        get_position = lambda row: [row[0].isoformat(), row[1]]
+    else:
+        stmtset = stmtset.select_related(*stmt_select_related).prefetch_related(*stmt_prefetch_related)
+        stmts = list(stmtset[:cursor['limit'] + 1])
+        get_position = lambda stmt: [stmt.stored.isoformat(), stmt.id]
 
-    # Create cache key from hashed data (always 32 digits)
-    key = hashlib.md5(bencode.bencode(hash_data)).hexdigest()
-    return key
+    if len(stmts) > cursor['limit']:
+        stmts = stmts[:cursor['limit']]
+        cursor['last'] = get_position(stmts[-1])
+    else:
+        cursor['last'] = None
+    return stmts
 
-def create_over_limit_stmt_result(stmt_list, stored, limit, language, format, attachments):
+def create_more_url(cursor):
     from ..views import statements_more_placeholder
-    # First time someone queries POST/GET
+    if not cursor['last']:
+        return ""
+    return "%s/%s" % (reverse(statements_more_placeholder).lower(), signing.dumps(cursor, salt=MORE_CURSOR_SALT, compress=True))
+
+def build_exact_result(rows, more):
+    # Pieces of the statement result around the stored JSON, yielded as the response is written
+    yield '{"statements": ['
+    for i, row in enumerate(rows):
+        if i:
+            yield ','
+        yield row[3]
+    yield '], "more": "%s"}' % more
+
+def exact_result_length(rows, more):
+    # Same layout as build_exact_result - the brackets, a comma between statements and the more url
+    return len('{"statements": [') + sum(len(row[3]) for row in rows) + max(len(rows) - 1, 0) + \
+        len('], "more": "%s"}' % more)
+
+def build_statement_result(stmts, cursor):
+    # Returns the encoded pieces of the result, their total length and the ids of the statements in it
+    more = create_more_url(cursor)
+    if cursor['format'] == 'exact':
+        return build_exact_result(stmts, more), exact_result_length(stmts, more), [row[2] for row in stmts]
     result = {}
-    cache_list = []
-
-    stmt_ids = list(set(Statement.objects.filter(Q(statement_id__in=stmt_list) & Q(voided=False)).values_list('statement_id', flat=True)))
-    stmt_list = Statement.objects.filter(statement_id__in=stmt_ids)
-    cache_list.append([s for s in stmt_list.order_by(stored).values_list('id', flat=True)])
-    stmt_pager = Paginator(cache_list[0], limit)
-
-    # Always start on first page
-    current_page = 1
-    total_pages = stmt_pager.num_pages
-    # Create cache key from hashed data (always 32 digits)
-    cache_key = create_cache_key(cache_list[0])
+    result['statements'] = [stmt.to_dict(cursor['language'], cursor['format']) for stmt in stmts]
+    result['more'] = more
+    result_text = json.dumps(result)
+    return [result_text], len(result_text), [st['id'] for st in result['statements']]
 
-    # Add data to cache
-    cache_list.append(current_page)
-    cache_list.append(total_pages)
-    cache_list.append(limit)
-    cache_list.append(attachments)
-    cache_list.append(language)
-    cache_list.append(format)
-    cache_list.append(stored)
-    
-    # Encode data
-    encoded_info = json.dumps(cache_list)
-    # Save encoded_dict in cache
-    cache.set(cache_key,encoded_info)
-
-    # Return first page of results
-    if format == 'exact':
-        result = '{"statements": [%s], "more": "%s"}' % (",".join([json.dumps(stmt.full_statement, sort_keys=False) for stmt in \
-                Statement.objects.filter(id__in=stmt_pager.page(1).object_list).order_by(stored)]),
-                reverse(statements_more_placeholder).lower() + "/" + cache_key)
-    else:
-        result['statements'] = [stmt.to_dict(language, format) for stmt in \
-                        Statement.objects.filter(id__in=stmt_pager.page(1).object_list).order_by(stored)]
-        result['more'] = "%s/%s" % (reverse(statements_more_placeholder).lower(), cache_key) 
-    return result
-
-def parse_more_request(req_id):  
-    # Retrieve encoded info for statements
-    encoded_info = cache.get(req_id)
-    # Could have expired or never existed
-    if not encoded_info:
+def complex_get(param_dict, limit, language, format, attachments):
+    # Cursor holds everything needed to serve the next page - the filter, output options and the last row seen
+    cursor = {'filters': get_filters(param_dict), 'limit': set_limit(limit), 'language': language, 'format': format,
+              'attachments': attachments, 'last': None}
+    stmtset, cursor['ref_depth'] = get_statement_set(cursor['filters'])
+    return build_statement_result(get_page(stmtset, cursor), cursor)
+
+def parse_more_request(req_id):
+    try:
+        cursor = signing.loads(req_id, salt=MORE_CURSOR_SALT, max_age=settings.MORE_CURSOR_MAX_AGE)
+    # Could have expired, been tampered with or never existed
+    except signing.BadSignature:
         raise NotFound("List does not exist - may have expired after 24 hours")
-    # Decode info
-    decoded_info = json.loads(encoded_info)
 
-    data = {}
-    # Info is always cached as [stmt_list, start_page, total_pages, limit, attachments, language, format]
-    data["stmt_list"] = decoded_info[0]
-    data["start_page"] = decoded_info[1]
-    data["total_pages"] = decoded_info[2]
-    data["limit"] = decoded_info[3]
-    data["attachments"] = decoded_info[4]
-    data["language"] = decoded_info[5]
-    data["format"] = decoded_info[6]
-    data["stored"] = decoded_info[7]
-
-    # Build statementResult
-    stmt_result = build_statement_result(req_id, **data)
-    return stmt_result, data["attachments"]
-
-# Gets called from req_process after complex_get with list of django objects and also gets called from parse_more_request when
-# more_id is used so list will be serialized
-def build_statement_result(more_id, **data):
-    from ..views import statements_more_placeholder
-    result = {}
-    current_page = data["start_page"] + 1
-    # If that was the last page to display then just return the remaining stmts
-    if current_page == data["total_pages"]:
-        stmt_pager = Paginator(data["stmt_list"], data["limit"])
-        # Return first page of results
-        if data["format"] == 'exact':
-            result = '{"statements": [%s], "more": ""}' % ",".join([json.dumps(stmt.to_dict(data["language"], data["format"]), sort_keys=False) for stmt in \
-                Statement.objects.filter(id__in=stmt_pager.page(current_page).object_list).order_by(data["stored"])])
-        else:
-            result['statements'] = [stmt.to_dict(data["language"], data["format"]) for stmt in \
-                    Statement.objects.filter(id__in=stmt_pager.page(current_page).object_list).order_by(data["stored"])]
-            result['more'] = ""
-        # Set current page back for when someone hits the URL again
-        current_page -= 1
-        # Retrieve list stored in cache
-        encoded_list = cache.get(more_id)
-        # Decode info to set the current page back then encode again
-        decoded_list = json.loads(encoded_list)
-        decoded_list[1] = current_page
-        encoded_list = json.dumps(decoded_list)
-        cache.set(more_id, encoded_list)
-    # There are more pages to display
-    else:
-        stmt_pager = Paginator(data["stmt_list"], data["limit"])
-        # Create cache key from hashed data (always 32 digits)
-        cache_key = create_cache_key(data["stmt_list"])
-        # Return first page of results
-        if data["format"] == 'exact':
-            result = '{"statements": [%s], "more": "%s"}' % (",".join([json.dumps(stmt.to_dict(data["language"], data["format"]), sort_keys=False) for stmt in \
-                Statement.objects.filter(id__in=stmt_pager.page(current_page).object_list).order_by(data["stored"])]),
-                reverse(statements_more_placeholder).lower() + "/" + cache_key)
-        else:
-            # Set result to have selected page of stmts and more endpoint
-            result['statements'] = [stmt.to_dict(data["language"], data["format"]) for stmt in \
-                    Statement.objects.filter(id__in=stmt_pager.page(current_page).object_list).order_by(data["stored"])]
-            result['more'] = "%s/%s" % (reverse(statements_more_placeholder).lower(), cache_key)
-        more_cache_list = []
-        # Increment next page
-        start_page = current_page
-        more_cache_list.append(data["stmt_list"])
-        more_cache_list.append(start_page)
-        more_cache_list.append(data["total_pages"])
-        more_cache_list.append(data["limit"])
-        more_cache_list.append(data["attachments"])
-        more_cache_list.append(data["language"])
-        more_cache_list.append(data["format"])
-        more_cache_list.append(data["stored"])
-        # Encode info
-        encoded_list = json.dumps(more_cache_list)
-        cache.set(cache_key, encoded_list)
-    return result
\ No newline at end of file
+    stmtset, cursor['ref_depth'] = get_statement_set(cursor['filters'], cursor['ref_depth'])
+    return build_statement_result(get_page(stmtset, cursor), cursor), cursor['attachments']
@@ -11,6 +11,7 @@ from django.views.decorators.http import require_http_methods
 
 from .exceptions import BadRequest, Unauthorized, Forbidden, NotFound, Conflict, PreconditionFail, OauthUnauthorized, OauthBadRequest
 from .utils import req_validate, req_parse, req_process, XAPIVersionHeaderMiddleware
+from .utils.model_cache import cache_committed_rows
 
 # This uses the lrs logger for LRS specific information
 logger = logging.getLogger(__name__)
@@ -192,6 +193,7 @@ processors = {
    }     
 }
 
+@cache_committed_rows
 @transaction.commit_on_success
 def handle_request(request, more_id=None):
     try:
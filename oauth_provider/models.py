@@ -4,14 +4,13 @@ import urlparse
 from datetime import datetime
 from time import time
 import oauth2 as oauth
-from Crypto.PublicKey import RSA
 from django.db import models
 
 from oauth_provider.compat import AUTH_USER_MODEL, get_random_string
 from oauth_provider.managers import TokenManager
 from oauth_provider.consts import KEY_SIZE, RSA_SECRET_SIZE, CONSUMER_KEY_SIZE, CONSUMER_STATES,\
     PENDING, VERIFIER_SIZE, MAX_URL_LENGTH, OUT_OF_BAND, REGULAR_SECRET_SIZE
-from oauth_provider.utils import check_valid_callback
+from oauth_provider.utils import check_valid_callback, import_rsa_key
 
 
 class Nonce(models.Model):
@@ -75,7 +74,7 @@ class Consumer(models.Model):
     def generate_rsa_key(self):
         if not self.secret or len(self.secret) == REGULAR_SECRET_SIZE:
             return None
-        return RSA.importKey(self.secret)
+        return import_rsa_key(self.secret)
 
 class Token(models.Model):
     REQUEST = 1
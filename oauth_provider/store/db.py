@@ -1,10 +1,11 @@
+import time
 import oauth2 as oauth
 
 from django.conf import settings
-from oauth_provider.compat import now
 
 from oauth_provider.store import InvalidConsumerError, InvalidTokenError, Store
-from oauth_provider.models import Nonce, Token, Consumer, VERIFIER_SIZE
+from oauth_provider.store.nonce import nonce_store
+from oauth_provider.models import Token, Consumer, VERIFIER_SIZE
 
 NONCE_VALID_PERIOD = getattr(settings, "OAUTH_NONCE_VALID_PERIOD", None)
 SCOPES = [x[1] for x in settings.OAUTH_SCOPES]
@@ -97,12 +98,11 @@ class ModelStore(Store):
     def check_nonce(self, request, oauth_request, nonce, timestamp=0):
         timestamp = int(timestamp)
 
-        if NONCE_VALID_PERIOD and int(now().strftime("%s")) - timestamp > NONCE_VALID_PERIOD:
+        # LRS CHANGE - COMPARE AGAINST THE EPOCH DIRECTLY, STRFTIME("%s") READS THE UTC TIME AS LOCAL TIME. TIMESTAMPS
+        # TOO FAR AHEAD ARE REFUSED AS WELL SO A NONCE ONLY HAS TO BE REMEMBERED FOR THE VALID PERIOD
+        if NONCE_VALID_PERIOD and abs(int(time.time()) - timestamp) > NONCE_VALID_PERIOD:
             return False
 
-        nonce, created = Nonce.objects.get_or_create(
-            consumer_key=oauth_request['oauth_consumer_key'],
-            token_key=oauth_request.get('oauth_token', ''),
-            key=nonce, timestamp=timestamp,
-        )
-        return created
+        # LRS CHANGE - NONCES ARE KEPT BY THE CONFIGURED NONCE STORE
+        return nonce_store.check_nonce(oauth_request['oauth_consumer_key'], oauth_request.get('oauth_token', ''),
+            nonce, timestamp)
@@ -0,0 +1,122 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import importlib
+
+from oauth_provider.models import Nonce
+
+NONCE_VALID_PERIOD = getattr(settings, "OAUTH_NONCE_VALID_PERIOD", None)
+
+
+class NonceStore(object):
+    """
+    Remembers the nonces of signed requests so that none of them can be replayed.
+    """
+    def check_nonce(self, consumer_key, token_key, nonce, timestamp):
+        """
+        Return `True` the first time `nonce` is seen for the consumer and token, `False` after.
+
+        `consumer_key`: The key of the Consumer that signed the request.
+        `token_key`: The key of the Token the request was signed with, empty if none.
+        `nonce`: The nonce to check.
+        `timestamp`: The request timestamp, in seconds since the epoch.
+        """
+        raise NotImplementedError
+
+
+class ModelNonceStore(NonceStore):
+    """
+    Keeps every nonce as a `Nonce` row. Rows older than `OAUTH_NONCE_VALID_PERIOD` are
+    never looked at again and can be removed with the purge_oauth_nonces command.
+    """
+    def check_nonce(self, consumer_key, token_key, nonce, timestamp):
+        nonce, created = Nonce.objects.get_or_create(
+            consumer_key=consumer_key,
+            token_key=token_key,
+            key=nonce, timestamp=timestamp,
+        )
+        return created
+
+
+class ExpiringNonceStore(NonceStore):
+    """
+    Base for stores that forget a nonce once its timestamp falls outside of
+    `OAUTH_NONCE_VALID_PERIOD`, after which the request would be refused anyway.
+    """
+    def __init__(self):
+        if not NONCE_VALID_PERIOD:
+            raise ImproperlyConfigured('%s needs OAUTH_NONCE_VALID_PERIOD to be set' % self.__class__.__name__)
+
+    def get_key(self, consumer_key, token_key, nonce, timestamp):
+        # Nonces are chosen by the client, hashing keeps the key short and safe for any cache
+        return 'oauth_nonce:%s' % hashlib.sha1('%s:%s:%s:%s' % (consumer_key, token_key, nonce, timestamp)).hexdigest()
+
+    def get_expiry(self, timestamp):
+        return timestamp + NONCE_VALID_PERIOD
+
+
+class LocalNonceStore(ExpiringNonceStore):
+    """
+    Keeps nonces in memory. Other processes do not see them, so this only suits a
+    deployment running a single process.
+    """
+    def __init__(self):
+        super(LocalNonceStore, self).__init__()
+        self.nonces = {}
+        self.lock = threading.Lock()
+        self.next_sweep = 0
+
+    def check_nonce(self, consumer_key, token_key, nonce, timestamp):
+        key = self.get_key(consumer_key, token_key, nonce, timestamp)
+        now = time.time()
+        with self.lock:
+            # Expired nonces are dropped once per valid period
+            if now >= self.next_sweep:
+                self.nonces = dict((k, expires) for k, expires in self.nonces.iteritems() if expires > now)
+                self.next_sweep = now + NONCE_VALID_PERIOD
+            expires = self.nonces.get(key)
+            if expires is not None and expires > now:
+                return False
+            self.nonces[key] = self.get_expiry(timestamp)
+            return True
+
+
+class CacheNonceStore(ExpiringNonceStore):
+    """
+    Keeps nonces in the `OAUTH_NONCE_CACHE` cache, shared by every process. The cache
+    should not evict live entries early, memcached sized for the traffic does fine.
+    """
+    def __init__(self):
+        super(CacheNonceStore, self).__init__()
+        self.cache = get_cache(getattr(settings, 'OAUTH_NONCE_CACHE', 'default'))
+
+    def check_nonce(self, consumer_key, token_key, nonce, timestamp):
+        # add only writes a key that is not there yet, so seeing and recording the nonce is one step
+        timeout = max(int(self.get_expiry(timestamp) - time.time()), 1)
+        return self.cache.add(self.get_key(consumer_key, token_key, nonce, timestamp), 1, timeout)
+
+
+def get_nonce_store(path='oauth_provider.store.nonce.ModelNonceStore'):
+    """
+    Load the nonce store. Should not be called directly unless testing.
+    """
+    path = getattr(settings, 'OAUTH_NONCE_STORE', path)
+
+    try:
+        module, attr = path.rsplit('.', 1)
+        store_class = getattr(importlib.import_module(module), attr)
+    except ValueError:
+        raise ImproperlyConfigured('Invalid oauth nonce store string: "%s"' % path)
+    except ImportError, e:
+        raise ImproperlyConfigured('Error loading oauth nonce store module "%s": "%s"' % (module, e))
+    except AttributeError:
+        raise ImproperlyConfigured('Module "%s" does not define an oauth nonce store named "%s"' % (module, attr))
+
+    return store_class()
+
+
+nonce_store = get_nonce_store()
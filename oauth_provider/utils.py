@@ -1,7 +1,10 @@
 import ast
 import binascii
+import hashlib
+import threading
 import urllib
 import oauth2 as oauth
+from collections import OrderedDict
 from urlparse import urlparse, urlunparse
 
 from Crypto.PublicKey import RSA
@@ -17,6 +20,33 @@ from consts import MAX_URL_LENGTH
 OAUTH_REALM_KEY_NAME = getattr(settings, 'OAUTH_REALM_KEY_NAME', '')
 OAUTH_SIGNATURE_METHODS = getattr(settings, 'OAUTH_SIGNATURE_METHODS', ['plaintext', 'hmac-sha1','rsa-sha1'])
 OAUTH_BLACKLISTED_HOSTNAMES = getattr(settings, 'OAUTH_BLACKLISTED_HOSTNAMES', [])
+RSA_KEY_CACHE_SIZE = getattr(settings, 'RSA_KEY_CACHE_SIZE', 100)
+
+# LRS CHANGE - PARSED RSA KEYS BY PARSER AND A HASH OF THE BYTES THEY CAME FROM, SHARED WITH STATEMENT JWS
+# VERIFICATION SO A FEW SIGNING KEYS ARE NOT PARSED AGAIN ON EVERY REQUEST
+rsa_keys = OrderedDict()
+rsa_keys_lock = threading.Lock()
+
+def import_rsa_key(data, parse=RSA.importKey):
+    """
+    Return the key `parse` builds from `data`, each distinct key or certificate is only
+    parsed again once it drops out of the `RSA_KEY_CACHE_SIZE` most recently used.
+    """
+    if not RSA_KEY_CACHE_SIZE:
+        return parse(data)
+    raw = data.encode('utf-8') if isinstance(data, unicode) else data
+    cache_key = (parse, hashlib.sha256(raw).digest())
+    with rsa_keys_lock:
+        key = rsa_keys.pop(cache_key, None)
+        if key is not None:
+            rsa_keys[cache_key] = key
+            return key
+    key = parse(data)
+    with rsa_keys_lock:
+        rsa_keys[cache_key] = key
+        while len(rsa_keys) > RSA_KEY_CACHE_SIZE:
+            rsa_keys.popitem(last=False)
+    return key
 
 def initialize_server_request(request):
     """Shortcut for initialization."""
@@ -184,7 +214,7 @@ class SignatureMethod_RSA_SHA1(oauth.SignatureMethod):
             key = consumer.generate_rsa_key()
         # If incoming consumer is consumer object from verify
         else:
-            key = RSA.importKey(consumer.secret)
+            key = import_rsa_key(consumer.secret)
         
         raw = '&'.join(sig)
         return key, raw